@@ -52,6 +52,7 @@ dealiniApp.controller('ToastCtrl', function ($scope, $mdToast, text, error) {
 
 dealiniApp.controller("UrlsController", function ($scope, DealiniFactory, $mdMenu, $filter, $mdDialog, $mdToast) {
     let params = "";
+    let queriedParams = "";
 
     function initValues() {
         $scope.filter = {
@@ -80,11 +81,14 @@ dealiniApp.controller("UrlsController", function ($scope, DealiniFactory, $mdMen
         });
     };
 
-    $scope.queryUrls = function (params = "") {
+    $scope.queryUrls = function (params = "", cursor = null) {
         $scope.showCustomToast("Processing...");
-        DealiniFactory.fetchUrls(params).then(function (success) {
+        DealiniFactory.fetchUrls(params, cursor).then(function (success) {
             $scope.showCustomToast("Done!", false, 1500);
-            $scope.urls = success.data;
+            // Next page continues the query it was returned for, even if filters changed meanwhile
+            $scope.urls = cursor ? $scope.urls.concat(success.data) : success.data;
+            $scope.nextCursor = success.headers("X-Next-Cursor");
+            queriedParams = params;
         }, function (error) {
             $scope.showCustomToast("Something went wrong", true, 1500);
             console.log(error);
@@ -92,6 +96,10 @@ dealiniApp.controller("UrlsController", function ($scope, DealiniFactory, $mdMen
     }
     $scope.queryUrls();
 
+    $scope.loadMore = function () {
+        $scope.queryUrls(queriedParams, $scope.nextCursor);
+    }
+
     $scope.urlDetails = function (url) {
         $mdDialog.show({
             controller: DialogController,
@@ -213,8 +221,20 @@ dealiniApp.controller("UrlsController", function ($scope, DealiniFactory, $mdMen
                 console.error(error)
             })
         }
+        $scope.history = {bucket: "month"};
+        $scope.getHistory = function(bucket){
+            $scope.history.bucket = bucket;
+            DealiniFactory.getUrlHistory($scope.url.id, {bucket: bucket}).then(function(success){
+                $scope.history.data = success.data;
+                $scope.history.error = null;
+            }, function(error){
+                $scope.history.data = null;
+                $scope.history.error = error.data;
+            })
+        }
         $scope.getVisits();
         $scope.getVisitors();
+        $scope.getHistory($scope.history.bucket);
         $scope.hide = function () {
             $mdDialog.hide();
         };
@@ -9,9 +9,12 @@ dealiniApp.factory("DealiniFactory", ['$q', '$http', function ($q, $http) {
         })
         return urlShorten.promise;
     }
-    factory.fetchUrls = function(params){
+    factory.fetchUrls = function(params, cursor){
         let urls = $q.defer()
         let url = "/url/all"+params
+        if(cursor){
+            url += (params.indexOf("?") === -1 ? "?" : "&") + "cursor=" + encodeURIComponent(cursor)
+        }
         $http.get(url).then(function(success){
             urls.resolve(success)
         }, function(error){
@@ -37,5 +40,14 @@ dealiniApp.factory("DealiniFactory", ['$q', '$http', function ($q, $http) {
         })
         return visitors.promise;
     }
+    factory.getUrlHistory = function(id, params){
+        let history = $q.defer()
+        $http.get("/url/"+id+"/history", {params: params}).then(function(success){
+            history.resolve(success)
+        }, function(error){
+            history.reject(error);
+        })
+        return history.promise;
+    }
     return factory;
 }])
\ No newline at end of file
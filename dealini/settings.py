@@ -71,6 +71,9 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'dealini.wsgi.application'
 
+# Serve /url/<short url> redirects straight from dealini.wsgi, bypassing middleware and url resolving.
+# SHORT_URL_FAST_PATH = False
+
 
 # Database
 # https://docs.djangoproject.com/en/1.11/ref/settings/#databases
@@ -115,6 +118,87 @@ CACHES = {
     }
 }
 
+# Short url and visit settings below are shown with their defaults from shortenurls/const.py,
+# uncomment and change only the ones that need overriding.
+
+# Per-process LRU of short url lookups kept in front of memcache, 0 disables it.
+# SHORT_URL_L1_CACHE_SIZE = 10000
+# SHORT_URL_L1_CACHE_TTL = 60
+# Short urls are only admitted to it once hit this many times in the current hot urls slot, 1 admits every one.
+# SHORT_URL_L1_ADMIT_HITS = 2
+
+# Per-process LRU of user agent strings to ids of their interned rows, 0 disables it.
+# USER_AGENT_CACHE_SIZE = 10000
+# USER_AGENT_CACHE_TTL = 3600
+
+# Per-process heavy hitters summary of redirects, merged into the cache every flush interval (seconds).
+# HOT_URLS_CAPACITY = 1000
+# HOT_URLS_FLUSH_INTERVAL = 10
+
+# Length new short urls start at, it grows by itself once all short urls of a length are issued.
+# Every process reserves SHORT_URL_BLOCK_SIZE short urls at a time.
+# SHORT_URL_LENGTH = 5
+# SHORT_URL_BLOCK_SIZE = 100
+
+# Unknown short urls are remembered in memcache for this many seconds.
+# SHORT_URL_NEGATIVE_CACHE_TTL = 60
+
+# Optional per-process Bloom filter of existing short urls, rejects unknown ones without a database query.
+# SHORT_URL_BLOOM_FILTER = False
+# SHORT_URL_BLOOM_CAPACITY = 1000000
+# SHORT_URL_BLOOM_ERROR_RATE = 0.01
+
+# Visit recording
+# With write-behind enabled redirects only buffer visit events, buffered events are
+# applied in batches by the background_task worker (manage.py process_tasks).
+
+# VISIT_WRITE_BEHIND = False
+# VISIT_BUFFER_SIZE = 500
+# VISIT_BUFFER_INTERVAL = 5
+
+# With async recording enabled redirects are sent first and visits are written by a background
+# thread of the worker process. Visits are recorded synchronously when the queue is full.
+
+# VISIT_ASYNC = False
+# VISIT_QUEUE_SIZE = 10000
+
+# Unique visitors are counted with HyperLogLog sketches kept per url and per day. With visitor rows disabled
+# no UrlVisitors row is stored per (day, IP) and unique visitor counts are sketch estimates.
+# KEEP_VISITOR_ROWS = True
+
+# Visitor rows older than this many days are folded into daily visit records and deleted by the compact_visits
+# command, None keeps them forever. With a retention period url wide unique visitor counts are sketch estimates,
+# since visitor rows no longer cover the whole history of urls.
+# VISITOR_RETENTION_DAYS = None
+
+# Reachability check of URLs being shortened
+# "sync" checks the URL before the short url is issued, "deferred" issues the short url right
+# away and verifies the URL in a background task which marks the link as verified or not.
+
+# URL_VERIFICATION = "sync"
+# URL_CHECK_TIMEOUT = (3.05, 5)
+# URL_CHECK_CACHE_TTL = 3600
+# URL_CHECK_FAILURE_TTL = 300
+# URL_CHECK_POOL_SIZE = 10
+
+# Maximum number of URLs accepted by a single /url/bulk request. URLs shortened in bulk are always verified
+# by background tasks, whatever URL_VERIFICATION is.
+# BULK_SHORTEN_LIMIT = 1000
+
+# Page size of /url/all when no results parameter is given, and the maximum one a client can ask for.
+# URL_PAGE_SIZE = 100
+# URL_MAX_PAGE_SIZE = 1000
+
+# Visit reports (/url/report and the visits_report command) need numpy. Visit records are loaded this many rows
+# at a time.
+# REPORT_CHUNK_SIZE = 100000
+
+# Seconds responses of /url/all, /url/<id>/visits and /url/<id>/visitors are cached for, 0 disables the cache.
+# Cached responses of a url's visits and visitors are dropped as soon as the url is visited, cached listings as soon
+# as urls are created. Visits don't invalidate listings, their ETag changes every URLS_LIST_MAX_AGE seconds.
+# RESPONSE_CACHE_TTL = 5
+# URLS_LIST_MAX_AGE = 60
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.11/topics/i18n/
 
@@ -8,9 +8,65 @@ https://docs.djangoproject.com/en/1.11/howto/deployment/wsgi/
 """
 
 import os
+import re
 
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "dealini.settings")
 
 application = get_wsgi_application()
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils.encoding import force_bytes, force_str, iri_to_uri
+from django.utils.six.moves.urllib.parse import urlparse
+
+from shortenurls.const import SHORT_URL_FAST_PATH, SHORT_URL_PATTERN, SHORT_URL_RESERVED
+from shortenurls.exceptions import URLException
+from shortenurls.models import Url
+from shortenurls.visits import record_visit
+
+
+class ShortUrlDispatcher(object):
+    """ Serves short url redirects directly, without Django's middleware stack and url resolver. Every other
+    request, and redirects the fast path can't produce itself, are passed to the wrapped Django application.
+    """
+    pattern = re.compile(r'^/url/(?P<url>%s)$' % SHORT_URL_PATTERN)
+    allowed_schemes = ['http', 'https', 'ftp']
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        match = self.pattern.match(environ.get('PATH_INFO', ''))
+        if match is None or match.group('url') in SHORT_URL_RESERVED or \
+                environ.get('REQUEST_METHOD') not in ('GET', 'HEAD'):
+            return self.app(environ, start_response)
+        # Django's handler does this on request_started/request_finished signals
+        close_old_connections()
+        try:
+            try:
+                url_obj = Url.check_short_url(match.group('url'))
+            except URLException:
+                return self.app(environ, start_response)
+            location = iri_to_uri(url_obj.original_url)
+            scheme = urlparse(location).scheme
+            if scheme and scheme not in self.allowed_schemes:
+                return self.app(environ, start_response)
+            try:
+                record_visit(url_obj.id, environ)
+            except URLException as fail:
+                body = force_bytes(fail)
+                start_response('200 OK', [('Content-Type', 'text/html; charset=utf-8'),
+                                          ('Content-Length', str(len(body)))])
+                return [body]
+        finally:
+            close_old_connections()
+        start_response('301 Moved Permanently', [('Location', force_str(location)),
+                                                 ('Content-Type', 'text/html; charset=utf-8'),
+                                                 ('Content-Length', '0')])
+        return [b'']
+
+
+if getattr(settings, "SHORT_URL_FAST_PATH", SHORT_URL_FAST_PATH):
+    application = ShortUrlDispatcher(application)
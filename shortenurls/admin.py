@@ -13,6 +13,7 @@ class VisitsInLine(admin.StackedInline):
 
 class VisitorsInLine(admin.StackedInline):
     model = UrlVisitors
+    raw_id_fields = ("agent",)
 
 
 class URLAdmin(admin.ModelAdmin):
@@ -0,0 +1,135 @@
+import binascii
+import hashlib
+import math
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+
+from shortenurls.const import SHORT_URL_BLOOM_CAPACITY, SHORT_URL_BLOOM_ERROR_RATE, SHORT_URL_BLOOM_FILTER, \
+    SHORT_URL_BLOOM_GENERATION_KEY
+
+# Urls created by concurrent transactions may become visible out of id order, so every refresh re-reads this many
+# ids below the highest id already in the filter. Adding a short url twice is harmless.
+REFRESH_OVERLAP = 100
+
+
+class BloomFilter(object):
+    """ Plain Bloom filter. Membership test can return false positives (bounded by error_rate while count stays
+    below capacity) but never false negatives.
+    """
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.bits = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.bits / float(capacity) * math.log(2))))
+        self.count = 0
+        self._array = bytearray((self.bits + 7) // 8)
+
+    def _positions(self, key):
+        digest = hashlib.md5(key.encode("utf-8")).digest()
+        first = int(binascii.hexlify(digest[:8]), 16)
+        second = int(binascii.hexlify(digest[8:]), 16) | 1
+        return [(first + i * second) % self.bits for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self._array[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        for position in self._positions(key):
+            if not self._array[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+class ShortUrlFilter(object):
+    """ Per-process Bloom filter of every existing short url, used to reject unknown short urls without touching
+    the database. Filter is built on first use. Every Url creation bumps a generation counter in memcache, when a
+    lookup misses the filter and the generation changed, urls created since the last refresh are loaded first.
+    """
+
+    def __init__(self, capacity=SHORT_URL_BLOOM_CAPACITY, error_rate=SHORT_URL_BLOOM_ERROR_RATE):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.bloom = None
+        self.max_id = 0
+        self.generation = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def enabled():
+        return getattr(settings, "SHORT_URL_BLOOM_FILTER", SHORT_URL_BLOOM_FILTER)
+
+    @staticmethod
+    def _generation():
+        generation = cache.get(SHORT_URL_BLOOM_GENERATION_KEY)
+        if generation is None:
+            # Counter got evicted, start a new one so misses don't refresh until next url creation
+            cache.add(SHORT_URL_BLOOM_GENERATION_KEY, 0, None)
+            generation = cache.get(SHORT_URL_BLOOM_GENERATION_KEY)
+        return generation
+
+    def build(self):
+        """ (Re)builds the filter from the database"""
+        with self._lock:
+            self.generation = self._generation()
+            self.bloom = BloomFilter(self.capacity, self.error_rate)
+            self.max_id = 0
+            self._load()
+
+    def _load(self):
+        # Imported here since models module depends on this one
+        from shortenurls.models import Url
+        rows = Url.objects.filter(id__gt=self.max_id - REFRESH_OVERLAP).values_list("id", "shorten_url")
+        for url_id, short_url in rows.iterator():
+            if short_url not in self.bloom:
+                self.bloom.add(short_url)
+            self.max_id = max(self.max_id, url_id)
+        if self.bloom.count > self.bloom.capacity:
+            # Filter got saturated, grow it so false positive rate stays as configured
+            self.capacity = self.bloom.count * 2
+            self.bloom = BloomFilter(self.capacity, self.error_rate)
+            self.max_id = 0
+            self._load()
+
+    def _refresh(self):
+        generation = self._generation()
+        with self._lock:
+            if generation is not None and generation == self.generation:
+                return False
+            self.generation = generation
+            self._load()
+        return True
+
+    def might_exist(self, short_url):
+        """ Returns False only if short url certainly doesn't exist. Always True when filter is disabled."""
+        if not self.enabled():
+            return True
+        if self.bloom is None:
+            self.build()
+        if short_url in self.bloom:
+            return True
+        return self._refresh() and short_url in self.bloom
+
+    def add(self, *short_urls):
+        """ Marks newly created short urls as existing in this process and notifies other processes"""
+        if not self.enabled() or not short_urls:
+            return
+        try:
+            generation = cache.incr(SHORT_URL_BLOOM_GENERATION_KEY, len(short_urls))
+        except ValueError:
+            generation = len(short_urls) if cache.add(SHORT_URL_BLOOM_GENERATION_KEY, len(short_urls), None) else None
+        if self.bloom is not None:
+            with self._lock:
+                for short_url in short_urls:
+                    self.bloom.add(short_url)
+                if generation is not None and self.generation == generation - len(short_urls):
+                    # Nobody else created a url meanwhile, no need to refresh on next miss
+                    self.generation = generation
+
+
+short_url_filter = ShortUrlFilter(getattr(settings, "SHORT_URL_BLOOM_CAPACITY", SHORT_URL_BLOOM_CAPACITY),
+                                  getattr(settings, "SHORT_URL_BLOOM_ERROR_RATE", SHORT_URL_BLOOM_ERROR_RATE))
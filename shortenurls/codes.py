@@ -0,0 +1,107 @@
+import re
+import threading
+from collections import deque
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+
+from shortenurls.const import SHORT_URL_ALPHABET, SHORT_URL_LENGTH, SHORT_URL_MAX_LENGTH, SHORT_URL_RESERVED, \
+    SHORT_URL_BLOCK_SIZE, SHORT_URL_CREATE_ATTEMPTS
+from shortenurls.models import ShortUrlSequence, Url
+
+# Short urls issued before the generator existed were the first 5 characters of a uuid4, generated codes of that
+# shape are skipped so they can never collide with those.
+LEGACY_SHORT_URL = re.compile(r"^[0-9a-f]{5}$")
+
+# Sequence numbers are multiplied by this constant (coprime with the alphabet size, so the mapping stays a bijection)
+# to keep consecutive short urls from looking consecutive.
+SCRAMBLE_MULTIPLIER = 1580030173
+
+# Largest value of ShortUrlSequence.next_value, a signed 64 bit column
+MAX_SEQUENCE_VALUE = 2 ** 63 - 1
+
+
+def encode(number, length):
+    """ Maps a sequence number in range [0, len(alphabet) ** length) to a distinct short url of the given length"""
+    base = len(SHORT_URL_ALPHABET)
+    number = (number * SCRAMBLE_MULTIPLIER) % (base ** length)
+    chars = []
+    for _ in range(length):
+        number, remainder = divmod(number, base)
+        chars.append(SHORT_URL_ALPHABET[remainder])
+    return "".join(reversed(chars))
+
+
+def is_usable(short_url):
+    return short_url not in SHORT_URL_RESERVED and LEGACY_SHORT_URL.match(short_url) is None
+
+
+class ShortUrlGenerator(object):
+    """ Issues short urls that never collide. Every length has its own database sequence (ShortUrlSequence) from
+    which each process reserves blocks of numbers, so there are two queries per block (reservation and a check for
+    imported short urls) instead of an existence check per short url. Once every short url of the current length is
+    issued, generator moves to the next length.
+
+    Blocks are reserved in their own transaction. Generator must not be used inside a transaction that can be rolled
+    back, another process could then be handed the same block.
+
+    Short urls imported after a block was reserved can still collide with codes of the block, urls are therefore
+    created through `create`, which retries with fresh short urls on a unique violation.
+    """
+
+    def __init__(self, length=SHORT_URL_LENGTH, block_size=SHORT_URL_BLOCK_SIZE):
+        self.length = length
+        self.block_size = block_size
+        self._codes = deque()
+        self._lock = threading.Lock()
+
+    def _reserve(self):
+        while True:
+            capacity = len(SHORT_URL_ALPHABET) ** self.length
+            if self.length > SHORT_URL_MAX_LENGTH or capacity > MAX_SEQUENCE_VALUE:
+                raise ValueError("All short urls up to {} characters are taken".format(self.length - 1))
+            block = ShortUrlSequence.allocate(self.length, self.block_size, capacity)
+            if block is not None:
+                break
+            self.length += 1
+        start, end = block
+        codes = [encode(start + offset, self.length) for offset in range(end - start)]
+        codes = [code for code in codes if is_usable(code)]
+        # Imported short urls are not issued by the generator, one query per block keeps them from being reissued
+        taken = set(Url.objects.filter(shorten_url__in=codes).values_list("shorten_url", flat=True))
+        self._codes.extend(code for code in codes if code not in taken)
+
+    def next(self):
+        """ Returns a new, never issued short url"""
+        with self._lock:
+            while not self._codes:
+                self._reserve()
+            return self._codes.popleft()
+
+    def take(self, count):
+        """ Returns a list of `count` new short urls"""
+        return [self.next() for _ in range(count)]
+
+    def discard(self, short_urls):
+        """ Drops short urls taken by imported urls from the codes reserved by this process"""
+        short_urls = set(short_urls)
+        with self._lock:
+            if any(code in short_urls for code in self._codes):
+                self._codes = deque(code for code in self._codes if code not in short_urls)
+
+    def create(self, create, count, attempts=SHORT_URL_CREATE_ATTEMPTS):
+        """ Calls create with a list of `count` new short urls and returns its result. When the insert fails because
+        one of the short urls got imported since its block was reserved, it is repeated with fresh short urls.
+        """
+        for attempt in range(attempts):
+            short_urls = self.take(count)
+            try:
+                with transaction.atomic():
+                    return create(short_urls)
+            except IntegrityError:
+                if attempt == attempts - 1:
+                    raise
+
+
+short_url_generator = ShortUrlGenerator(getattr(settings, "SHORT_URL_LENGTH", SHORT_URL_LENGTH),
+                                        getattr(settings, "SHORT_URL_BLOCK_SIZE", SHORT_URL_BLOCK_SIZE))
@@ -0,0 +1,37 @@
+import re
+
+from django.middleware.gzip import GZipMiddleware
+from django.utils.cache import patch_vary_headers
+from django.utils.decorators import decorator_from_middleware
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+re_accepts_brotli = re.compile(r'\bbr\b')
+
+
+class CompressionMiddleware(GZipMiddleware):
+    """ Compresses responses with brotli when the client accepts it and the brotli package is installed, with gzip
+    otherwise. Streaming responses are always gzipped.
+    """
+
+    def process_response(self, request, response):
+        if brotli is None or response.streaming or response.has_header('Content-Encoding') or \
+                len(response.content) < 200 or not re_accepts_brotli.search(request.META.get('HTTP_ACCEPT_ENCODING', '')):
+            return super(CompressionMiddleware, self).process_response(request, response)
+        patch_vary_headers(response, ('Accept-Encoding',))
+        compressed_content = brotli.compress(response.content)
+        if len(compressed_content) >= len(response.content):
+            return response
+        response.content = compressed_content
+        response['Content-Length'] = str(len(response.content))
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response['ETag'] = 'W/' + etag
+        response['Content-Encoding'] = 'br'
+        return response
+
+
+compress_page = decorator_from_middleware(CompressionMiddleware)
@@ -1,5 +1,82 @@
 SHORT_URL_LENGTH = 5
+SHORT_URL_MIN_LENGTH = 5
+# Sequence numbers of generated short urls are kept in a signed 64 bit column and 62 ** 10 < 2 ** 63 < 62 ** 11,
+# so short urls are at most 10 characters long
+SHORT_URL_MAX_LENGTH = 10
+SHORT_URL_PATTERN = r"\w{%d,%d}" % (SHORT_URL_MIN_LENGTH, SHORT_URL_MAX_LENGTH)
+SHORT_URL_ALPHABET = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+SHORT_URL_RESERVED = ("create", "all", "visitors", "report")
+SHORT_URL_FAST_PATH = False
+SHORT_URL_BLOCK_SIZE = 100
+# Inserts of generated short urls are retried this many times when a short url turns out to be imported meanwhile
+SHORT_URL_CREATE_ATTEMPTS = 3
 SHORT_URL_MEMCACHE_KEY = "short_url:{}"
 ORIGINAL_URL_MEMCACHE_KEY = "original-url:{}"
 DATE_FORMAT = "%d/%m/%Y"
 DATETIME_FORMAT = "%d.%m.%Y %H:%M"
+VISIT_WRITE_BEHIND = False
+VISIT_BUFFER_SIZE = 500
+VISIT_BUFFER_INTERVAL = 5
+SHORT_URL_L1_CACHE_SIZE = 10000
+SHORT_URL_L1_CACHE_TTL = 60
+USER_AGENT_CACHE_SIZE = 10000
+USER_AGENT_CACHE_TTL = 3600
+SHORT_URL_MISSING_MEMCACHE_KEY = "short_url_missing:{}"
+SHORT_URL_NEGATIVE_CACHE_TTL = 60
+SHORT_URL_BLOOM_GENERATION_KEY = "short_url_bloom_generation"
+SHORT_URL_BLOOM_FILTER = False
+SHORT_URL_BLOOM_CAPACITY = 1000000
+SHORT_URL_BLOOM_ERROR_RATE = 0.01
+VISIT_ASYNC = False
+VISIT_QUEUE_SIZE = 10000
+REACHABLE_URL_MEMCACHE_KEY = "reachable-url:{}"
+UNREACHABLE_HOST_MEMCACHE_KEY = "unreachable-host:{}"
+# "sync" or "deferred"
+URL_VERIFICATION = "sync"
+URL_CHECK_TIMEOUT = (3.05, 5)
+URL_CHECK_CACHE_TTL = 3600
+URL_CHECK_FAILURE_TTL = 300
+URL_CHECK_POOL_SIZE = 10
+BULK_SHORTEN_LIMIT = 1000
+URL_PAGE_SIZE = 100
+URL_MAX_PAGE_SIZE = 1000
+# Allowed sort keys of url listing, each one backed by an index and ending with id so the order is total
+URL_SORT_KEYS = {
+    "created": ("created", "id"),
+    "-created": ("-created", "-id"),
+    "id": ("id",),
+    "-id": ("-id",),
+}
+URL_DEFAULT_SORT_KEY = "created"
+STREAM_BATCH_SIZE = 100
+VISIT_HISTORY_BUCKETS = ("day", "week", "month")
+VISIT_HISTORY_MAX_BUCKETS = 1000
+# Most recent visitor rows searched by network on databases without an inet type, PostgreSQL searches them all
+NETWORK_SCAN_MAX_ROWS = 10000
+# 4096 one byte registers per sketch, about 1.6% standard error
+HLL_PRECISION = 12
+KEEP_VISITOR_ROWS = True
+# Days visitor rows are kept for, None keeps them forever
+VISITOR_RETENTION_DAYS = None
+HOT_URLS_CAPACITY = 1000
+HOT_URLS_FLUSH_INTERVAL = 10
+HOT_URLS_MEMCACHE_KEY = "hot_urls:{}:{}"
+HOT_URLS_LOCK_KEY = "hot_urls_lock"
+# Window: (slot length in seconds, number of slots)
+HOT_URLS_WINDOWS = {"hour": (300, 12), "day": (3600, 24)}
+HOT_URLS_MAX_RESULTS = 100
+SHORT_URL_L1_ADMIT_HITS = 2
+DATA_VERSION_MEMCACHE_KEY = "data_version"
+URL_VERSION_MEMCACHE_KEY = "url_version:{}"
+RESPONSE_CACHE_KEY = "response:{}"
+# Visits don't change the data version, visit counts of the url listing are revalidated this often (seconds)
+URLS_LIST_MAX_AGE = 60
+RESPONSE_CACHE_TTL = 5
+# Seconds a request waits, once, for an identical one to finish computing the response before computing it as well
+RESPONSE_CACHE_WAIT = 0.1
+REPORT_CHUNK_SIZE = 100000
+REPORT_TOP_URLS = 10
+REPORT_MAX_TOP_URLS = 100
+# Longest report period in days, the previous period of the same length is loaded as well
+REPORT_MAX_DAYS = 1000
+REPORT_PERCENTILES = (50, 90, 95, 99)
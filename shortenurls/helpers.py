@@ -1,12 +1,165 @@
+import datetime
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
 from django.core.cache import cache
 
+from shortenurls.const import SHORT_URL_L1_CACHE_SIZE, SHORT_URL_L1_CACHE_TTL, DATA_VERSION_MEMCACHE_KEY, \
+    URL_VERSION_MEMCACHE_KEY, USER_AGENT_CACHE_SIZE, USER_AGENT_CACHE_TTL
+
 
 def get_memcached_value(key):
     """ Checking memcache for a specific key. Returns a cached object if any or None"""
     return cache.get(key)
 
 
+def get_memcached_values(*keys):
+    """ Checking memcache for several keys in a single round trip. Returns a dict of found keys and their values"""
+    return cache.get_many(keys)
+
+
 def add_to_memcache(key, val):
     """ Adding new value to memcache. Returns True if successfully added, False otherwise"""
     success = cache.add(key, val)
     return success
+
+
+def set_memcache(key, val, timeout=None):
+    """ Storing value to memcache, overwriting existing one. Timeout defaults to cache's default timeout"""
+    if timeout is None:
+        cache.set(key, val)
+    else:
+        cache.set(key, val, timeout)
+
+
+def set_many_memcache(values, timeout=None):
+    """ Storing several key/value pairs to memcache in a single round trip"""
+    if timeout is None:
+        cache.set_many(values)
+    else:
+        cache.set_many(values, timeout)
+
+
+def delete_from_memcache(*keys):
+    if len(keys) == 1:
+        cache.delete(keys[0])
+    else:
+        cache.delete_many(keys)
+
+
+def get_data_version():
+    """ Returns version of url data, changing whenever urls are created or changed"""
+    version = cache.get(DATA_VERSION_MEMCACHE_KEY)
+    if version is None:
+        # Counter got evicted, restart it from current time so versions issued before aren't reused
+        cache.add(DATA_VERSION_MEMCACHE_KEY, int(time.time() * 1000), None)
+        version = cache.get(DATA_VERSION_MEMCACHE_KEY)
+    return version
+
+
+def get_url_version(url_id):
+    """ Returns version of a url's visit data, changing whenever its visit records are rewritten by maintenance.
+    Recorded visits don't change it, they change the url's counters instead.
+    """
+    key = URL_VERSION_MEMCACHE_KEY.format(url_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, None)
+        version = cache.get(key)
+    return version
+
+
+def bump_data_version():
+    """ Changes data version, whenever urls are created or changed. Visits don't change it."""
+    try:
+        cache.incr(DATA_VERSION_MEMCACHE_KEY)
+    except ValueError:
+        cache.add(DATA_VERSION_MEMCACHE_KEY, int(time.time() * 1000), None)
+
+
+def bump_url_versions(*url_ids):
+    """ Changes versions of visit data of the given urls"""
+    if url_ids:
+        cache.set_many(dict((URL_VERSION_MEMCACHE_KEY.format(url_id), uuid.uuid4().hex) for url_id in url_ids), None)
+
+
+def bucket_start(day, bucket):
+    """ First day of the day, week (starting on Monday) or month bucket the day falls into"""
+    if bucket == "week":
+        return day - datetime.timedelta(days=day.weekday())
+    if bucket == "month":
+        return day.replace(day=1)
+    return day
+
+
+def next_bucket(start, bucket):
+    """ First day of the bucket following the one starting on `start`"""
+    if bucket == "week":
+        return start + datetime.timedelta(days=7)
+    if bucket == "month":
+        return (start.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+    return start + datetime.timedelta(days=1)
+
+
+class LocalCache(object):
+    """ Bounded in-process LRU cache with per entry TTL. Meant to sit in front of memcache for the hottest keys,
+    every worker process keeps its own copy. Size of 0 disables the cache.
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """ Returns cached value for a key or None if key is missing or expired"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return None
+            # Re-inserting moves the key to the most recently used end
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, val):
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, val)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "maxSize": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+short_url_cache = LocalCache(getattr(settings, "SHORT_URL_L1_CACHE_SIZE", SHORT_URL_L1_CACHE_SIZE),
+                             getattr(settings, "SHORT_URL_L1_CACHE_TTL", SHORT_URL_L1_CACHE_TTL))
+user_agent_cache = LocalCache(getattr(settings, "USER_AGENT_CACHE_SIZE", USER_AGENT_CACHE_SIZE),
+                              getattr(settings, "USER_AGENT_CACHE_TTL", USER_AGENT_CACHE_TTL))
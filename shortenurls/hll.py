@@ -0,0 +1,140 @@
+import binascii
+import hashlib
+import math
+
+from django.db import connection, transaction
+
+from shortenurls.const import HLL_PRECISION
+
+# Registers updated by a single UPDATE statement, bounds the statement size of batched updates
+REGISTERS_PER_STATEMENT = 100
+
+
+class HyperLogLog(object):
+    """ HyperLogLog sketch estimating the number of distinct values added to it, with a standard error of
+    1.04 / sqrt(2 ** precision). Registers are one byte each so a sketch is stored as plain bytes, and sketches of
+    the same precision merge by taking the maximum of every register.
+    """
+
+    def __init__(self, registers=None, precision=HLL_PRECISION):
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(registers) if registers else bytearray(self.size)
+
+    @staticmethod
+    def position(value, precision=HLL_PRECISION):
+        """ Returns (register index, rank) of a value"""
+        hashed = int(binascii.hexlify(hashlib.md5(value.encode("utf-8")).digest()[:8]), 16)
+        bits = 64 - precision
+        rest = hashed & ((1 << bits) - 1)
+        return hashed >> bits, bits - rest.bit_length() + 1
+
+    def update(self, index, rank):
+        """ Raises the register to rank, returns whether it changed"""
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+            return True
+        return False
+
+    def add(self, value):
+        return self.update(*self.position(value, self.precision))
+
+    def merge(self, other):
+        for index, rank in enumerate(other.registers):
+            if rank > self.registers[index]:
+                self.registers[index] = rank
+
+    def count(self):
+        alpha = 0.7213 / (1 + 1.079 / self.size)
+        estimate = alpha * self.size * self.size / sum(2.0 ** -rank for rank in self.registers)
+        zeros = self.registers.count(b"\0")
+        if estimate <= 2.5 * self.size and zeros:
+            # Linear counting is more accurate for small cardinalities
+            estimate = self.size * math.log(self.size / float(zeros))
+        return int(round(estimate))
+
+    def to_bytes(self):
+        return bytes(self.registers)
+
+
+def register_updates(values, precision=HLL_PRECISION):
+    """ Returns {register index: rank} of the given values, the highest rank per register"""
+    updates = {}
+    for value in values:
+        index, rank = HyperLogLog.position(value, precision)
+        if rank > updates.get(index, 0):
+            updates[index] = rank
+    return updates
+
+
+def update_sketch(model, pk, field, values, **lookups):
+    """ Adds values to the sketch stored in `field` of the model's row. A NULL sketch counts as empty. Returns the
+    updated sketch, or None when no register changed (or the row doesn't exist), in which case nothing is written.
+    Lookups are exact column values the row is matched on besides pk, such as the partition key.
+
+    On PostgreSQL registers are raised in place by a single UPDATE, which only matches the row when one of them
+    actually grows, so concurrent visits never lose a register and warm sketches are rarely rewritten. Other
+    databases lock the row and write back the merged sketch.
+    """
+    updates = sorted(register_updates(values).items())
+    if not updates:
+        return None
+    if connection.vendor == "postgresql":
+        return _update_sketch_in_place(model, pk, field, updates, lookups)
+    with transaction.atomic():
+        rows = list(model.objects.select_for_update().filter(pk=pk, **lookups).values_list(field, flat=True))
+        if not rows:
+            return None
+        sketch = HyperLogLog(rows[0])
+        changed = [sketch.update(index, rank) for index, rank in updates]
+        if not any(changed):
+            return None
+        model.objects.filter(pk=pk, **lookups).update(**{field: sketch.to_bytes()})
+    return sketch
+
+
+def merge_sketch(model, pk, field, sketch, count_field=None, **values):
+    """ Merges the sketch into the one stored in `field` of the model's row, in a transaction locking only that row.
+    With count_field the estimate of the merged sketch is written to it, other values are written as given. Returns
+    the merged sketch, or None when the row doesn't exist.
+    """
+    with transaction.atomic():
+        rows = list(model.objects.select_for_update().filter(pk=pk).values_list(field, flat=True))
+        if not rows:
+            return None
+        merged = HyperLogLog(rows[0])
+        merged.merge(sketch)
+        values[field] = merged.to_bytes()
+        if count_field is not None:
+            values[count_field] = merged.count()
+        model.objects.filter(pk=pk).update(**values)
+    return merged
+
+
+def _update_sketch_in_place(model, pk, field, updates, lookups):
+    table = connection.ops.quote_name(model._meta.db_table)
+    column = connection.ops.quote_name(model._meta.get_field(field).column)
+    match = "".join(" AND {} = %s".format(connection.ops.quote_name(model._meta.get_field(name).column))
+                    for name in sorted(lookups))
+    params = [pk] + [model._meta.get_field(name).get_db_prep_value(lookups[name], connection)
+                     for name in sorted(lookups)]
+    empty = "decode(repeat('00', {}), 'hex')".format(1 << HLL_PRECISION)
+    current = "COALESCE({}, {})".format(column, empty)
+    registers = None
+    with connection.cursor() as cursor:
+        for offset in range(0, len(updates), REGISTERS_PER_STATEMENT):
+            chunk = updates[offset:offset + REGISTERS_PER_STATEMENT]
+            expression = current
+            conditions = ["{} IS NULL".format(column)]
+            for index, rank in chunk:
+                expression = "set_byte({}, {}, GREATEST(get_byte({}, {}), {}))".format(expression, index, current,
+                                                                                  index, rank)
+                conditions.append("get_byte({}, {}) < {}".format(column, index, rank))
+            cursor.execute("UPDATE {table} SET {column} = {expression} WHERE {pk} = %s{match} AND ({conditions}) "
+                           "RETURNING {column}".format(table=table, column=column, expression=expression,
+                                                       pk=connection.ops.quote_name(model._meta.pk.column),
+                                                       match=match, conditions=" OR ".join(conditions)), params)
+            row = cursor.fetchone()
+            if row is not None:
+                registers = row[0]
+    return HyperLogLog(registers) if registers is not None else None
@@ -0,0 +1,163 @@
+import heapq
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from shortenurls.const import HOT_URLS_CAPACITY, HOT_URLS_FLUSH_INTERVAL, HOT_URLS_MEMCACHE_KEY, HOT_URLS_LOCK_KEY, \
+    HOT_URLS_WINDOWS, SHORT_URL_L1_ADMIT_HITS
+
+
+class SpaceSaving(object):
+    """ Space-Saving heavy hitters summary keeping at most `capacity` counters. Every key counted more than
+    total / capacity times is guaranteed to be kept, its count is overestimated by at most its error.
+
+    The least counted key is found with a min-heap of (count, key) holding one entry per key. Increments don't touch
+    the heap, so an entry's count can be lower than the key's, such stale entries are refreshed when they reach the
+    top. Counts never decrease, so an up to date entry on top is the least counted key and evictions take O(log n).
+    """
+
+    def __init__(self, capacity, counters=None):
+        self.capacity = capacity
+        # key: [count, error]
+        self.counters = dict(counters) if counters else {}
+        # Built on first eviction
+        self._heap = None
+
+    def offer(self, key, count=1):
+        counter = self.counters.get(key)
+        if counter is not None:
+            counter[0] += count
+        elif len(self.counters) < self.capacity:
+            self.counters[key] = [count, 0]
+            if self._heap is not None:
+                heapq.heappush(self._heap, (count, key))
+        else:
+            # New key replaces the least counted one and inherits its count as error
+            evicted, minimum = self._least_counted()
+            del self.counters[evicted]
+            self.counters[key] = [minimum + count, minimum]
+            heapq.heapreplace(self._heap, (minimum + count, key))
+
+    def _least_counted(self):
+        """ Returns (key, count) of the least counted key, its entry is left on top of the heap"""
+        if self._heap is None:
+            self._heap = [(counter[0], key) for key, counter in self.counters.items()]
+            heapq.heapify(self._heap)
+        while True:
+            stored, key = self._heap[0]
+            count = self.counters[key][0]
+            if stored == count:
+                return key, count
+            heapq.heapreplace(self._heap, (count, key))
+
+    def count(self, key):
+        counter = self.counters.get(key)
+        return counter[0] if counter is not None else 0
+
+    def merge(self, other):
+        """ Adds counters of another summary, keeping the `capacity` highest ones"""
+        for key, (count, error) in other.counters.items():
+            counter = self.counters.setdefault(key, [0, 0])
+            counter[0] += count
+            counter[1] += error
+        if len(self.counters) > self.capacity:
+            self.counters = dict(self.top(self.capacity))
+        self._heap = None
+
+    def top(self, n):
+        """ Returns [(key, [count, error])] of the n highest counts"""
+        return sorted(self.counters.items(), key=lambda item: item[1][0], reverse=True)[:n]
+
+    def __len__(self):
+        return len(self.counters)
+
+
+class HotUrls(object):
+    """ Tracks most visited short urls. Every process counts redirects into a local Space-Saving summary, which is
+    merged into per slot summaries in the cache every flush interval, and whenever a slot ends. There are two
+    granularities of slots (see HOT_URLS_WINDOWS), so top short urls of the last hour or day are read from a fixed
+    number of cache keys regardless of traffic.
+    """
+
+    def __init__(self, capacity=HOT_URLS_CAPACITY, flush_interval=HOT_URLS_FLUSH_INTERVAL):
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self._local = SpaceSaving(capacity)
+        self._slot_started = self._slot_start()
+        self._flushed = time.time()
+        self._hot = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _slot_start(now=None):
+        length = HOT_URLS_WINDOWS["hour"][0]
+        now = time.time() if now is None else now
+        return int(now // length * length)
+
+    @staticmethod
+    def _key(window, start):
+        length = HOT_URLS_WINDOWS[window][0]
+        return HOT_URLS_MEMCACHE_KEY.format(window, int(start // length))
+
+    def offer(self, short_url):
+        now = time.time()
+        with self._lock:
+            if self._slot_start(now) != self._slot_started or now - self._flushed >= self.flush_interval:
+                self._flush()
+            self._local.offer(short_url)
+
+    def is_hot(self, short_url):
+        """ Whether the short url is hot enough to be kept in the local cache. Always True when admission is
+        disabled.
+        """
+        admit_hits = getattr(settings, "SHORT_URL_L1_ADMIT_HITS", SHORT_URL_L1_ADMIT_HITS)
+        return admit_hits <= 1 or short_url in self._hot or self._local.count(short_url) >= admit_hits
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def clear(self):
+        """ Forgets local counts, cached summaries are left as they are"""
+        with self._lock:
+            self._local = SpaceSaving(self.capacity)
+            self._hot = set()
+
+    def _flush(self):
+        now = time.time()
+        if len(self._local) and cache.add(HOT_URLS_LOCK_KEY, True, 5):
+            try:
+                merged = None
+                for window, (length, slots) in HOT_URLS_WINDOWS.items():
+                    key = self._key(window, self._slot_started)
+                    summary = SpaceSaving(self.capacity, cache.get(key))
+                    summary.merge(self._local)
+                    cache.set(key, summary.counters, length * (slots + 1))
+                    if window == "hour":
+                        merged = summary
+            finally:
+                cache.delete(HOT_URLS_LOCK_KEY)
+            admit_hits = getattr(settings, "SHORT_URL_L1_ADMIT_HITS", SHORT_URL_L1_ADMIT_HITS)
+            self._hot = set(key for key, (count, error) in merged.counters.items() if count >= admit_hits)
+            self._local = SpaceSaving(self.capacity)
+        elif self._slot_start(now) != self._slot_started:
+            # Counts of a slot that couldn't be merged are dropped rather than attributed to the next one
+            self._local = SpaceSaving(self.capacity)
+        self._slot_started = self._slot_start(now)
+        self._flushed = now
+
+    def top(self, window, n):
+        """ Returns [(short url, [count, error])] of the n most visited short urls of the last hour or day"""
+        length, slots = HOT_URLS_WINDOWS[window]
+        now = time.time()
+        keys = [self._key(window, now - slot * length) for slot in range(slots)]
+        summary = SpaceSaving(self.capacity)
+        for counters in cache.get_many(keys).values():
+            summary.merge(SpaceSaving(self.capacity, counters))
+        return summary.top(n)
+
+
+hot_urls = HotUrls(getattr(settings, "HOT_URLS_CAPACITY", HOT_URLS_CAPACITY),
+                   getattr(settings, "HOT_URLS_FLUSH_INTERVAL", HOT_URLS_FLUSH_INTERVAL))
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import datetime
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from shortenurls.models import UrlVisitors, UrlVisits
+
+
+class Command(BaseCommand):
+    help = "Folds visitor rows older than the retention period into their daily visit records and deletes them in " \
+           "small chunks, each in its own transaction, pausing between chunks. Optionally folds old daily visit " \
+           "records into monthly ones."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=None,
+                            help="Days visitor rows are kept for, defaults to the VISITOR_RETENTION_DAYS setting. "
+                                 "The setting has to be configured, unique visitors are only counted from sketches "
+                                 "then.")
+        parser.add_argument("--fold-months-after", type=int, default=None,
+                            help="Fold daily visit records of whole months older than this many days into monthly "
+                                 "records")
+        parser.add_argument("--chunk-size", type=int, default=1000, help="Number of rows deleted per transaction")
+        parser.add_argument("--batch-size", type=int, default=100,
+                            help="Number of visit records or months folded per batch")
+        parser.add_argument("--sleep", type=float, default=0.1, help="Seconds to pause between chunks")
+
+    def handle(self, *args, **options):
+        if not UrlVisitors.retention_days():
+            # Without it unique visitors are counted from visitor rows, which wouldn't cover deleted days
+            raise CommandError("No retention period, set VISITOR_RETENTION_DAYS")
+        days = options["days"] if options["days"] is not None else UrlVisitors.retention_days()
+        if days <= 0:
+            raise CommandError("--days has to be positive")
+        if options["fold_months_after"] is not None and options["fold_months_after"] < days:
+            raise CommandError("Months can't be folded before their visitor rows are compacted")
+        today = datetime.date.today()
+        folded_days, deleted = self.compact_visitors(today - datetime.timedelta(days=days), options)
+        self.stdout.write(self.style.SUCCESS("Deleted {} visitor rows of {} days".format(deleted, folded_days)))
+        if options["fold_months_after"] is not None:
+            folded_months = self.fold_months(today - datetime.timedelta(days=options["fold_months_after"]), options)
+            self.stdout.write(self.style.SUCCESS("Folded {} months of daily visits".format(folded_months)))
+
+    def compact_visitors(self, before, options):
+        folded_days, deleted, after_id = 0, 0, 0
+        while True:
+            visit_ids = UrlVisitors.compactable_days(before, after_id, options["batch_size"])
+            if not visit_ids:
+                return folded_days, deleted
+            UrlVisitors.fold_days(visit_ids)
+            while True:
+                chunk = UrlVisitors.delete_rows(visit_ids, options["chunk_size"])
+                if not chunk:
+                    break
+                deleted += chunk
+                time.sleep(options["sleep"])
+            folded_days += len(visit_ids)
+            after_id = visit_ids[-1]
+
+    def fold_months(self, before, options):
+        folded = 0
+        skipped = set()
+        while True:
+            months = [month for month in UrlVisits.foldable_months(before, options["batch_size"] + len(skipped))
+                      if month not in skipped]
+            if not months:
+                return folded
+            for url_id, month in months:
+                if UrlVisits.fold_month(url_id, month):
+                    folded += 1
+                else:
+                    skipped.add((url_id, month))
+            time.sleep(options["sleep"])
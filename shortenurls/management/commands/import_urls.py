@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import csv
+import datetime
+import io
+import json
+import re
+from itertools import islice
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand
+from django.core.validators import URLValidator
+from django.db import transaction
+from django.db.models import Case, DateTimeField, Value, When
+from django.utils import six, timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from shortenurls.bloom import short_url_filter
+from shortenurls.codes import short_url_generator
+from shortenurls.const import SHORT_URL_PATTERN, SHORT_URL_RESERVED, SHORT_URL_MEMCACHE_KEY, \
+    SHORT_URL_MISSING_MEMCACHE_KEY
+from shortenurls.helpers import set_many_memcache, delete_from_memcache, bump_data_version
+from shortenurls.models import Url
+
+SHORT_URL = re.compile(r"^%s$" % SHORT_URL_PATTERN)
+
+# Rows per UPDATE of imported created dates, two parameters each keep it within SQLite's parameter limit
+CREATED_BATCH_SIZE = 300
+
+
+def restore_created(url_objs, created_dates):
+    """ Url.created is auto_now_add, so bulk_create sets it to the import time. Imported created dates (None for
+    rows without one) are written back afterwards, with one UPDATE per batch of urls.
+    """
+    rows = [(url_obj, created) for url_obj, created in zip(url_objs, created_dates) if created is not None]
+    for offset in range(0, len(rows), CREATED_BATCH_SIZE):
+        batch = rows[offset:offset + CREATED_BATCH_SIZE]
+        Url.objects.filter(shorten_url__in=[url_obj.shorten_url for url_obj, created in batch]).update(
+            created=Case(*[When(shorten_url=url_obj.shorten_url, then=Value(created)) for url_obj, created in batch],
+                         output_field=DateTimeField()))
+        for url_obj, created in batch:
+            url_obj.created = created
+
+
+def read_csv(path):
+    if six.PY2:
+        with open(path, "rb") as csv_file:
+            for row in csv.reader(csv_file):
+                yield [cell.decode("utf-8") for cell in row]
+    else:
+        with io.open(path, encoding="utf-8", newline="") as csv_file:
+            for row in csv.reader(csv_file):
+                yield row
+
+
+def read_ndjson(path):
+    with io.open(path, encoding="utf-8") as ndjson_file:
+        for line in ndjson_file:
+            if line.strip():
+                row = json.loads(line)
+                yield [row.get("original_url"), row.get("short_url"), row.get("created")]
+
+
+def parse_created(value):
+    if not value:
+        return None
+    created = parse_datetime(value)
+    if created is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValueError("Invalid created date {}".format(value))
+        created = datetime.datetime(day.year, day.month, day.day)
+    if settings.USE_TZ and timezone.is_naive(created):
+        created = timezone.make_aware(created, timezone.utc)
+    return created
+
+
+class Command(BaseCommand):
+    help = "Imports urls from a CSV or NDJSON file of (original_url, short_url, created) rows. Short url and created " \
+           "are optional. File is streamed and imported in chunks, every chunk in its own transaction."
+
+    def add_arguments(self, parser):
+        parser.add_argument("path")
+        parser.add_argument("--format", choices=["csv", "ndjson"],
+                            help="Input format, guessed from the file extension by default")
+        parser.add_argument("--chunk-size", type=int, default=5000)
+
+    def handle(self, *args, **options):
+        file_format = options["format"] or ("ndjson" if options["path"].endswith((".ndjson", ".jsonl")) else "csv")
+        rows = read_ndjson(options["path"]) if file_format == "ndjson" else read_csv(options["path"])
+        totals = {"imported": 0, "existing": 0, "invalid": 0, "conflicts": 0}
+        line = 0
+        while True:
+            chunk = list(islice(rows, options["chunk_size"]))
+            if not chunk:
+                break
+            if line == 0 and chunk[0] and chunk[0][0] == "original_url":
+                # Header row
+                chunk = chunk[1:]
+                line = 1
+            counts = self.import_chunk(chunk, line)
+            line += len(chunk)
+            for key in totals:
+                totals[key] += counts[key]
+            self.stdout.write("{} rows processed, {} imported".format(line, totals["imported"]))
+        self.stdout.write(self.style.SUCCESS(
+            "Imported {imported} urls, {existing} already existing, {invalid} invalid rows, "
+            "{conflicts} short urls taken by other urls".format(**totals)))
+
+    def import_chunk(self, chunk, first_line):
+        counts = {"imported": 0, "existing": 0, "invalid": 0, "conflicts": 0}
+        validate = URLValidator()
+        rows = []
+        for line, row in enumerate(chunk, first_line + 1):
+            row = list(row) + [None] * (3 - len(row))
+            try:
+                original_url = Url.normalize_url((row[0] or "").strip())
+                validate(original_url)
+                short_url = (row[1] or "").strip() or None
+                if short_url is not None and (SHORT_URL.match(short_url) is None or short_url in SHORT_URL_RESERVED):
+                    raise ValueError("Invalid short url {}".format(short_url))
+                rows.append((original_url, short_url, parse_created(row[2])))
+            except (ValidationError, ValueError) as error:
+                counts["invalid"] += 1
+                self.stderr.write("Line {}: {}".format(line, error))
+        # Rows with a short url keep it, for rows without one an existing url is reused or a short url generated
+        existing_urls = Url.fetch_by_original_urls(original_url for original_url, short_url, created in rows
+                                                   if short_url is None)
+        taken = dict(Url.objects.filter(shorten_url__in=[row[1] for row in rows if row[1] is not None])
+                     .values_list("shorten_url", "original_url"))
+        new_rows = []
+        seen = set()
+        for original_url, short_url, created in rows:
+            key = short_url or original_url
+            if key in seen or (short_url is None and original_url in existing_urls):
+                counts["existing"] += 1
+            elif short_url in taken:
+                counts["existing" if taken[short_url] == original_url else "conflicts"] += 1
+            else:
+                new_rows.append([original_url, short_url, created])
+            seen.add(key)
+        # Imported short urls reserved by this process are never issued, codes of blocks reserved by other processes
+        # are retried by ShortUrlGenerator.create when they collide
+        explicit = set(row[1] for row in new_rows if row[1] is not None)
+        short_url_generator.discard(explicit)
+        missing = len(new_rows) - len(explicit)
+        generated = []
+        while len(generated) < missing:
+            generated += [code for code in short_url_generator.take(missing - len(generated)) if code not in explicit]
+        generated = iter(generated)
+        url_objs = [Url(original_url=original_url, original_url_hash=Url.hash_url(original_url),
+                        shorten_url=short_url or next(generated)) for original_url, short_url, created in new_rows]
+        with transaction.atomic():
+            Url.objects.bulk_create(url_objs, batch_size=1000)
+            restore_created(url_objs, [created for original_url, short_url, created in new_rows])
+        counts["imported"] = len(url_objs)
+        self.warm_cache(url_objs)
+        return counts
+
+    @staticmethod
+    def warm_cache(url_objs):
+        short_urls = [url_obj.shorten_url for url_obj in url_objs]
+        if url_objs and url_objs[0].id is None:
+            # Only some database backends return ids of bulk inserted rows
+            url_objs = list(Url.objects.defer("visitors_sketch").filter(shorten_url__in=short_urls))
+        set_many_memcache(dict((SHORT_URL_MEMCACHE_KEY.format(url_obj.shorten_url), url_obj) for url_obj in url_objs))
+        delete_from_memcache(*[SHORT_URL_MISSING_MEMCACHE_KEY.format(short_url) for short_url in short_urls])
+        short_url_filter.add(*short_urls)
+        bump_data_version()
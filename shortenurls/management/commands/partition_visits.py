@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from shortenurls import partitions
+from shortenurls.helpers import bucket_start, next_bucket
+from shortenurls.models import UrlVisitors, UrlVisits
+
+
+class Command(BaseCommand):
+    help = "Maintains monthly partitions of visit and visitor tables on PostgreSQL 11+. Creates partitions of the " \
+           "coming months ahead of time and removes partitions past their retention period. Visitor rows are " \
+           "folded into their daily visit records before their partition is dropped. Run with --convert once to " \
+           "turn the existing tables into partitioned ones."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--convert", action="store_true", help="Convert the tables into partitioned ones first")
+        parser.add_argument("--months-ahead", type=int, default=3, help="Number of future monthly partitions to keep")
+        parser.add_argument("--visit-retention-days", type=int, default=None,
+                            help="Remove daily visit partitions older than this many days, kept forever by default. "
+                                 "Url visit totals are kept, rebuilding them afterwards only counts remaining days.")
+        parser.add_argument("--detach-only", action="store_true",
+                            help="Detach expired partitions instead of dropping them")
+        parser.add_argument("--batch-size", type=int, default=100,
+                            help="Number of visit records folded per transaction")
+
+    def handle(self, *args, **options):
+        if connection.vendor != "postgresql" or connection.pg_version < partitions.MIN_SERVER_VERSION:
+            raise CommandError("Partitioning requires PostgreSQL 11 or newer")
+        visitor_days = UrlVisitors.retention_days()
+        visit_days = options["visit_retention_days"]
+        if visit_days is not None and (not visitor_days or visit_days < visitor_days):
+            raise CommandError("Visit partitions can't be removed before visitor partitions of the same days")
+        if options["convert"]:
+            boundary = partitions.convert_tables()
+            self.stdout.write("Converted tables, existing rows up to {} are kept in legacy partitions".format(boundary))
+        tables = [model._meta.db_table for model, unique, foreign_keys in partitions.partitioned_tables()]
+        for table in tables:
+            if not partitions.is_partitioned(table):
+                raise CommandError("{} is not partitioned, run with --convert first".format(table))
+        today = datetime.date.today()
+        until = bucket_start(today, "month")
+        for _ in range(options["months_ahead"]):
+            until = next_bucket(until, "month")
+        for table in tables:
+            for name in partitions.create_partitions(table, until):
+                self.stdout.write("Created partition {}".format(name))
+        if visitor_days:
+            before = today - datetime.timedelta(days=visitor_days)
+            self.remove_partitions(UrlVisitors._meta.db_table, before, options, fold=True)
+        if visit_days is not None:
+            self.remove_partitions(UrlVisits._meta.db_table, today - datetime.timedelta(days=visit_days), options)
+        self.stdout.write(self.style.SUCCESS("Partitions are up to date"))
+
+    def remove_partitions(self, table, before, options, fold=False):
+        for name, lower, upper in partitions.partitions(table):
+            if upper > before:
+                continue
+            if fold:
+                self.fold_visitors(upper, options["batch_size"])
+            partitions.remove_partition(table, name, drop=not options["detach_only"])
+            self.stdout.write("{} partition {}".format("Detached" if options["detach_only"] else "Dropped", name))
+
+    @staticmethod
+    def fold_visitors(before, batch_size):
+        after_id = 0
+        while True:
+            visit_ids = UrlVisitors.compactable_days(before, after_id, batch_size)
+            if not visit_ids:
+                return
+            UrlVisitors.fold_days(visit_ids)
+            after_id = visit_ids[-1]
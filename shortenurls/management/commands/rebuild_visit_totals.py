@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+from django.db.models import Max, Min
+
+from shortenurls.models import Url
+
+
+class Command(BaseCommand):
+    help = "Rebuilds denormalized visit totals of urls and daily unique visitors from raw visit and visitor rows. " \
+           "Urls are processed in id ranges, every range in its own transaction."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=1000, help="Number of url ids per transaction")
+
+    def handle(self, *args, **options):
+        bounds = Url.objects.aggregate(first=Min("id"), last=Max("id"))
+        if bounds["first"] is None:
+            self.stdout.write("No urls to rebuild")
+            return
+        rebuilt = 0
+        for first_id in range(bounds["first"], bounds["last"] + 1, options["chunk_size"]):
+            rebuilt += Url.rebuild_visit_totals(first_id, first_id + options["chunk_size"] - 1)
+        self.stdout.write(self.style.SUCCESS("Rebuilt visit totals of {} urls".format(rebuilt)))
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import datetime
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from shortenurls.const import DATE_FORMAT, REPORT_TOP_URLS
+from shortenurls.exceptions import URLException
+from shortenurls.reports import default_range, visits_report
+
+
+class Command(BaseCommand):
+    help = "Prints the visits report of a date range as JSON, the last seven full days by default. Requires numpy."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--from-date", help="First day of the report, dd/mm/yyyy")
+        parser.add_argument("--to-date", help="Last day of the report, dd/mm/yyyy")
+        parser.add_argument("--top", type=int, default=REPORT_TOP_URLS, help="Number of most visited urls to list")
+
+    def handle(self, *args, **options):
+        from_date, to_date = default_range()
+        try:
+            if options["from_date"]:
+                from_date = datetime.datetime.strptime(options["from_date"], DATE_FORMAT).date()
+            if options["to_date"]:
+                to_date = datetime.datetime.strptime(options["to_date"], DATE_FORMAT).date()
+            report = visits_report(from_date, to_date, options["top"])
+        except (ValueError, OverflowError, URLException) as error:
+            raise CommandError(error)
+        self.stdout.write(json.dumps(report, indent=2))
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.11 on 2026-10-18 07:27
+from __future__ import unicode_literals
+
+import datetime
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def merge_duplicate_visits(apps, schema_editor):
+    """ Folds duplicated same-day visit records and duplicated visitors into a single row so unique constraints
+    can be created.
+    """
+    UrlVisits = apps.get_model('shortenurls', 'UrlVisits')
+    UrlVisitors = apps.get_model('shortenurls', 'UrlVisitors')
+    duplicates = UrlVisits.objects.values('url_id', 'date').annotate(rows=Count('id')).filter(rows__gt=1)
+    for duplicate in duplicates:
+        rows = list(UrlVisits.objects.filter(url_id=duplicate['url_id'], date=duplicate['date']).order_by('id'))
+        kept = rows[0]
+        for row in rows[1:]:
+            kept.visits += row.visits
+            if row.last_visit_at is not None and (kept.last_visit_at is None or row.last_visit_at > kept.last_visit_at):
+                kept.last_visit_at = row.last_visit_at
+                kept.last_visit_from = row.last_visit_from
+            UrlVisitors.objects.filter(url_visit_id=row.id).update(url_visit_id=kept.id)
+            row.delete()
+        kept.save()
+    duplicates = UrlVisitors.objects.values('url_visit_id', 'remote_address').annotate(rows=Count('id')).filter(rows__gt=1)
+    for duplicate in duplicates:
+        rows = list(UrlVisitors.objects.filter(url_visit_id=duplicate['url_visit_id'],
+                                               remote_address=duplicate['remote_address']).order_by('id'))
+        kept = rows[0]
+        for row in rows[1:]:
+            kept.visits += row.visits
+            if row.last_visit is not None and (kept.last_visit is None or row.last_visit > kept.last_visit):
+                kept.last_visit = row.last_visit
+            row.delete()
+        kept.save()
+
+
+class Migration(migrations.Migration):
+    # Merging repoints deferred foreign keys of visitors, their pending trigger events have to be committed before
+    # PostgreSQL allows altering the tables, so only the merge runs in a transaction.
+    atomic = False
+
+    dependencies = [
+        ('shortenurls', '0012_auto_20180404_2125'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='urlvisits',
+            name='date',
+            field=models.DateField(default=datetime.date.today),
+        ),
+        migrations.RunPython(merge_duplicate_visits, migrations.RunPython.noop, atomic=True),
+        migrations.AlterUniqueTogether(
+            name='urlvisitors',
+            unique_together=set([('url_visit', 'remote_address')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='urlvisits',
+            unique_together=set([('url', 'date')]),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.11 on 2026-10-18 07:31
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shortenurls', '0013_visit_unique_together'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='url',
+            name='verified',
+            field=models.NullBooleanField(default=True),
+        ),
+    ]
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.11 on 2026-10-18 07:40
+from __future__ import unicode_literals
+
+import hashlib
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def hash_original_urls(apps, schema_editor):
+    Url = apps.get_model('shortenurls', 'Url')
+    rows = Url.objects.filter(original_url_hash='').values_list('id', 'original_url')
+    for url_id, original_url in rows.iterator():
+        Url.objects.filter(id=url_id).update(original_url_hash=hashlib.sha1(original_url.encode('utf-8')).hexdigest())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shortenurls', '0015_short_url_sequence'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='url',
+            name='original_url_hash',
+            field=models.CharField(default='', editable=False, max_length=40),
+            preserve_default=False,
+        ),
+        migrations.RunPython(hash_original_urls, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='url',
+            name='original_url_hash',
+            field=models.CharField(db_index=True, editable=False, max_length=40),
+        ),
+        migrations.AlterField(
+            model_name='url',
+            name='created',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='url',
+            name='shorten_url',
+            field=models.CharField(max_length=255, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='urlvisitors',
+            name='url_visit',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='shortenurls.UrlVisits'),
+        ),
+        migrations.AlterField(
+            model_name='urlvisits',
+            name='url',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='shortenurls.Url'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.11 on 2026-10-18 09:15
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shortenurls', '0016_url_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='url',
+            name='created',
+            field=models.DateTimeField(auto_now_add=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='url',
+            index_together=set([('created', 'id')]),
+        ),
+    ]
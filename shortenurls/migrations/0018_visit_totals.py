@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.11 on 2026-10-18 10:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def rebuild_visit_totals(apps, schema_editor):
+    Url = apps.get_model('shortenurls', 'Url')
+    UrlVisits = apps.get_model('shortenurls', 'UrlVisits')
+    UrlVisitors = apps.get_model('shortenurls', 'UrlVisitors')
+    day_visitors = UrlVisitors.objects.filter(url_visit=OuterRef('pk')).order_by().values('url_visit') \
+        .annotate(count=Count('id')).values('count')
+    total_visits = UrlVisits.objects.filter(url=OuterRef('pk')).order_by().values('url') \
+        .annotate(total=Sum('visits')).values('total')
+    unique_visitors = UrlVisitors.objects.filter(url_visit__url=OuterRef('pk')).order_by().values('url_visit__url') \
+        .annotate(count=Count('remote_address', distinct=True)).values('count')
+    UrlVisits.objects.update(unique_visitors=Coalesce(Subquery(day_visitors, output_field=IntegerField()), 0))
+    Url.objects.update(total_visits=Coalesce(Subquery(total_visits, output_field=IntegerField()), 0),
+                       unique_visitors=Coalesce(Subquery(unique_visitors, output_field=IntegerField()), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shortenurls', '0017_url_created_id_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='url',
+            name='total_visits',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='url',
+            name='unique_visitors',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='urlvisits',
+            name='unique_visitors',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(rebuild_visit_totals, migrations.RunPython.noop),
+    ]
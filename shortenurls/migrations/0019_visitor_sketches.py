@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.11 on 2026-10-18 11:20
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shortenurls', '0018_visit_totals'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='url',
+            name='visitors_sketch',
+            field=models.BinaryField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='urlvisits',
+            name='visitors_sketch',
+            field=models.BinaryField(editable=False, null=True),
+        ),
+    ]
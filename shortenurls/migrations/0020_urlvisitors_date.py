@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.11 on 2026-10-18 14:40
+from __future__ import unicode_literals
+
+import datetime
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def copy_visit_dates(apps, schema_editor):
+    UrlVisits = apps.get_model('shortenurls', 'UrlVisits')
+    UrlVisitors = apps.get_model('shortenurls', 'UrlVisitors')
+    visit_date = UrlVisits.objects.filter(id=OuterRef('url_visit_id')).values('date')
+    UrlVisitors.objects.update(date=Subquery(visit_date, output_field=models.DateField()))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shortenurls', '0019_visitor_sketches'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='urlvisitors',
+            name='date',
+            field=models.DateField(default=datetime.date.today),
+        ),
+        migrations.RunPython(copy_visit_dates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.11 on 2026-10-18 15:30
+from __future__ import unicode_literals
+
+import hashlib
+from itertools import islice
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+import django.db.models.deletion
+
+from shortenurls.useragents import parse_user_agent
+
+BATCH_SIZE = 1000
+
+
+def intern_user_agents(apps, schema_editor):
+    """ Inserts distinct user agents of visitors in batches, then points every visitor at its agent with one update"""
+    UserAgent = apps.get_model('shortenurls', 'UserAgent')
+    UrlVisitors = apps.get_model('shortenurls', 'UrlVisitors')
+    user_agents = UrlVisitors.objects.exclude(user_agent="").order_by().values_list('user_agent', flat=True) \
+        .distinct().iterator()
+    while True:
+        batch = list(islice(user_agents, BATCH_SIZE))
+        if not batch:
+            break
+        agents = []
+        for user_agent in batch:
+            browser, operating_system, device = parse_user_agent(user_agent)
+            agents.append(UserAgent(hash=hashlib.md5(user_agent.encode("utf-8")).hexdigest(), user_agent=user_agent,
+                                    browser=browser, os=operating_system, device=device))
+        UserAgent.objects.bulk_create(agents)
+    connection = schema_editor.connection
+    if connection.vendor == "postgresql":
+        quote = connection.ops.quote_name
+        with connection.cursor() as cursor:
+            cursor.execute("UPDATE {visitors} SET agent_id = a.id FROM {agents} a WHERE a.user_agent = {visitors}."
+                           "user_agent AND {visitors}.user_agent <> ''".format(
+                               visitors=quote(UrlVisitors._meta.db_table), agents=quote(UserAgent._meta.db_table)))
+    else:
+        UrlVisitors.objects.exclude(user_agent="").update(
+            agent=Subquery(UserAgent.objects.filter(user_agent=OuterRef('user_agent')).values('id')[:1]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shortenurls', '0020_urlvisitors_date'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserAgent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hash', models.CharField(max_length=32, unique=True)),
+                ('user_agent', models.TextField()),
+                ('browser', models.CharField(max_length=50)),
+                ('os', models.CharField(max_length=50)),
+                ('device', models.CharField(max_length=10)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='urlvisitors',
+            name='agent',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='shortenurls.UserAgent'),
+        ),
+        migrations.RunPython(intern_user_agents, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='urlvisitors',
+            name='user_agent',
+        ),
+    ]
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.11 on 2026-10-18 16:45
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+from shortenurls.networks import normalize_ip
+
+IP_FIELDS = (('Url', 'last_visit_from'), ('UrlVisits', 'last_visit_from'), ('UrlVisitors', 'remote_address'))
+
+
+def normalize_addresses(apps, schema_editor):
+    """ Addresses are normalized before columns become inet, anything that isn't an address is cleared"""
+    for model_name, field in IP_FIELDS:
+        model = apps.get_model('shortenurls', model_name)
+        values = model.objects.exclude(**{field: None}).order_by().values_list(field, flat=True).distinct()
+        for value in list(values.iterator()):
+            normalized = normalize_ip(value)
+            if normalized != value:
+                model.objects.filter(**{field: value}).update(**{field: normalized})
+
+
+def create_network_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('CREATE INDEX "shortenurls_urlvisitors_remote_address_gist" '
+                              'ON "shortenurls_urlvisitors" USING gist ("remote_address" inet_ops)')
+
+
+def drop_network_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX "shortenurls_urlvisitors_remote_address_gist"')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shortenurls', '0021_user_agents'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='url',
+            name='last_visit_from',
+            field=models.CharField(max_length=39, null=True),
+        ),
+        migrations.AlterField(
+            model_name='urlvisitors',
+            name='remote_address',
+            field=models.CharField(max_length=39, null=True),
+        ),
+        migrations.AlterField(
+            model_name='urlvisits',
+            name='last_visit_from',
+            field=models.CharField(max_length=39, null=True),
+        ),
+        migrations.RunPython(normalize_addresses, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='url',
+            name='last_visit_from',
+            field=models.GenericIPAddressField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='urlvisitors',
+            name='remote_address',
+            field=models.GenericIPAddressField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='urlvisits',
+            name='last_visit_from',
+            field=models.GenericIPAddressField(blank=True, null=True),
+        ),
+        migrations.RunPython(create_network_index, drop_network_index),
+    ]
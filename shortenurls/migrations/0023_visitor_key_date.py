@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.11 on 2026-10-18 17:10
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shortenurls', '0022_ip_addresses'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='urlvisitors',
+            unique_together=set([('url_visit', 'remote_address', 'date')]),
+        ),
+    ]
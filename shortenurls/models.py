@@ -1,36 +1,139 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import base64
+import hashlib
+import json
 import logging
+from collections import OrderedDict
+from itertools import islice
 
 import datetime
-import requests
+from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.core.validators import URLValidator
-from django.db import models
+from django.db import IntegrityError, connection, models, transaction
+from django.db.models import Case, Count, Exists, F, IntegerField, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce, Greatest, TruncMonth
+from django.utils.dateparse import parse_datetime
 from requests import RequestException
 
-from shortenurls.const import SHORT_URL_LENGTH, SHORT_URL_MEMCACHE_KEY, DATE_FORMAT, DATETIME_FORMAT
+from shortenurls.bloom import short_url_filter
+from shortenurls.const import SHORT_URL_MIN_LENGTH, SHORT_URL_MAX_LENGTH, SHORT_URL_MEMCACHE_KEY, DATE_FORMAT, DATETIME_FORMAT, \
+    SHORT_URL_MISSING_MEMCACHE_KEY, SHORT_URL_NEGATIVE_CACHE_TTL, URL_PAGE_SIZE, URL_MAX_PAGE_SIZE, URL_SORT_KEYS, \
+    URL_DEFAULT_SORT_KEY, VISIT_HISTORY_BUCKETS, VISIT_HISTORY_MAX_BUCKETS, VISITOR_RETENTION_DAYS, KEEP_VISITOR_ROWS, \
+    NETWORK_SCAN_MAX_ROWS
 from shortenurls.exceptions import URLException
-from shortenurls.helpers import get_memcached_value, add_to_memcache
+from shortenurls.hll import HyperLogLog, merge_sketch, update_sketch
+from shortenurls.hot import hot_urls
+from shortenurls.networks import normalize_ip
+from shortenurls.helpers import get_memcached_values, add_to_memcache, short_url_cache, set_memcache, \
+    delete_from_memcache, bucket_start, next_bucket, bump_data_version, bump_url_versions, user_agent_cache
+from shortenurls.reachability import check_reachability
+from shortenurls.useragents import parse_user_agent
+
+
+def _upsert(model, values, conflict, updates, returning):
+    """ Inserts a row of the model, or updates the row it conflicts with on the `conflict` columns, with a single
+    INSERT ... ON CONFLICT statement of PostgreSQL. `values` is an OrderedDict of field attnames to values, `updates`
+    are SET assignments where {table} is the existing row and EXCLUDED the inserted one. Returns the `returning`
+    expressions of the row.
+    """
+    quote = connection.ops.quote_name
+    table = quote(model._meta.db_table)
+    fields = [model._meta.get_field(name) for name in values]
+    params = [field.get_db_prep_save(values[field.attname], connection) for field in fields]
+    with connection.cursor() as cursor:
+        cursor.execute("INSERT INTO {table} ({columns}) VALUES ({values}) ON CONFLICT ({conflict}) DO UPDATE SET "
+                       "{updates} RETURNING {returning}".format(
+                           table=table, columns=", ".join(quote(field.column) for field in fields),
+                           values=", ".join(["%s"] * len(fields)), conflict=", ".join(conflict),
+                           updates=", ".join(updates).format(table=table), returning=", ".join(returning)), params)
+        return cursor.fetchone()
 
 
 class Url(models.Model):
     original_url = models.CharField(max_length=255, validators=[URLValidator])
-    shorten_url = models.CharField(max_length=255)
+    # Fixed width digest of original_url, indexed for lookups of already shortened urls
+    original_url_hash = models.CharField(max_length=40, db_index=True, editable=False)
+    shorten_url = models.CharField(max_length=255, unique=True)
     created = models.DateTimeField(auto_now_add=True)
     last_visit_at = models.DateTimeField(blank=True, null=True)
-    last_visit_from = models.CharField(max_length=39)
+    last_visit_from = models.GenericIPAddressField(null=True, blank=True)
+    verified = models.NullBooleanField(default=True)
+    # Denormalized from UrlVisits and UrlVisitors by the visit recording path, rebuild_visit_totals repairs drift
+    total_visits = models.IntegerField(default=0)
+    unique_visitors = models.IntegerField(default=0)
+    # HyperLogLog registers of visitor addresses, NULL until the first visit
+    visitors_sketch = models.BinaryField(null=True, editable=False)
+
+    class Meta:
+        # Backs listing sorted by created, id is the tie breaker of keyset pagination
+        index_together = (("created", "id"),)
 
     def __str__(self):
         return self.original_url
 
+    def save(self, *args, **kwargs):
+        self.original_url_hash = Url.hash_url(self.original_url)
+        super(Url, self).save(*args, **kwargs)
+
+    @staticmethod
+    def hash_url(url):
+        return hashlib.sha1(url.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def fetch_by_original_url(url):
+        """ Returns the oldest url shortening given original url, raises Url.DoesNotExist if there is none. Visitors
+        sketch is left out, urls found here end up in memcache.
+        """
+        url_obj = Url.objects.defer("visitors_sketch").filter(original_url_hash=Url.hash_url(url), original_url=url) \
+            .order_by("id").first()
+        if url_obj is None:
+            raise Url.DoesNotExist("Url matching query does not exist.")
+        return url_obj
+
     @staticmethod
-    def check_url_validation(url):
+    def fetch_by_original_urls(urls):
+        """ Returns a dict of original url to the oldest url shortening it, for given urls that are shortened"""
+        url_objs = {}
+        urls = set(urls)
+        hashes = [Url.hash_url(url) for url in urls]
+        for url_obj in Url.objects.defer("visitors_sketch").filter(original_url_hash__in=hashes).order_by("id"):
+            if url_obj.original_url in urls:
+                url_objs.setdefault(url_obj.original_url, url_obj)
+        return url_objs
+
+    @staticmethod
+    def normalize_url(url):
+        # If url doesn't contain http or https, add to the url
+        if "http" not in url:
+            url = "http://" + url
+        return url
+
+    @staticmethod
+    def check_url_validation(url, reachability=True):
         """ Check if provided URL is valid. First we check if URL is URL-like then try to reach the provided address to see if exists.
+        Syntax is always checked, raising ValidationError, only reachability can be left out.
         """
-        URLValidator(url)
-        requests.get(url)
+        URLValidator()(url)
+        if reachability:
+            check_reachability(url)
+
+    @staticmethod
+    def verify(url_id):
+        """ Checks reachability of an already shortened url and marks it as verified or not"""
+        url = Url.objects.filter(id=url_id).values_list("original_url", flat=True).first()
+        if url is None:
+            return None
+        try:
+            check_reachability(url)
+            verified = True
+        except RequestException:
+            verified = False
+        Url.objects.filter(id=url_id).update(verified=verified)
+        bump_data_version()
+        return verified
 
     @staticmethod
     def short_url_exist(url):
@@ -43,100 +146,335 @@ class Url(models.Model):
 
     @staticmethod
     def create(save=True, **kwargs):
+        if "last_visit_from" in kwargs:
+            kwargs["last_visit_from"] = normalize_ip(kwargs["last_visit_from"])
         url_obj = Url(**kwargs)
         if save:
             url_obj.save()
+            short_url_filter.add(url_obj.shorten_url)
+            delete_from_memcache(SHORT_URL_MISSING_MEMCACHE_KEY.format(url_obj.shorten_url))
+            bump_data_version()
         return url_obj
 
+    @staticmethod
+    def create_many(original_urls, short_urls, verified=True):
+        """ Creates urls in a single bulk insert. Returns created urls with their ids set."""
+        url_objs = [Url(original_url=original_url, original_url_hash=Url.hash_url(original_url), shorten_url=short_url,
+                        verified=verified)
+                    for original_url, short_url in zip(original_urls, short_urls)]
+        with transaction.atomic():
+            url_objs = Url.objects.bulk_create(url_objs)
+        if url_objs and url_objs[0].id is None:
+            # Only some database backends return ids of bulk inserted rows
+            url_objs = list(Url.objects.defer("visitors_sketch").filter(shorten_url__in=short_urls))
+        short_url_filter.add(*short_urls)
+        delete_from_memcache(*[SHORT_URL_MISSING_MEMCACHE_KEY.format(short_url) for short_url in short_urls])
+        bump_data_version()
+        return url_objs
+
     @staticmethod
     def check_short_url(url):
-        if len(url) != SHORT_URL_LENGTH:
+        if not SHORT_URL_MIN_LENGTH <= len(url) <= SHORT_URL_MAX_LENGTH:
             raise URLException("Invalid short url")
 
+        # Hot short urls are resolved from the local cache which only keeps id and original url
+        cached = short_url_cache.get(url)
+        if cached is not None:
+            hot_urls.offer(url)
+            return Url(id=cached[0], original_url=cached[1], shorten_url=url)
+        if not short_url_filter.might_exist(url):
+            raise URLException("Short URL not found")
         memcache_format = SHORT_URL_MEMCACHE_KEY.format(url)
-        url_obj = get_memcached_value(memcache_format)
+        missing_format = SHORT_URL_MISSING_MEMCACHE_KEY.format(url)
+        cached_values = get_memcached_values(memcache_format, missing_format)
+        if missing_format in cached_values:
+            raise URLException("Short URL not found")
+        url_obj = cached_values.get(memcache_format)
         if url_obj is None:
             try:
-                url_obj = Url.fetch(shorten_url=url)
+                url_obj = Url.objects.defer("visitors_sketch").get(shorten_url=url)
             except Url.DoesNotExist:
+                set_memcache(missing_format, True,
+                             getattr(settings, "SHORT_URL_NEGATIVE_CACHE_TTL", SHORT_URL_NEGATIVE_CACHE_TTL))
                 raise URLException("Short URL not found")
             if not add_to_memcache(memcache_format, url_obj):
                 logging.warning("Memcaching for short url failed")
+        hot_urls.offer(url)
+        if hot_urls.is_hot(url):
+            short_url_cache.set(url, (url_obj.id, url_obj.original_url))
         return url_obj
 
     @staticmethod
-    def update_last_visit(url_id, remote_address):
-        url = Url.fetch(id=url_id)
-        url.last_visit_from = remote_address
-        url.last_visit_at = datetime.datetime.now()
-        url.save()
+    def update_last_visit(url_id, remote_address, visited_at=None, new_visitors=0, visits=0):
+        """ Records the last visit of the url, and adds visits and new unique visitors to its totals in the same
+        UPDATE.
+        """
+        values = {"last_visit_from": remote_address, "last_visit_at": visited_at or datetime.datetime.now()}
+        if visits:
+            values['total_visits'] = F('total_visits') + visits
+        if new_visitors:
+            values['unique_visitors'] = F('unique_visitors') + new_visitors
+        updated = Url.objects.filter(id=url_id).update(**values)
+        if not updated:
+            raise Url.DoesNotExist("Url matching query does not exist.")
 
     def json(self, host, secure):
-        return {
+        return Url.values_json({
             "id": self.id,
-            "shortUrl": ("https://" if secure else "http://") + host+"/url/"+self.shorten_url,
-            "redirectUrl": self.original_url,
-            "created": datetime.datetime.strftime(self.created, DATE_FORMAT),
-            "lastIP": self.last_visit_from,
+            "shorten_url": self.shorten_url,
+            "original_url": self.original_url,
+            "created": self.created,
+            "last_visit_from": self.last_visit_from,
+            "verified": self.verified,
+        }, host, secure)
+
+    @staticmethod
+    def values_json(values, host, secure):
+        """ Builds url's JSON out of a dict of its field values, e.g. a row of values() queryset"""
+        return {
+            "id": values['id'],
+            "shortUrl": ("https://" if secure else "http://") + host+"/url/"+values['shorten_url'],
+            "redirectUrl": values['original_url'],
+            "created": datetime.datetime.strftime(values['created'], DATE_FORMAT),
+            "lastIP": values['last_visit_from'],
+            "verified": values['verified'],
         }
 
+    @staticmethod
+    def visits_json(values, host, secure):
+        """ Url's JSON along with its visit totals, out of a row of query_with_visits"""
+        resp = Url.values_json(values, host, secure)
+        resp['visits'] = values['window_visits'] if "window_visits" in values else values['total_visits']
+        resp['uniqueVisitors'] = values['unique_visitors']
+        return resp
+
     @staticmethod
     def fetch(single=True, **kwargs):
         """ Fetch can return filtered by"""
         if single:
             resp = Url.objects.get(**kwargs)
         else:
-            limit = 0
-            resp = Url.objects.all()
-            if "results" in kwargs:
-                limit = int(kwargs['results'][0])
-            if "from_date" in kwargs:
-                day = datetime.datetime.strptime(kwargs['from_date'][0], DATE_FORMAT).date()
-                beginning_of_day = datetime.datetime.combine(day, datetime.datetime.min.time())
-                resp = resp.filter(created__gte=beginning_of_day)
-            if "to_date" in kwargs:
-                day = datetime.datetime.strptime(kwargs['to_date'][0], DATE_FORMAT).date()
-                end_of_day = datetime.datetime.combine(day, datetime.datetime.max.time())
-                resp = resp.filter(created__lte=end_of_day)
-            if "date" in kwargs:
-                day = datetime.datetime.strptime(kwargs['date'][0], DATE_FORMAT).date()
-                beginning_of_day = datetime.datetime.combine(day, datetime.datetime.min.time())
-                end_of_day = datetime.datetime.combine(day, datetime.datetime.max.time())
-                resp = resp.filter(created__gte=beginning_of_day, created__lte=end_of_day)
-            if "order_by" in kwargs:
-                resp = resp.order_by(kwargs['order_by'][0])
-            if limit != 0:
-                resp = resp[:limit]
+            resp = Url.query(**kwargs)[:Url.page_size(**kwargs)]
         return resp
 
     @staticmethod
-    def fetch_all(host, secure=False, **kwargs):
-        urls = Url.fetch(single=False, **kwargs)
+    def page_size(**kwargs):
+        """ Requested number of results, capped. Default page size is used when results is missing or 0."""
+        page_size = getattr(settings, "URL_PAGE_SIZE", URL_PAGE_SIZE)
+        max_page_size = getattr(settings, "URL_MAX_PAGE_SIZE", URL_MAX_PAGE_SIZE)
+        if "results" in kwargs and int(kwargs['results'][0]) > 0:
+            page_size = int(kwargs['results'][0])
+        return min(page_size, max_page_size)
+
+    @staticmethod
+    def query(**kwargs):
+        """ Returns queryset of urls filtered by creation date, ordered by one of URL_SORT_KEYS and starting after
+        the cursor when one is given.
+        """
+        resp = Url.objects.all()
+        if "from_date" in kwargs:
+            day = datetime.datetime.strptime(kwargs['from_date'][0], DATE_FORMAT).date()
+            beginning_of_day = datetime.datetime.combine(day, datetime.datetime.min.time())
+            resp = resp.filter(created__gte=beginning_of_day)
+        if "to_date" in kwargs:
+            day = datetime.datetime.strptime(kwargs['to_date'][0], DATE_FORMAT).date()
+            end_of_day = datetime.datetime.combine(day, datetime.datetime.max.time())
+            resp = resp.filter(created__lte=end_of_day)
+        if "date" in kwargs:
+            day = datetime.datetime.strptime(kwargs['date'][0], DATE_FORMAT).date()
+            beginning_of_day = datetime.datetime.combine(day, datetime.datetime.min.time())
+            end_of_day = datetime.datetime.combine(day, datetime.datetime.max.time())
+            resp = resp.filter(created__gte=beginning_of_day, created__lte=end_of_day)
+        sort_key = kwargs['order_by'][0] if "order_by" in kwargs else URL_DEFAULT_SORT_KEY
+        if sort_key not in URL_SORT_KEYS:
+            raise URLException("Sorting by {} is not supported, use one of: {}".format(
+                sort_key, ", ".join(sorted(URL_SORT_KEYS))))
+        resp = resp.order_by(*URL_SORT_KEYS[sort_key])
+        if kwargs.get("cursor"):
+            resp = resp.filter(Url.after_cursor(sort_key, kwargs['cursor'][0]))
+        return resp
+
+    @staticmethod
+    def encode_cursor(sort_key, url):
+        """ Opaque cursor pointing after the given url (dict with id and created) in sort_key order"""
+        position = [url['id']]
+        if "created" in sort_key:
+            position.append(url['created'].isoformat())
+        return base64.urlsafe_b64encode(json.dumps([sort_key] + position).encode("utf-8")).decode("ascii")
+
+    @staticmethod
+    def after_cursor(sort_key, cursor):
+        """ Returns filter selecting urls following the cursor in sort_key order"""
+        try:
+            position = json.loads(base64.urlsafe_b64decode(str(cursor)).decode("utf-8"))
+            if not isinstance(position, list):
+                raise ValueError("Cursor is not a list")
+            cursor_sort_key, url_id = position[0], int(position[1])
+            created = parse_datetime(position[2]) if "created" in sort_key else None
+        except (TypeError, ValueError, IndexError):
+            raise URLException("Invalid cursor")
+        if cursor_sort_key != sort_key or ("created" in sort_key and created is None):
+            raise URLException("Invalid cursor")
+        lookup = "lt" if sort_key.startswith("-") else "gt"
+        after = Q(**{"id__" + lookup: url_id})
+        if created is not None:
+            after = Q(**{"created__" + lookup: created}) | (Q(created=created) & after)
+        return after
+
+    @staticmethod
+    def fetch_page(host, secure=False, **kwargs):
+        """ Returns JSON of a page of urls matching query's filters along with their total visits, computed by the
+        database in the same query, and cursor of the next page (None on the last page). Visits can be limited to
+        a date window with visits_from and visits_to.
+        """
+        page_size = Url.page_size(**kwargs)
+        urls = Url.query_with_visits(**kwargs)
+        # One extra row tells whether there is a next page
+        urls = list(urls[:page_size + 1])
+        next_cursor = None
+        if len(urls) > page_size:
+            urls = urls[:page_size]
+            next_cursor = Url.encode_cursor(kwargs['order_by'][0] if "order_by" in kwargs else URL_DEFAULT_SORT_KEY,
+                                            urls[-1])
         resp = []
         for url in urls:
-            visits = UrlVisits.fetch(single=False, url_id=url.id)
-            no_of_visits = 0
-            for visit in visits:
-                no_of_visits += visit.visits
-            url_resp = url.json(host, secure)
-            url_resp['visits'] = no_of_visits
-            resp.append(url_resp)
-        return resp
+            resp.append(Url.visits_json(url, host, secure))
+        return resp, next_cursor
+
+    @staticmethod
+    def fetch_all(host, secure=False, **kwargs):
+        """ Returns JSON of the first page of urls, see fetch_page"""
+        return Url.fetch_page(host, secure, **kwargs)[0]
+
+    @staticmethod
+    def query_with_visits(**kwargs):
+        """ Returns values() queryset of query's urls with their total visits and unique visitors. Visits can be limited
+        to visits between visits_from and visits_to, they are then returned as window_visits.
+        """
+        kwargs = dict(kwargs)
+        window = {}
+        if "visits_from" in kwargs:
+            window['urlvisits__date__gte'] = datetime.datetime.strptime(kwargs.pop('visits_from')[0], DATE_FORMAT).date()
+        if "visits_to" in kwargs:
+            window['urlvisits__date__lte'] = datetime.datetime.strptime(kwargs.pop('visits_to')[0], DATE_FORMAT).date()
+        urls = Url.query(**kwargs)
+        if window:
+            # Only totals of the whole lifetime are denormalized, visits of a window are summed from daily rows
+            visits = Sum(Case(When(then=F('urlvisits__visits'), **window), default=Value(0), output_field=IntegerField()))
+            urls = urls.annotate(window_visits=Coalesce(visits, 0))
+        urls = urls.values("id", "shorten_url", "original_url", "created", "last_visit_from", "verified",
+                           "window_visits" if window else "total_visits", "unique_visitors")
+        return urls
+
+    @staticmethod
+    def iter_all(host, secure=False, **kwargs):
+        """ Streaming variant of fetch_all. Every url matching the filters is returned, or only `results` of them when
+        given, read from a server-side cursor on databases supporting one. Filters are validated before returning.
+        """
+        urls = Url.query_with_visits(**kwargs)
+        if "results" in kwargs:
+            urls = urls[:Url.page_size(**kwargs)]
+
+        def rows():
+            for url in urls.iterator():
+                url_resp = Url.visits_json(url, host, secure)
+                yield url_resp
+        return rows()
+
+    @staticmethod
+    def rebuild_visit_totals(first_id, last_id):
+        """ Recomputes denormalized visit totals of urls with id between first_id and last_id, and unique visitors of
+        their daily visit records, from UrlVisits and UrlVisitors rows. Visitor sketches are rebuilt from visitor
+        rows too. Unique visitors not covered by visitor rows (rows aren't kept, or were compacted) are estimated
+        from the sketches.
+        """
+        total_visits = UrlVisits.objects.filter(url=OuterRef('pk')).order_by().values('url') \
+            .annotate(total=Sum('visits')).values('total')
+        urls = Url.objects.filter(id__gte=first_id, id__lte=last_id)
+        visits = UrlVisits.objects.filter(url_id__gte=first_id, url_id__lte=last_id)
+        estimated = []
+        with transaction.atomic():
+            rebuilt = urls.update(total_visits=Coalesce(Subquery(total_visits, output_field=IntegerField()), 0))
+            if UrlVisitors.rows_kept():
+                day_visitors = UrlVisitors.objects.filter(url_visit=OuterRef('pk')).order_by().values('url_visit') \
+                    .annotate(count=Count('id')).values('count')
+                # Days whose visitor rows were compacted keep their counts
+                visits.filter(id__in=UrlVisitors.objects.values('url_visit')) \
+                    .update(unique_visitors=Coalesce(Subquery(day_visitors, output_field=IntegerField()), 0))
+                Url.rebuild_visitor_sketches(first_id, last_id)
+            else:
+                estimated.append((UrlVisits, visits))
+            if UrlVisitors.counts_new_visitors():
+                unique_visitors = UrlVisitors.objects.filter(url_visit__url=OuterRef('pk')).order_by() \
+                    .values('url_visit__url').annotate(count=Count('remote_address', distinct=True)).values('count')
+                urls.update(unique_visitors=Coalesce(Subquery(unique_visitors, output_field=IntegerField()), 0))
+            else:
+                estimated.append((Url, urls))
+            for model, rows in estimated:
+                sketches = rows.filter(visitors_sketch__isnull=False).values_list('id', 'visitors_sketch')
+                for row_id, registers in sketches.iterator():
+                    model.objects.filter(id=row_id).update(unique_visitors=HyperLogLog(registers).count())
+        bump_data_version()
+        return rebuilt
+
+    @staticmethod
+    def rebuild_visitor_sketches(first_id, last_id):
+        """ Rebuilds visitor sketches of urls with id between first_id and last_id and of their visit records from
+        visitor rows. Rows are read in visit record order so only one daily sketch is held at a time. Sketches of days
+        without visitor rows are kept, url sketches are merged from the daily ones.
+        """
+        visits = UrlVisits.objects.filter(url_id__gte=first_id, url_id__lte=last_id)
+        visits.filter(id__in=UrlVisitors.objects.values('url_visit')).update(visitors_sketch=None)
+        rows = UrlVisitors.objects.filter(url_visit__url_id__gte=first_id, url_visit__url_id__lte=last_id) \
+            .order_by('url_visit_id').values_list('url_visit_id', 'remote_address')
+        visit_id, day_sketch = None, None
+        for row_visit_id, remote_address in rows.iterator():
+            if row_visit_id != visit_id:
+                if day_sketch is not None:
+                    UrlVisits.objects.filter(id=visit_id).update(visitors_sketch=day_sketch.to_bytes())
+                visit_id, day_sketch = row_visit_id, HyperLogLog()
+            day_sketch.add(remote_address)
+        if day_sketch is not None:
+            UrlVisits.objects.filter(id=visit_id).update(visitors_sketch=day_sketch.to_bytes())
+        Url.objects.filter(id__gte=first_id, id__lte=last_id).update(visitors_sketch=None)
+        day_sketches = visits.filter(visitors_sketch__isnull=False).order_by('url_id') \
+            .values_list('url_id', 'visitors_sketch')
+        url_id, url_sketch = None, None
+        for row_url_id, registers in day_sketches.iterator():
+            if row_url_id != url_id:
+                if url_sketch is not None:
+                    Url.objects.filter(id=url_id).update(visitors_sketch=url_sketch.to_bytes())
+                url_id, url_sketch = row_url_id, HyperLogLog()
+            url_sketch.merge(HyperLogLog(registers))
+        if url_sketch is not None:
+            Url.objects.filter(id=url_id).update(visitors_sketch=url_sketch.to_bytes())
 
     @staticmethod
     def get_all_visits(id):
         resp = []
-        visits = UrlVisits.fetch(single=False, url_id=id)
+        visits = UrlVisits.fetch(single=False, url_id=id).defer("visitors_sketch")
         for v in visits:
             resp.append(v.json())
         return resp
 
     @staticmethod
-    def get_all_visitors(id):
+    def iter_visits(id):
+        """ Streaming variant of get_all_visits"""
+        visits = UrlVisits.fetch(single=False, url_id=id).defer("visitors_sketch").order_by("date")
+        return (v.json() for v in visits.iterator())
+
+    @staticmethod
+    def iter_visitors(id, network=None):
+        """ Streaming variant of get_all_visitors"""
+        visitors = UrlVisitors.fetch(single=False, url_visit__url_id=id).select_related("agent").order_by("id")
+        return (v.json() for v in UrlVisitors.in_network(visitors, network))
+
+    @staticmethod
+    def get_all_visitors(id, network=None):
         try:
             resp = []
-            visitors = UrlVisitors.fetch(single=False, url_visit__url_id=id)
-            for v in visitors:
+            visitors = UrlVisitors.fetch(single=False, url_visit__url_id=id).select_related("agent")
+            for v in UrlVisitors.in_network(visitors, network):
                 resp.append(v.json())
         except URLException as error:
             raise URLException(error)
@@ -144,11 +482,18 @@ class Url(models.Model):
 
 
 class UrlVisits(models.Model):
-    url = models.ForeignKey(Url)
-    date = models.DateField(auto_now_add=True)
+    # Lookups by url are served by the (url, date) unique index
+    url = models.ForeignKey(Url, db_index=False)
+    date = models.DateField(default=datetime.date.today)
     visits = models.IntegerField(default=0)
+    # Number of UrlVisitors rows of the day, maintained along with them, or the sketch estimate without visitor rows
+    unique_visitors = models.IntegerField(default=0)
+    visitors_sketch = models.BinaryField(null=True, editable=False)
     last_visit_at = models.DateTimeField(blank=True, null=True)
-    last_visit_from = models.CharField(max_length=39)
+    last_visit_from = models.GenericIPAddressField(null=True, blank=True)
+
+    class Meta:
+        unique_together = (("url", "date"),)
 
     def __str__(self):
         return datetime.date.strftime(self.date, DATE_FORMAT)
@@ -172,19 +517,127 @@ class UrlVisits(models.Model):
         return url_obj
 
     @staticmethod
-    def mark_visit(url_id, remote_addr):
-        try:
-            try:
-                url_visit_obj = UrlVisits.fetch(date=datetime.date.today(), url_id=url_id)
-            except Exception as error:
-                if isinstance(error, UrlVisits.MultipleObjectsReturned):
-                    raise URLException("There is more than 1 visit record for today")
-                else:
-                    url_visit_obj = UrlVisits.create(False, url_id=url_id)
-            url_visit_obj.visits += 1
+    def add_visits(url_id, day, visits, visited_at, remote_addr):
+        """ Adds visits to the url's record of the given day. Record is inserted when missing, otherwise visits are
+        incremented in database so concurrent requests never lose an increment. Url's total visits are left to
+        Url.update_last_visit, which writes the url row once per visit or batch. Returned object reflects the record
+        as read plus the added visits. PostgreSQL does it with a single upsert, other databases with get_or_create and
+        an update.
+        """
+        if connection.vendor == "postgresql":
+            visit_id, total, unique_visitors = _upsert(
+                UrlVisits, OrderedDict([("url_id", url_id), ("date", day), ("visits", visits), ("unique_visitors", 0),
+                                        ("last_visit_at", visited_at), ("last_visit_from", remote_addr)]),
+                ("url_id", "date"), ("visits = {table}.visits + EXCLUDED.visits",
+                                     "last_visit_at = EXCLUDED.last_visit_at",
+                                     "last_visit_from = EXCLUDED.last_visit_from"),
+                ("id", "visits", "unique_visitors"))
+            return UrlVisits(id=visit_id, url_id=url_id, date=day, visits=total, unique_visitors=unique_visitors,
+                             last_visit_at=visited_at, last_visit_from=remote_addr)
+        url_visit_obj, created = UrlVisits.objects.get_or_create(
+            url_id=url_id, date=day,
+            defaults={"visits": visits, "last_visit_at": visited_at, "last_visit_from": remote_addr})
+        if not created:
+            UrlVisits.objects.filter(id=url_visit_obj.id, date=day).update(visits=F('visits') + visits,
+                                                                           last_visit_at=visited_at,
+                                                                           last_visit_from=remote_addr)
+            url_visit_obj.visits += visits
+            url_visit_obj.last_visit_at = visited_at
             url_visit_obj.last_visit_from = remote_addr
-            url_visit_obj.last_visit_at = datetime.datetime.now()
-            url_visit_obj.save()
+        return url_visit_obj
+
+    @staticmethod
+    def history(url_id, bucket, from_date, to_date):
+        """ Returns OrderedDict of bucket start date to url's visits in that bucket, for every day, week or month
+        bucket between from_date and to_date. Buckets without visits are zero filled.
+        """
+        if bucket not in VISIT_HISTORY_BUCKETS:
+            raise URLException("Unsupported bucket {}, visits are kept per day so use one of: {}".format(
+                bucket, ", ".join(VISIT_HISTORY_BUCKETS)))
+        if from_date > to_date:
+            raise URLException("From date must be before to date")
+        history = OrderedDict()
+        start = bucket_start(from_date, bucket)
+        while start <= to_date:
+            history[start] = 0
+            if len(history) > VISIT_HISTORY_MAX_BUCKETS:
+                raise URLException("Too many buckets, use a shorter window or a larger bucket")
+            start = next_bucket(start, bucket)
+        rows = UrlVisits.objects.filter(url_id=url_id, date__gte=from_date, date__lte=to_date).order_by()
+        if bucket == "month":
+            rows = rows.annotate(month=TruncMonth('date')).values('month').annotate(total=Sum('visits')) \
+                .values_list('month', 'total')
+        else:
+            # Weeks are summed here, there is no week truncation in the ORM
+            rows = rows.values_list('date', 'visits')
+        for day, visits in rows:
+            history[bucket_start(day, bucket)] += visits
+        return history
+
+    @staticmethod
+    def add_visitors(url_id, visit, day, remote_addrs):
+        """ Adds visitor addresses to visitor sketches of the url and of its visit record of the given day. Unique
+        visitor counters not maintained from visitor rows are set from sketch estimates, whenever a sketch changes.
+        """
+        remote_addrs = [remote_addr for remote_addr in remote_addrs if remote_addr is not None]
+        day_sketch = update_sketch(UrlVisits, visit, "visitors_sketch", remote_addrs, date=day)
+        url_sketch = update_sketch(Url, url_id, "visitors_sketch", remote_addrs)
+        if day_sketch is not None and not UrlVisitors.rows_kept():
+            UrlVisits.objects.filter(id=visit, date=day).update(unique_visitors=day_sketch.count())
+        if url_sketch is not None and not UrlVisitors.counts_new_visitors():
+            Url.objects.filter(id=url_id).update(unique_visitors=url_sketch.count())
+
+    @staticmethod
+    def unique_visitors_between(url_id, from_date, to_date):
+        """ Estimated number of distinct visitors of the url between from_date and to_date, out of merged daily
+        sketches.
+        """
+        sketch = HyperLogLog()
+        sketches = UrlVisits.objects.filter(url_id=url_id, date__gte=from_date, date__lte=to_date,
+                                            visitors_sketch__isnull=False).values_list('visitors_sketch', flat=True)
+        for registers in sketches.iterator():
+            sketch.merge(HyperLogLog(registers))
+        return sketch.count()
+
+    @staticmethod
+    def foldable_months(before, limit):
+        """ Returns up to `limit` (url id, month) pairs of months before the given date with daily visit records not yet
+        folded into a single record on the first day of the month.
+        """
+        return list(UrlVisits.objects.filter(date__lt=bucket_start(before, "month"), date__day__gt=1).order_by()
+                    .annotate(month=TruncMonth('date')).values_list('url_id', 'month').distinct()[:limit])
+
+    @staticmethod
+    def fold_month(url_id, month):
+        """ Folds daily visit records of the url in the month starting on `month` into one record dated on the first
+        day of the month, merging their visits and visitor sketches. Months with days still having visitor rows are
+        left alone. Returns whether the month was folded.
+        """
+        with transaction.atomic():
+            days = list(UrlVisits.objects.select_for_update()
+                        .filter(url_id=url_id, date__gte=month, date__lt=next_bucket(month, "month")).order_by('date'))
+            if not days or UrlVisitors.objects.filter(url_visit__in=days).exists():
+                return False
+            folded, sketch = days[0], HyperLogLog()
+            sketches = [day.visitors_sketch for day in days if day.visitors_sketch is not None]
+            for registers in sketches:
+                sketch.merge(HyperLogLog(registers))
+            visited = [day for day in days if day.last_visit_at is not None]
+            last_visit = max(visited, key=lambda day: day.last_visit_at) if visited else folded
+            UrlVisits.objects.filter(id__in=[day.id for day in days[1:]]).delete()
+            UrlVisits.objects.filter(id=folded.id).update(
+                date=month, visits=sum(day.visits for day in days),
+                unique_visitors=max([sketch.count()] + [day.unique_visitors for day in days]),
+                visitors_sketch=sketch.to_bytes() if sketches else None,
+                last_visit_at=last_visit.last_visit_at, last_visit_from=last_visit.last_visit_from)
+        bump_url_versions(url_id)
+        return True
+
+    @staticmethod
+    def mark_visit(url_id, remote_addr, visited_at=None):
+        visited_at = visited_at or datetime.datetime.now()
+        try:
+            url_visit_obj = UrlVisits.add_visits(url_id, visited_at.date(), 1, visited_at, normalize_ip(remote_addr))
         except Exception as error:
             raise URLException(error)
         return url_visit_obj
@@ -193,20 +646,67 @@ class UrlVisits(models.Model):
         return {
             "id": self.id,
             "visits": self.visits,
+            "uniqueVisitors": self.unique_visitors,
             "created": datetime.date.strftime(self.date, DATE_FORMAT),
             "lastVisitAt": datetime.datetime.strftime(self.last_visit_at, DATETIME_FORMAT) if self.last_visit_at is not None else None,
             "lastIP": self.last_visit_from
         }
 
 
+class UserAgent(models.Model):
+    # md5 of the user agent string, keeps the unique index small whatever the length of the string
+    hash = models.CharField(max_length=32, unique=True)
+    user_agent = models.TextField()
+    browser = models.CharField(max_length=50)
+    os = models.CharField(max_length=50)
+    device = models.CharField(max_length=10)
+
+    def __str__(self):
+        return self.user_agent
+
+    @staticmethod
+    def hash_user_agent(user_agent):
+        return hashlib.md5(user_agent.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def intern(user_agent):
+        """ Returns id of the row of a user agent string, creating and parsing it the first time the string is seen.
+        Ids are kept in a per-process LRU so known user agents need no query.
+        """
+        agent_id = user_agent_cache.get(user_agent)
+        if agent_id is not None:
+            return agent_id
+        user_agent_hash = UserAgent.hash_user_agent(user_agent)
+        agent_id = UserAgent.objects.filter(hash=user_agent_hash).values_list("id", flat=True).first()
+        if agent_id is None:
+            browser, operating_system, device = parse_user_agent(user_agent)
+            try:
+                with transaction.atomic():
+                    agent_id = UserAgent.objects.create(hash=user_agent_hash, user_agent=user_agent, browser=browser,
+                                                        os=operating_system, device=device).id
+            except IntegrityError:
+                # Created concurrently by another process
+                agent_id = UserAgent.objects.get(hash=user_agent_hash).id
+        user_agent_cache.set(user_agent, agent_id)
+        return agent_id
+
+
 class UrlVisitors(models.Model):
-    remote_address = models.CharField(max_length=39)
-    user_agent = models.CharField(max_length=255)
-    url_visit = models.ForeignKey(UrlVisits)
+    # Kept as inet on PostgreSQL, a GiST index serves lookups by network (see in_network)
+    remote_address = models.GenericIPAddressField(null=True, blank=True)
+    agent = models.ForeignKey(UserAgent, null=True, blank=True, on_delete=models.SET_NULL)
+    # Lookups by url visit are served by the (url_visit, remote_address, date) unique index
+    url_visit = models.ForeignKey(UrlVisits, db_index=False)
+    # Day of the visit record, copied from it so the table can be partitioned by date (see partition_visits command)
+    date = models.DateField(default=datetime.date.today)
     visits = models.IntegerField(default=0)
     first_visit = models.DateTimeField(auto_now_add=True)
     last_visit = models.DateTimeField(blank=True, null=True)
 
+    class Meta:
+        # Date is implied by the visit record, it is part of the key so the key holds on partitioned tables too
+        unique_together = (("url_visit", "remote_address", "date"),)
+
     def __str__(self):
         return self.remote_address
 
@@ -232,25 +732,176 @@ class UrlVisitors(models.Model):
             "firstVisit": datetime.datetime.strftime(self.first_visit, DATETIME_FORMAT),
             "lastVisit": datetime.datetime.strftime(self.last_visit, DATETIME_FORMAT) if self.last_visit is not None else None,
             "ip": self.remote_address,
-            "userAgent": self.user_agent
+            "userAgent": self.agent.user_agent if self.agent_id is not None else None,
+            "browser": self.agent.browser if self.agent_id is not None else None,
+            "os": self.agent.os if self.agent_id is not None else None,
+            "device": self.agent.device if self.agent_id is not None else None
         }
 
     @staticmethod
-    def mark_visitor(meta, visit):
-        visitor_remote_address = meta['REMOTE_ADDR']
+    def add_visits(visit, day, remote_addr, user_agent, visits, visited_at):
+        """ Adds visits of a visitor to the given url visit record of the given day, same way as UrlVisits.add_visits
+        does. Returns the visitor and whether it is new for the day, like get_or_create.
+        """
+        if connection.vendor == "postgresql" and remote_addr is not None:
+            # Rows without an address never conflict, those are left to get_or_create
+            agent_id = UserAgent.intern(user_agent)
+            visitor_id, agent_id, total, first_visit, created = _upsert(
+                UrlVisitors, OrderedDict([("url_visit_id", visit), ("remote_address", remote_addr),
+                                          ("agent_id", agent_id), ("date", day), ("visits", visits),
+                                          ("first_visit", visited_at), ("last_visit", visited_at)]),
+                ("url_visit_id", "remote_address", "date"), ("visits = {table}.visits + EXCLUDED.visits",
+                                                             "last_visit = EXCLUDED.last_visit"),
+                ("id", "agent_id", "visits", "first_visit", "xmax = 0"))
+            visitor = UrlVisitors(id=visitor_id, url_visit_id=visit, remote_address=remote_addr, agent_id=agent_id,
+                                  date=day, visits=total, first_visit=first_visit, last_visit=visited_at)
+        else:
+            visitor, created = UrlVisitors.objects.get_or_create(
+                url_visit_id=visit, remote_address=remote_addr, date=day,
+                defaults={"agent_id": lambda: UserAgent.intern(user_agent), "visits": visits, "last_visit": visited_at})
+            if not created:
+                UrlVisitors.objects.filter(id=visitor.id, date=day).update(visits=F('visits') + visits,
+                                                                           last_visit=visited_at)
+                visitor.visits += visits
+                visitor.last_visit = visited_at
+        if created:
+            UrlVisits.objects.filter(id=visit, date=day).update(unique_visitors=F('unique_visitors') + 1)
+        return visitor, created
+
+    @staticmethod
+    def rows_kept():
+        return getattr(settings, "KEEP_VISITOR_ROWS", KEEP_VISITOR_ROWS)
+
+    @staticmethod
+    def retention_days():
+        return getattr(settings, "VISITOR_RETENTION_DAYS", VISITOR_RETENTION_DAYS)
+
+    @staticmethod
+    def counts_new_visitors():
+        """ Whether unique visitors of urls are counted exactly from visitor rows. With a retention period rows don't
+        cover the whole history of urls, so url wide counts are sketch estimates.
+        """
+        return UrlVisitors.rows_kept() and not UrlVisitors.retention_days()
+
+    @staticmethod
+    def compactable_days(before, after_id, limit):
+        """ Returns ids of up to `limit` visit records dated before the given date that still have visitor rows,
+        starting past the record with id after_id.
+        """
+        rows = UrlVisitors.objects.filter(url_visit=OuterRef('pk'))
+        return list(UrlVisits.objects.filter(date__lt=before, id__gt=after_id).annotate(has_rows=Exists(rows))
+                    .filter(has_rows=True).order_by('id').values_list('id', flat=True)[:limit])
+
+    @staticmethod
+    def fold_days(visit_ids):
+        """ Folds visitor rows of the given visit records into the records, and into sketches of their urls, so
+        the rows can be deleted without losing unique visitor counts. Safe to repeat when part of the rows is
+        already deleted.
+
+        Sketches of the rows are built without any lock, then merged into each visit record and url in a transaction
+        of its own. Merging only raises registers, so visits recorded meanwhile are kept.
+        """
+        days = dict((visit_id, (url_id, HyperLogLog())) for visit_id, url_id in
+                    UrlVisits.objects.filter(id__in=visit_ids).values_list('id', 'url_id'))
+        counts = dict(UrlVisitors.objects.filter(url_visit_id__in=visit_ids).order_by().values_list('url_visit')
+                      .annotate(count=Count('id')))
+        rows = UrlVisitors.objects.filter(url_visit_id__in=visit_ids, remote_address__isnull=False) \
+            .values_list('url_visit_id', 'remote_address')
+        for visit_id, remote_address in rows.iterator():
+            days[visit_id][1].add(remote_address)
+        url_sketches = {}
+        for visit_id, (url_id, sketch) in days.items():
+            merge_sketch(UrlVisits, visit_id, 'visitors_sketch', sketch,
+                         unique_visitors=Greatest('unique_visitors', Value(counts.get(visit_id, 0))))
+            url_sketches.setdefault(url_id, HyperLogLog()).merge(sketch)
+        for url_id, sketch in url_sketches.items():
+            merge_sketch(Url, url_id, 'visitors_sketch', sketch, count_field='unique_visitors')
+        bump_url_versions(*url_sketches.keys())
+
+    @staticmethod
+    def delete_rows(visit_ids, chunk_size):
+        """ Deletes at most chunk_size visitor rows of the given visit records, returns the number of deleted rows"""
+        ids = list(UrlVisitors.objects.filter(url_visit_id__in=visit_ids).values_list('id', flat=True)[:chunk_size])
+        if not ids:
+            return 0
+        return UrlVisitors.objects.filter(id__in=ids).delete()[0]
+
+    @staticmethod
+    def in_network(visitors, network):
+        """ Iterates visitors of the queryset with an address in the given Network, or all of them when network is
+        None. PostgreSQL filters with an indexed containment lookup, other databases filter rows as they are read.
+        """
+        if network is None:
+            return visitors.iterator()
+        if connection.vendor == "postgresql":
+            return visitors.filter(remote_address__net_contained_or_equal=network.cidr).iterator()
+        return (visitor for visitor in visitors.iterator() if visitor.remote_address in network)
+
+    @staticmethod
+    def iter_network(network, limit):
+        """ Iterates json of up to `limit` most recent visitors of any url with an address in the given Network. On
+        PostgreSQL the limit is applied in SQL, other databases only search the NETWORK_SCAN_MAX_ROWS most recent
+        visitors rather than reading the whole table.
+        """
+        visitors = UrlVisitors.objects.select_related("agent", "url_visit").order_by("-id")
+        if connection.vendor == "postgresql":
+            visitors = visitors.filter(remote_address__net_contained_or_equal=network.cidr)[:limit].iterator()
+        else:
+            scanned = visitors[:getattr(settings, "NETWORK_SCAN_MAX_ROWS", NETWORK_SCAN_MAX_ROWS)].iterator()
+            visitors = islice((visitor for visitor in scanned if visitor.remote_address in network), limit)
+        for visitor in visitors:
+            resp = visitor.json()
+            resp["urlId"] = visitor.url_visit.url_id
+            yield resp
+
+    @staticmethod
+    def is_new_to_url(url_id, remote_addr, visit):
+        """ Whether a visitor new for the given url visit record never visited the url on another day"""
+        return not UrlVisitors.objects.filter(url_visit__url_id=url_id, remote_address=remote_addr) \
+            .exclude(url_visit_id=visit).exists()
+
+    @staticmethod
+    def mark_visitor(meta, visit, url_id=None, visited_at=None, visits=0, day=None):
+        """ Records the visitor of a url visit record, and the visit on the url along with `visits` more visits of
+        its total. Url and day of the visit record are read when not given, day is the partition key of visit and
+        visitor rows.
+        """
+        visitor_remote_address = normalize_ip(meta['REMOTE_ADDR'])
         visitor_user_agent = meta['HTTP_USER_AGENT'] if "HTTP_USER_AGENT" in meta else "N/A"
+        now = visited_at or datetime.datetime.now()
         try:
-            visitor = UrlVisitors.fetch(url_visit_id=visit, remote_address=visitor_remote_address)
-        except(UrlVisitors.DoesNotExist, UrlVisitors.MultipleObjectsReturned) as error:
-            if isinstance(error, UrlVisitors.MultipleObjectsReturned):
-                raise URLException("More than 1 visitor for the same url marked")
-            else:
-                visitor = UrlVisitors.create(False, url_visit_id=visit, remote_address=visitor_remote_address, user_agent=visitor_user_agent)
-        visitor.visits += 1
-        visitor.last_visit = datetime.datetime.now()
-        visitor.save()
-        try:
-            Url.update_last_visit(visitor.url_visit.url_id, visitor_remote_address)
-        except (Url.DoesNotExist, Url.MultipleObjectsReturned) as error:
+            with transaction.atomic():
+                if url_id is None or day is None:
+                    url_id, day = UrlVisits.objects.values_list("url_id", "date").get(id=visit)
+                visitor, created = None, False
+                if UrlVisitors.rows_kept():
+                    visitor, created = UrlVisitors.add_visits(visit, day, visitor_remote_address, visitor_user_agent,
+                                                              1, now)
+                UrlVisits.add_visitors(url_id, visit, day, [visitor_remote_address])
+                new_visitor = created and UrlVisitors.counts_new_visitors() and \
+                    UrlVisitors.is_new_to_url(url_id, visitor_remote_address, visit)
+                Url.update_last_visit(url_id, visitor_remote_address, now, int(new_visitor), visits)
+        except (Url.DoesNotExist, Url.MultipleObjectsReturned, UrlVisits.DoesNotExist) as error:
             raise URLException(error)
         return visitor
+
+
+class ShortUrlSequence(models.Model):
+    length = models.PositiveSmallIntegerField(unique=True)
+    next_value = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return "{}: {}".format(self.length, self.next_value)
+
+    @staticmethod
+    def allocate(length, size, capacity):
+        """ Reserves a block of at most `size` sequence numbers for short urls of the given length. Returns (start, end)
+        of the reserved block or None when all `capacity` numbers of this length are already taken.
+        """
+        with transaction.atomic():
+            sequence, created = ShortUrlSequence.objects.select_for_update().get_or_create(length=length)
+            if sequence.next_value >= capacity:
+                return None
+            end = min(sequence.next_value + size, capacity)
+            ShortUrlSequence.objects.filter(id=sequence.id).update(next_value=end)
+        return sequence.next_value, end
@@ -0,0 +1,84 @@
+import binascii
+import socket
+
+from django.core.exceptions import ValidationError
+from django.db import NotSupportedError
+from django.db.models import GenericIPAddressField, Lookup
+from django.utils.ipv6 import clean_ipv6_address
+
+from shortenurls.exceptions import URLException
+
+
+def normalize_ip(value):
+    """ Returns the canonical form of an IPv4 or IPv6 address, None for anything that isn't an address"""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return socket.inet_ntop(socket.AF_INET, socket.inet_pton(socket.AF_INET, value))
+    except (socket.error, ValueError):
+        pass
+    try:
+        return clean_ipv6_address(value)
+    except ValidationError:
+        return None
+
+
+def _packed(address):
+    """ Returns (address family, packed address) of a normalized address"""
+    family = socket.AF_INET6 if ":" in address else socket.AF_INET
+    return family, socket.inet_pton(family, address)
+
+
+class Network(object):
+    """ IPv4 or IPv6 network given in CIDR notation, host bits of the address are cleared"""
+
+    def __init__(self, cidr):
+        address, _, prefix = cidr.strip().partition("/")
+        address = normalize_ip(address)
+        if address is None:
+            raise URLException("Invalid network address")
+        self.family, packed = _packed(address)
+        self.bits = len(packed) * 8
+        try:
+            self.prefix = int(prefix) if prefix else self.bits
+        except ValueError:
+            raise URLException("Invalid network prefix")
+        if not 0 <= self.prefix <= self.bits:
+            raise URLException("Invalid network prefix")
+        self.mask = ((1 << self.bits) - 1) ^ ((1 << (self.bits - self.prefix)) - 1)
+        self.network = self._to_int(packed) & self.mask
+
+    @staticmethod
+    def _to_int(packed):
+        return int(binascii.hexlify(packed), 16)
+
+    @property
+    def cidr(self):
+        packed = binascii.unhexlify("{:0{}x}".format(self.network, self.bits // 4))
+        return "{}/{}".format(socket.inet_ntop(self.family, packed), self.prefix)
+
+    def __contains__(self, address):
+        address = normalize_ip(address)
+        if address is None:
+            return False
+        family, packed = _packed(address)
+        return family == self.family and self._to_int(packed) & self.mask == self.network
+
+    def __str__(self):
+        return self.cidr
+
+
+@GenericIPAddressField.register_lookup
+class NetContainedOrEqual(Lookup):
+    """ `field__net_contained_or_equal=cidr` matches addresses within the network, with PostgreSQL's inet <<= operator
+    which GiST indexes with inet_ops serve.
+    """
+    lookup_name = "net_contained_or_equal"
+
+    def as_sql(self, compiler, connection):
+        if connection.vendor != "postgresql":
+            raise NotSupportedError("Network lookups require PostgreSQL")
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return "{} <<= {}::inet".format(lhs, rhs), lhs_params + rhs_params
@@ -0,0 +1,169 @@
+import datetime
+import hashlib
+import re
+
+from django.db import connection, transaction
+
+from shortenurls.helpers import bucket_start, next_bucket
+from shortenurls.models import Url, UrlVisits, UrlVisitors
+
+# PostgreSQL 11 is the first to support primary keys and foreign keys on partitioned tables
+MIN_SERVER_VERSION = 110000
+
+re_partition_bound = re.compile(r"FROM \((.+?)\) TO \((.+?)\)")
+re_index_method = re.compile(r" USING (.+)$")
+
+
+def partitioned_tables():
+    """ Returns (model, unique columns, [(foreign key column, referenced model)]) of tables partitioned by date. The
+    partition key has to be part of every unique constraint, so visitors are partitioned by the day of their visit
+    record rather than by first visit.
+    """
+    return [
+        (UrlVisits, ("url_id", "date"), [("url_id", Url)]),
+        (UrlVisitors, ("url_visit_id", "remote_address", "date"), []),
+    ]
+
+
+def partition_name(table, month):
+    return "{}_p{}".format(table, month.strftime("%Y%m"))
+
+
+def legacy_name(table):
+    return "{}_legacy".format(table)
+
+
+def default_name(table):
+    return "{}_default".format(table)
+
+
+def monthly_ranges(start, end):
+    """ Returns (first day, first day of the next month) of months from the one `start` falls into up to the one
+    `end` falls into.
+    """
+    month = bucket_start(start, "month")
+    ranges = []
+    while month <= end:
+        ranges.append((month, next_bucket(month, "month")))
+        month = next_bucket(month, "month")
+    return ranges
+
+
+def _parse_bound(value):
+    if value == "MINVALUE":
+        return None
+    return datetime.datetime.strptime(value.strip("'"), "%Y-%m-%d").date()
+
+
+def is_partitioned(table):
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s))", [table])
+        return cursor.fetchone()[0]
+
+
+def partitions(table):
+    """ Returns [(name, lower bound, upper bound)] of partitions of the table ordered by upper bound, lower bound of
+    the legacy partition is None. The default partition has no bounds and isn't listed.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i "
+                       "JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = %s::regclass", [table])
+        rows = cursor.fetchall()
+    result = []
+    for name, bound in rows:
+        match = re_partition_bound.search(bound)
+        if match:
+            result.append((name, _parse_bound(match.group(1)), _parse_bound(match.group(2))))
+    return sorted(result, key=lambda partition: partition[2])
+
+
+def copy_indexes(source, table):
+    """ Creates indexes of the source table not backing a constraint on the partitioned table, PostgreSQL creates them
+    on every partition and adopts the equivalent index of an existing table when it is attached. Returns the number of
+    created indexes.
+    """
+    quote = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_get_indexdef(i.indexrelid) FROM pg_index i WHERE i.indrelid = %s::regclass "
+                       "AND NOT i.indisunique AND NOT EXISTS (SELECT 1 FROM pg_constraint c "
+                       "WHERE c.conindid = i.indexrelid) ORDER BY i.indexrelid", [source])
+        definitions = [row[0] for row in cursor.fetchall()]
+        for definition in definitions:
+            method = re_index_method.search(definition).group(1)
+            name = "{}_{}_idx".format(table[:40], hashlib.md5(method.encode("utf-8")).hexdigest()[:8])
+            cursor.execute("CREATE INDEX {} ON {} USING {}".format(quote(name), quote(table), method))
+    return len(definitions)
+
+
+def convert_tables():
+    """ Turns visit and visitor tables into tables partitioned by month. Existing tables are attached as legacy
+    partitions holding everything up to the end of the current month, so no rows are copied. A default partition
+    takes rows of months having no partition yet, so writes never fail for a missing partition. Secondary indexes of
+    the existing tables are created on the partitioned ones, so every partition gets them. Returns the upper bound of
+    the legacy partitions.
+    """
+    quote = connection.ops.quote_name
+    visits_table, visitors_table = UrlVisits._meta.db_table, UrlVisitors._meta.db_table
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute("SELECT GREATEST(CURRENT_DATE, (SELECT MAX(date) FROM {}), (SELECT MAX(date) FROM {}))"
+                       .format(quote(visits_table), quote(visitors_table)))
+        boundary = next_bucket(bucket_start(cursor.fetchone()[0], "month"), "month")
+        # Foreign keys can't reference a partitioned table without the partition key
+        cursor.execute("SELECT conname FROM pg_constraint WHERE contype = 'f' AND conrelid = %s::regclass "
+                       "AND confrelid = %s::regclass", [visitors_table, visits_table])
+        for constraint, in cursor.fetchall():
+            cursor.execute("ALTER TABLE {} DROP CONSTRAINT {}".format(quote(visitors_table), quote(constraint)))
+        for model, unique, foreign_keys in partitioned_tables():
+            table = model._meta.db_table
+            legacy = legacy_name(table)
+            cursor.execute("ALTER TABLE {} RENAME TO {}".format(quote(table), quote(legacy)))
+            cursor.execute("CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS) PARTITION BY RANGE (date)"
+                           .format(quote(table), quote(legacy)))
+            cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [legacy])
+            cursor.execute("ALTER SEQUENCE {} OWNED BY {}.id".format(cursor.fetchone()[0], quote(table)))
+            cursor.execute("ALTER TABLE {} ADD PRIMARY KEY (id, date)".format(quote(table)))
+            cursor.execute("ALTER TABLE {} ADD CONSTRAINT {} UNIQUE ({})".format(
+                quote(table), quote("{}_partition_uniq".format(table)), ", ".join(quote(column) for column in unique)))
+            for column, referenced in foreign_keys:
+                cursor.execute("ALTER TABLE {} ADD FOREIGN KEY ({}) REFERENCES {} (id) DEFERRABLE INITIALLY DEFERRED"
+                               .format(quote(table), quote(column), quote(referenced._meta.db_table)))
+            copy_indexes(legacy, table)
+            # A valid check constraint spares the full table scan of attaching
+            cursor.execute("ALTER TABLE {} ADD CONSTRAINT {} CHECK (date IS NOT NULL AND date < %s)".format(
+                quote(legacy), quote("{}_date_check".format(legacy))), [boundary])
+            cursor.execute("ALTER TABLE {} ATTACH PARTITION {} FOR VALUES FROM (MINVALUE) TO (%s)".format(
+                quote(table), quote(legacy)), [boundary])
+            cursor.execute("CREATE TABLE {} PARTITION OF {} DEFAULT".format(quote(default_name(table)), quote(table)))
+    return boundary
+
+
+def create_partitions(table, until):
+    """ Creates monthly partitions of the table following the last one, up to the month `until` falls into. Rows of
+    those months which landed in the default partition are moved into the new partition before it is attached.
+    Returns names of created partitions.
+    """
+    quote = connection.ops.quote_name
+    existing = partitions(table)
+    start = existing[-1][2] if existing else bucket_start(datetime.date.today(), "month")
+    default = default_name(table)
+    created = []
+    with connection.cursor() as cursor:
+        for lower, upper in monthly_ranges(start, until):
+            name = partition_name(table, lower)
+            with transaction.atomic():
+                cursor.execute("CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS)".format(quote(name), quote(table)))
+                cursor.execute("WITH moved AS (DELETE FROM {} WHERE date >= %s AND date < %s RETURNING *) "
+                               "INSERT INTO {} SELECT * FROM moved".format(quote(default), quote(name)), [lower, upper])
+                cursor.execute("ALTER TABLE {} ATTACH PARTITION {} FOR VALUES FROM (%s) TO (%s)".format(
+                    quote(table), quote(name)), [lower, upper])
+            created.append(name)
+    return created
+
+
+def remove_partition(table, name, drop=True):
+    """ Detaches the partition from the table, and drops it unless drop is False"""
+    quote = connection.ops.quote_name
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute("ALTER TABLE {} DETACH PARTITION {}".format(quote(table), quote(name)))
+        if drop:
+            cursor.execute("DROP TABLE {}".format(quote(name)))
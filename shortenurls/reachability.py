@@ -0,0 +1,57 @@
+import hashlib
+
+import requests
+from django.conf import settings
+from django.utils.six.moves.urllib.parse import urlparse
+from requests import RequestException
+from requests.adapters import HTTPAdapter
+
+from shortenurls.const import REACHABLE_URL_MEMCACHE_KEY, UNREACHABLE_HOST_MEMCACHE_KEY, URL_CHECK_TIMEOUT, \
+    URL_CHECK_CACHE_TTL, URL_CHECK_FAILURE_TTL, URL_CHECK_POOL_SIZE
+from shortenurls.helpers import get_memcached_values, set_memcache
+
+# Servers answering HEAD with one of these don't implement it, reachability is then checked with a GET
+HEAD_NOT_SUPPORTED = (405, 501)
+
+
+def _build_session():
+    pool_size = getattr(settings, "URL_CHECK_POOL_SIZE", URL_CHECK_POOL_SIZE)
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+session = _build_session()
+
+
+def _key(template, value):
+    # Memcache keys are limited in length and can't contain whitespace
+    return template.format(hashlib.sha1(value.encode("utf-8")).hexdigest())
+
+
+def check_reachability(url):
+    """ Checks that provided URL answers to HTTP requests. Raises RequestException if it doesn't. Only headers are
+    requested (HEAD, or a streamed GET the body of which is never read), both results are cached: reachable URLs
+    by URL, connection failures by host since every URL of a dead host fails the same way.
+    """
+    timeout = getattr(settings, "URL_CHECK_TIMEOUT", URL_CHECK_TIMEOUT)
+    host = urlparse(url).netloc
+    url_key = _key(REACHABLE_URL_MEMCACHE_KEY, url)
+    host_key = _key(UNREACHABLE_HOST_MEMCACHE_KEY, host)
+    cached = get_memcached_values(url_key, host_key)
+    if url_key in cached:
+        return
+    if host_key in cached:
+        raise RequestException("Host {} is not reachable: {}".format(host, cached[host_key]))
+    try:
+        response = session.head(url, timeout=timeout, allow_redirects=True)
+        if response.status_code in HEAD_NOT_SUPPORTED:
+            response = session.get(url, timeout=timeout, allow_redirects=True, stream=True)
+            response.close()
+    except (requests.ConnectionError, requests.Timeout) as error:
+        if host:
+            set_memcache(host_key, str(error)[:200], getattr(settings, "URL_CHECK_FAILURE_TTL", URL_CHECK_FAILURE_TTL))
+        raise
+    set_memcache(url_key, True, getattr(settings, "URL_CHECK_CACHE_TTL", URL_CHECK_CACHE_TTL))
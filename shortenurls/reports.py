@@ -0,0 +1,124 @@
+import datetime
+from itertools import islice
+
+from django.conf import settings
+
+from shortenurls.const import DATE_FORMAT, REPORT_CHUNK_SIZE, REPORT_MAX_DAYS, REPORT_PERCENTILES, REPORT_TOP_URLS
+from shortenurls.exceptions import URLException
+from shortenurls.models import UrlVisits
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def reports_available():
+    return numpy is not None
+
+
+def default_range():
+    """ Returns (from date, to date) of the last seven full days"""
+    to_date = datetime.date.today() - datetime.timedelta(days=1)
+    return to_date - datetime.timedelta(days=6), to_date
+
+
+def load_visits(from_date, to_date, chunk_size=None):
+    """ Loads visit records between from_date and to_date into (url ids, days since from_date, visits) arrays. Rows
+    are read chunk_size at a time, so only one chunk of them is held as Python objects.
+    """
+    chunk_size = chunk_size or getattr(settings, "REPORT_CHUNK_SIZE", REPORT_CHUNK_SIZE)
+    rows = UrlVisits.objects.filter(date__gte=from_date, date__lte=to_date).order_by() \
+        .values_list("url_id", "date", "visits").iterator()
+    start = numpy.datetime64(from_date, "D")
+    url_ids, days, visits = [numpy.empty(0, dtype=numpy.int64)], [numpy.empty(0, dtype=numpy.int64)], \
+        [numpy.empty(0, dtype=numpy.int64)]
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        chunk_url_ids, chunk_dates, chunk_visits = zip(*chunk)
+        url_ids.append(numpy.array(chunk_url_ids, dtype=numpy.int64))
+        days.append((numpy.array(chunk_dates, dtype="datetime64[D]") - start).astype(numpy.int64))
+        visits.append(numpy.array(chunk_visits, dtype=numpy.int64))
+    return numpy.concatenate(url_ids), numpy.concatenate(days), numpy.concatenate(visits)
+
+
+def _growth(current, previous):
+    return round(float(current - previous) / previous, 4) if previous else None
+
+
+def _distribution(totals):
+    """ Share of visits going to the top 1% and 10% of urls, and Gini coefficient of visits across urls"""
+    if not totals.size or not totals.sum():
+        return {"top1Percent": 0.0, "top10Percent": 0.0, "gini": 0.0}
+    ascending = numpy.sort(totals).astype(numpy.float64)
+    shares = numpy.cumsum(ascending[::-1]) / ascending.sum()
+    ranks = numpy.arange(1, ascending.size + 1)
+    gini = 2 * (ranks * ascending).sum() / (ascending.size * ascending.sum()) - (ascending.size + 1.0) / ascending.size
+    return {
+        "top1Percent": round(float(shares[max(int(numpy.ceil(ascending.size * 0.01)) - 1, 0)]), 4),
+        "top10Percent": round(float(shares[max(int(numpy.ceil(ascending.size * 0.1)) - 1, 0)]), 4),
+        "gini": round(float(gini), 4),
+    }
+
+
+def visits_report(from_date, to_date, top=REPORT_TOP_URLS):
+    """ Builds the visits report of days between from_date and to_date: visits per day with running totals,
+    percentiles and distribution of visits across visited urls, growth over the previous period of the same length,
+    and daily visits of the most visited urls. Visit records of both periods are loaded into arrays once and
+    everything is computed with vectorised grouping, so reports take seconds over tens of millions of records.
+    Periods are limited to REPORT_MAX_DAYS days.
+    """
+    if from_date > to_date:
+        raise URLException("from_date is after to_date")
+    if top < 0:
+        raise URLException("top can't be negative")
+    period = (to_date - from_date).days + 1
+    max_days = getattr(settings, "REPORT_MAX_DAYS", REPORT_MAX_DAYS)
+    if period > max_days:
+        raise URLException("Reports cover at most {} days".format(max_days))
+    try:
+        previous_from_date = from_date - datetime.timedelta(days=period)
+    except OverflowError:
+        raise URLException("from_date is out of range")
+    if numpy is None:
+        raise URLException("Reports require numpy")
+    url_ids, days, visits = load_visits(previous_from_date, to_date)
+    # Days of the previous period become negative
+    days -= period
+    current = days >= 0
+    ids, index = numpy.unique(url_ids, return_inverse=True)
+    totals = numpy.bincount(index[current], weights=visits[current], minlength=ids.size).astype(numpy.int64)
+    previous = numpy.bincount(index[~current], weights=visits[~current], minlength=ids.size).astype(numpy.int64)
+    daily = numpy.bincount(days[current], weights=visits[current], minlength=period).astype(numpy.int64)
+    cumulative = numpy.cumsum(daily)
+    visited = totals[totals > 0]
+    percentiles = numpy.percentile(visited, REPORT_PERCENTILES) if visited.size else [0] * len(REPORT_PERCENTILES)
+
+    # Daily visits of top urls, grouped by (position among top urls, day) in a single pass
+    order = numpy.argsort(-totals, kind="mergesort")[:top]
+    order = order[totals[order] > 0]
+    position = numpy.full(ids.size, -1, dtype=numpy.int64)
+    position[order] = numpy.arange(order.size)
+    rows = current & (position[index] >= 0)
+    top_daily = numpy.bincount(position[index[rows]] * period + days[rows], weights=visits[rows],
+                               minlength=order.size * period).astype(numpy.int64).reshape(order.size, period)
+
+    total, previous_total = int(totals.sum()), int(previous.sum())
+    return {
+        "fromDate": datetime.date.strftime(from_date, DATE_FORMAT),
+        "toDate": datetime.date.strftime(to_date, DATE_FORMAT),
+        "visits": total,
+        "previousVisits": previous_total,
+        "growth": _growth(total, previous_total),
+        "visitedUrls": int(visited.size),
+        "daily": [{"date": datetime.date.strftime(from_date + datetime.timedelta(days=day), DATE_FORMAT),
+                   "visits": int(daily[day]), "cumulative": int(cumulative[day])} for day in range(period)],
+        "percentiles": dict((str(percentile), round(float(value), 2))
+                            for percentile, value in zip(REPORT_PERCENTILES, percentiles)),
+        "distribution": _distribution(visited),
+        "top": [{"id": int(ids[url]), "visits": int(totals[url]), "previousVisits": int(previous[url]),
+                 "growth": _growth(int(totals[url]), int(previous[url])), "daily": top_daily[rank].tolist()}
+                for rank, url in enumerate(order)],
+    }
@@ -0,0 +1,62 @@
+import hashlib
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+
+from shortenurls.const import RESPONSE_CACHE_KEY, RESPONSE_CACHE_TTL, RESPONSE_CACHE_WAIT
+
+
+def response_cache_key(request, name, kwargs, version):
+    """ Cache key of a response. Query parameters are normalized so their order doesn't matter, and the host is part of
+    the key since responses contain absolute short urls.
+    """
+    params = sorted((key, sorted(values)) for key, values in request.GET.lists())
+    parts = [name, sorted(kwargs.items()), params, request.scheme, request.get_host(), version]
+    return RESPONSE_CACHE_KEY.format(hashlib.md5(repr(parts).encode("utf-8")).hexdigest())
+
+
+def _cached_response(entry):
+    response = HttpResponse(entry['content'], status=entry['status'])
+    for header, value in entry['headers']:
+        response[header] = value
+    return response
+
+
+def cache_response(version):
+    """ Caches successful responses of the view for RESPONSE_CACHE_TTL seconds. `version` is called with the view's
+    arguments and is part of the cache key, so changing the version invalidates cached responses. An identical request
+    arriving while a response is computed waits RESPONSE_CACHE_WAIT seconds once and uses that response if it is
+    cached by then, otherwise it computes the response too rather than holding the worker any longer. Streamed
+    exports are never cached.
+    """
+    def decorator(view):
+        @wraps(view)
+        def inner(request, *args, **kwargs):
+            ttl = getattr(settings, "RESPONSE_CACHE_TTL", RESPONSE_CACHE_TTL)
+            if ttl <= 0 or request.method not in ("GET", "HEAD") or "format" in request.GET:
+                return view(request, *args, **kwargs)
+            key = response_cache_key(request, view.__name__, kwargs, version(request, *args, **kwargs))
+            lock_key = key + ":lock"
+            entry = cache.get(key)
+            if entry is not None:
+                return _cached_response(entry)
+            if not cache.add(lock_key, True, ttl):
+                # Identical request is computing the response
+                time.sleep(getattr(settings, "RESPONSE_CACHE_WAIT", RESPONSE_CACHE_WAIT))
+                entry = cache.get(key)
+                if entry is not None:
+                    return _cached_response(entry)
+                return view(request, *args, **kwargs)
+            try:
+                response = view(request, *args, **kwargs)
+                if response.status_code == 200 and not response.streaming:
+                    cache.set(key, {"status": response.status_code, "content": response.content,
+                                    "headers": list(response.items())}, ttl)
+            finally:
+                cache.delete(lock_key)
+            return response
+        return inner
+    return decorator
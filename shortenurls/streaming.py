@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import csv
+import json
+
+from django.http import StreamingHttpResponse
+from django.utils import six
+from django.utils.encoding import force_bytes
+
+from shortenurls.const import STREAM_BATCH_SIZE
+
+CONTENT_TYPES = {
+    "json": "application/json",
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv; charset=utf-8",
+}
+
+
+class Echo(object):
+    """ File-like object handing back whatever csv writer writes to it, so rows can be yielded one by one"""
+
+    def write(self, value):
+        return value
+
+
+def batched(chunks, size=STREAM_BATCH_SIZE):
+    """ Joins every `size` chunks into one, each chunk sent separately would mean a write call per row"""
+    batch = []
+    for chunk in chunks:
+        batch.append(chunk)
+        if len(batch) >= size:
+            yield "".join(batch)
+            batch = []
+    if batch:
+        yield "".join(batch)
+
+
+def json_array(rows):
+    yield "["
+    separator = ""
+    for row in rows:
+        yield separator + json.dumps(row)
+        separator = ","
+    yield "]"
+
+
+def ndjson_lines(rows):
+    for row in rows:
+        yield json.dumps(row) + "\n"
+
+
+def csv_lines(rows, fields):
+    writer = csv.writer(Echo())
+
+    def encode(value):
+        value = "" if value is None else value
+        return force_bytes(value) if six.PY2 else value
+
+    line = writer.writerow([encode(field) for field in fields])
+    yield line.decode("utf-8") if six.PY2 else line
+    for row in rows:
+        line = writer.writerow([encode(row.get(field)) for field in fields])
+        yield line.decode("utf-8") if six.PY2 else line
+
+
+def stream_response(rows, output_format, fields, filename):
+    """ Returns StreamingHttpResponse writing rows (an iterable of dicts, ideally backed by a queryset iterator) as
+    JSON array, NDJSON or CSV of given fields, without ever holding the whole result in memory.
+    """
+    if output_format == "csv":
+        chunks = csv_lines(rows, fields)
+    elif output_format == "ndjson":
+        chunks = ndjson_lines(rows)
+    else:
+        chunks = json_array(rows)
+    response = StreamingHttpResponse(batched(chunks), content_type=CONTENT_TYPES[output_format])
+    if output_format == "csv":
+        response['Content-Disposition'] = 'attachment; filename="{}.csv"'.format(filename)
+    return response
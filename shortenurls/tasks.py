@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from background_task import background
+
+from shortenurls.models import Url
+from shortenurls.visits import apply_visit_events
+
+
+@background(schedule=0)
+def flush_visit_events(events):
+    """ Applies a batch of buffered visit events. Scheduled by VisitBuffer, executed by process_tasks worker."""
+    apply_visit_events(events)
+
+
+@background(schedule=0)
+def verify_url(url_id):
+    """ Checks reachability of a url shortened without verification and marks it accordingly."""
+    Url.verify(url_id)
@@ -1,21 +1,50 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import base64
 import datetime
 import json
+import os
+import tempfile
+import time
+from unittest import skipIf, skipUnless
 
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
-from django.test import TestCase
-from django.utils import timezone
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import six, timezone
 from requests import RequestException
 
-from models import Url, UrlVisits, UrlVisitors
+from background_task.models import Task
+from dealini.wsgi import ShortUrlDispatcher
+from models import Url, UrlVisits, UrlVisitors, ShortUrlSequence, UserAgent
+from shortenurls.bloom import BloomFilter, ShortUrlFilter
+from shortenurls.codes import MAX_SEQUENCE_VALUE, ShortUrlGenerator, encode, is_usable
+from shortenurls.const import SHORT_URL_MAX_LENGTH
 from shortenurls.exceptions import URLException
+from shortenurls.helpers import LocalCache, bump_url_versions, get_data_version, get_url_version, short_url_cache, \
+    user_agent_cache
+from shortenurls.hll import HyperLogLog, merge_sketch, update_sketch
+from shortenurls.hot import SpaceSaving, hot_urls
+from shortenurls.networks import Network, normalize_ip
+from shortenurls import partitions
+from shortenurls.partitions import monthly_ranges
+from shortenurls.reachability import check_reachability
+from shortenurls.reports import reports_available, visits_report
+from shortenurls.response_cache import response_cache_key
+from shortenurls.useragents import parse_user_agent
+from shortenurls.visits import VisitBuffer, VisitWorker, apply_visit_events, coalesce_visit_events
 from django.core.urlresolvers import reverse
 
 
 class UrlModelTest(TestCase):
     def setUp(self):
+        cache.clear()
+        short_url_cache.clear()
+        hot_urls.clear()
         self.url1 = Url.create(original_url="testing", shorten_url="1", last_visit_from="me")
         self.url2 = Url.create(original_url="http://testing2", shorten_url="tstng2", last_visit_from="me")
         self.url3 = Url.create(original_url="https://www.football-italia.net/", shorten_url="daaf1", last_visit_from="127.0.0.1")
@@ -48,7 +77,7 @@ class UrlModelTest(TestCase):
         except (ValidationError, RequestException) as error:
             exception = error.message
         self.assertIsNotNone(exception)
-        self.assertIn("Failed to establish a new connection", exception.message)
+        self.assertIn("Enter a valid URL.", exception)
 
     def test_valid_url(self):
         exception = None
@@ -62,6 +91,18 @@ class UrlModelTest(TestCase):
         exist = Url.short_url_exist(self.url1.shorten_url)
         self.assertTrue(exist)
 
+    def test_duplicated_short_url_rejected(self):
+        with self.assertRaises(IntegrityError):
+            Url.create(original_url="http://testing3", shorten_url=self.url3.shorten_url)
+
+    def test_fetch_by_original_url(self):
+        self.assertEqual(self.url3.original_url_hash, Url.hash_url(self.url3.original_url))
+        self.assertEqual(Url.fetch_by_original_url(self.url3.original_url), self.url3)
+        self.assertEqual(Url.fetch_by_original_urls([self.url3.original_url, "http://dummy"]),
+                         {self.url3.original_url: self.url3})
+        with self.assertRaises(Url.DoesNotExist):
+            Url.fetch_by_original_url("http://dummy")
+
     def test_not_duplicated_short_url(self):
         exist = Url.short_url_exist("dummy")
         self.assertFalse(exist)
@@ -84,10 +125,32 @@ class UrlModelTest(TestCase):
         self.assertIsNotNone(exception)
         self.assertIn("not found", exception)
 
+    def test_missing_short_url_cached(self):
+        with self.assertRaises(URLException):
+            Url.check_short_url("miss1")
+        with self.assertNumQueries(0):
+            with self.assertRaises(URLException):
+                Url.check_short_url("miss1")
+        Url.create(original_url="http://testing3", shorten_url="miss1")
+        self.assertEqual(Url.check_short_url("miss1").original_url, "http://testing3")
+
     def test_correct_short_url(self):
         url = Url.check_short_url(self.url3.shorten_url)
         self.assertEqual(url, self.url3)
 
+    def test_short_url_served_from_local_cache(self):
+        # Admitted to the local cache on second hit
+        Url.check_short_url(self.url3.shorten_url)
+        self.assertIsNone(short_url_cache.get(self.url3.shorten_url))
+        Url.check_short_url(self.url3.shorten_url)
+        short_url_cache.clear()
+        Url.check_short_url(self.url3.shorten_url)
+        with self.assertNumQueries(0):
+            url = Url.check_short_url(self.url3.shorten_url)
+        self.assertEqual(url, self.url3)
+        self.assertEqual(url.original_url, self.url3.original_url)
+        self.assertEqual(short_url_cache.stats()['hits'], 1)
+
     def test_json_response(self):
         resp = self.url3.json("testhost:8080", True)
         self.assertEqual(resp['id'], self.url3.id)
@@ -96,6 +159,44 @@ class UrlModelTest(TestCase):
         for param in json_params:
             self.assertIn(param, resp)
 
+    def test_fetch_all_visits_aggregated_in_one_query(self):
+        now = datetime.datetime.now()
+        UrlVisits.add_visits(self.url3.id, self.visit1.date, 3, now, "1.1.1.1")
+        UrlVisits.add_visits(self.url3.id, datetime.date(2018, 4, 1), 2, now, "1.1.1.1")
+        UrlVisits.add_visits(self.url2.id, datetime.date.today(), 1, now, "1.1.1.1")
+        # Totals are kept by Url.update_last_visit, which would also change the last visit compared below
+        Url.objects.filter(id=self.url3.id).update(total_visits=5)
+        Url.objects.filter(id=self.url2.id).update(total_visits=1)
+        with self.assertNumQueries(1):
+            urls = Url.fetch_all("testhost:8080", order_by=["id"])
+        self.assertEqual([url['visits'] for url in urls], [0, 1, 5])
+        self.assertEqual(urls[2], dict(self.url3.json("testhost:8080", False), visits=5,
+                                                       uniqueVisitors=0))
+        urls = Url.fetch_all("testhost:8080", order_by=["id"], visits_from=["01/04/2018"], visits_to=["01/04/2018"])
+        self.assertEqual([url['visits'] for url in urls], [0, 0, 2])
+        self.assertEqual(len(Url.fetch_all("testhost:8080", results=["2"])), 2)
+
+    @override_settings(URL_MAX_PAGE_SIZE=2)
+    def test_fetch_page_follows_cursor(self):
+        ids = sorted([self.url1.id, self.url2.id, self.url3.id])
+        # Equal creation times are ordered by id
+        Url.objects.update(created=datetime.datetime(2018, 4, 1, 12, 0))
+        for sort_key, expected in (("created", ids), ("-created", ids[::-1]), ("-id", ids[::-1])):
+            urls, cursor = Url.fetch_page("testhost:8080", order_by=[sort_key], results=["10"])
+            self.assertEqual(len(urls), 2)
+            self.assertIsNotNone(cursor)
+            next_urls, next_cursor = Url.fetch_page("testhost:8080", order_by=[sort_key], cursor=[cursor])
+            self.assertEqual([url['id'] for url in urls + next_urls], expected)
+            self.assertIsNone(next_cursor)
+        with self.assertRaises(URLException):
+            Url.fetch_page("testhost:8080", order_by=["created"], cursor=[cursor])
+        with self.assertRaises(URLException):
+            Url.fetch_page("testhost:8080", cursor=["not a cursor"])
+        with self.assertRaises(URLException):
+            Url.fetch_page("testhost:8080", cursor=[base64.urlsafe_b64encode(b'{"id": 1}').decode("ascii")])
+        with self.assertRaises(URLException):
+            Url.fetch_page("testhost:8080", order_by=["original_url"])
+
     def test_all_visits_of_url(self):
         visits = Url.get_all_visits(self.url3)
         self.assertIn(self.visit1.json(), visits)
@@ -114,8 +215,7 @@ class UrlVisitsModelTest(TestCase):
         self.url = Url.create(original_url="https://www.football-italia.net/", shorten_url="daaf1", last_visit_from="127.0.0.1")
         self.visit1 = UrlVisits.create(url_id=self.url.id)
         self.visit2 = UrlVisits.create(save=False, url_id=self.url.id)
-        self.visit3 = UrlVisits.create(url_id=self.url.id)
-        # self.visit3 = UrlVisits.create(url_id=self.url.id)
+        self.visit3 = UrlVisits.create(url_id=self.url.id, date=datetime.date.today() - datetime.timedelta(days=1))
         self.url_to_test = "https://google.com"
 
     def test_creating_with_save(self):
@@ -159,13 +259,24 @@ class UrlVisitsModelTest(TestCase):
         self.assertEqual(visit.last_visit_from, "1.2.3.4")
         self.assertLess(visit.last_visit_at, datetime.datetime.now())
 
+    def test_mark_visit_increments_existing_record(self):
+        UrlVisits.mark_visit(self.url.id, "1.2.3.4")
+        visit = UrlVisits.mark_visit(self.url.id, "1.2.3.5")
+        self.assertEqual(visit.id, self.visit1.id)
+        self.assertEqual(UrlVisits.fetch(id=self.visit1.id).visits, 2)
+        self.assertEqual(UrlVisits.fetch(id=self.visit1.id).last_visit_from, "1.2.3.5")
+
+    def test_duplicated_visit_date(self):
+        with self.assertRaises(IntegrityError):
+            UrlVisits.create(url_id=self.url.id)
+
     def test_json_response(self):
         resp = self.visit1.json()
         json_params = ['id', 'visits', 'created', 'lastVisitAt', 'lastIP']
         for param in json_params:
             self.assertIn(param, resp)
         self.assertEqual(resp['id'], self.visit1.id)
-        self.assertEqual(resp['lastIP'], "")
+        self.assertIsNone(resp['lastIP'])
         self.assertEqual(resp['lastVisitAt'], None)
 
     def test_getting_url(self):
@@ -199,7 +310,6 @@ class UrlVisitorModelTest(TestCase):
         self.visit = UrlVisits.create(url_id=self.url.id)
         self.visitor = UrlVisitors.create(url_visit=self.visit, remote_address="1.1.1.1")
         self.visitor2 = UrlVisitors.create(save=False, url_visit=self.visit)
-        self.visitor3 = UrlVisitors.create(url_visit=self.visit, remote_address="1.1.1.1")
 
     def test_creating_with_save(self):
         self.assertIn(self.visitor, UrlVisitors.fetch(single=False, url_visit=self.visit))
@@ -233,13 +343,16 @@ class UrlVisitorModelTest(TestCase):
 
     def test_mark_visitor_with_same_remote_address(self):
         meta = {"REMOTE_ADDR": "1.1.1.1", "HTTP_USER_AGENT": "Chrome"}
-        exception = None
-        try:
-            visitor = UrlVisitors.mark_visitor(meta, self.visit.id)
-        except Exception as error:
-            exception = error.message
-        self.assertIsNotNone(exception)
-        self.assertIn("More than 1", exception)
+        UrlVisitors.mark_visitor(meta, self.visit.id)
+        visitor = UrlVisitors.mark_visitor(meta, self.visit.id, self.url.id)
+        self.assertEqual(visitor.id, self.visitor.id)
+        self.assertEqual(visitor.visits, 2)
+        self.assertEqual(UrlVisitors.fetch(id=self.visitor.id).visits, 2)
+        self.assertEqual(UrlVisitors.fetch(single=False, url_visit=self.visit).count(), 1)
+
+    def test_duplicated_visitor(self):
+        with self.assertRaises(IntegrityError):
+            UrlVisitors.create(url_visit=self.visit, remote_address="1.1.1.1")
 
     def test_mark_visitor(self):
         meta = {"REMOTE_ADDR": "1.1.1.2", "HTTP_USER_AGENT": "Chrome"}
@@ -265,3 +378,840 @@ class UrlVisitorModelTest(TestCase):
         self.assertEqual(resp['lastVisit'], None)
         self.assertEqual(resp['lastVisit'], self.visitor.last_visit)
 
+
+class VisitBufferTest(TestCase):
+    def setUp(self):
+        user_agent_cache.clear()
+        self.url = Url.create(original_url="https://www.football-italia.net/", shorten_url="daaf1", last_visit_from="127.0.0.1")
+        now = 1522872000
+        self.events = [
+            [self.url.id, "1.1.1.1", "Chrome", now],
+            [self.url.id, "1.1.1.1", "Chrome", now + 10],
+            [self.url.id, "1.1.1.2", "Firefox", now + 20],
+        ]
+
+    def test_coalesce_events(self):
+        visits, visitors, urls = coalesce_visit_events(self.events)
+        self.assertEqual(len(visits), 1)
+        self.assertEqual(list(visits.values())[0]['visits'], 3)
+        self.assertEqual(list(visits.values())[0]['last_visit_from'], "1.1.1.2")
+        self.assertEqual(len(visitors), 2)
+        self.assertEqual(urls[self.url.id][1], "1.1.1.2")
+
+    def test_apply_events(self):
+        apply_visit_events(self.events)
+        apply_visit_events(self.events)
+        visit = UrlVisits.fetch(url_id=self.url.id)
+        self.assertEqual(visit.visits, 6)
+        self.assertEqual(visit.date, datetime.date.fromtimestamp(self.events[0][3]))
+        visitor = UrlVisitors.fetch(url_visit=visit, remote_address="1.1.1.1")
+        self.assertEqual(visitor.visits, 4)
+        self.assertEqual(visit.unique_visitors, 2)
+        url = Url.fetch(id=self.url.id)
+        self.assertEqual(url.last_visit_from, "1.1.1.2")
+        self.assertEqual((url.total_visits, url.unique_visitors), (6, 2))
+
+    def test_rebuild_visit_totals(self):
+        apply_visit_events(self.events)
+        # Visitor returning on another day is not a new unique visitor of the url
+        apply_visit_events([[self.url.id, "1.1.1.1", "Chrome", self.events[0][3] + 86400]])
+        url = Url.fetch(id=self.url.id)
+        self.assertEqual((url.total_visits, url.unique_visitors), (4, 2))
+        Url.objects.update(total_visits=0, unique_visitors=0)
+        UrlVisits.objects.update(unique_visitors=0)
+        call_command("rebuild_visit_totals", chunk_size=1, stdout=six.StringIO())
+        url = Url.fetch(id=self.url.id)
+        self.assertEqual((url.total_visits, url.unique_visitors), (4, 2))
+        self.assertEqual(sorted(UrlVisits.fetch(single=False).values_list("unique_visitors", flat=True)), [1, 2])
+
+    @override_settings(VISITOR_RETENTION_DAYS=30)
+    def test_compact_visits(self):
+        apply_visit_events(self.events)
+        apply_visit_events([[self.url.id, "1.1.1.1", "Chrome", self.events[0][3] + 86400]])
+        call_command("compact_visits", chunk_size=1, sleep=0, fold_months_after=30, stdout=six.StringIO())
+        self.assertFalse(UrlVisitors.objects.exists())
+        url = Url.fetch(id=self.url.id)
+        self.assertEqual((url.total_visits, url.unique_visitors), (4, 2))
+        visit = UrlVisits.fetch(url_id=self.url.id)
+        self.assertEqual((visit.date, visit.visits, visit.unique_visitors), (datetime.date(2018, 4, 1), 4, 2))
+        # Returning visitor is recognized by the url sketch once its rows are gone
+        apply_visit_events([[self.url.id, "1.1.1.2", "Firefox", self.events[0][3] + 86400 * 40]])
+        call_command("rebuild_visit_totals", stdout=six.StringIO())
+        url = Url.fetch(id=self.url.id)
+        self.assertEqual((url.total_visits, url.unique_visitors), (5, 2))
+        self.assertEqual(sorted(UrlVisits.fetch(single=False).values_list("unique_visitors", flat=True)), [1, 2])
+
+    def test_compact_visits_requires_retention_setting(self):
+        apply_visit_events(self.events)
+        with self.assertRaises(CommandError):
+            call_command("compact_visits", days=30, sleep=0, stdout=six.StringIO())
+        self.assertTrue(UrlVisitors.objects.exists())
+
+    def test_partition_visits(self):
+        apply_visit_events(self.events)
+        self.assertEqual(set(UrlVisitors.objects.values_list("date", flat=True)),
+                         {datetime.date.fromtimestamp(self.events[0][3])})
+        self.assertEqual(monthly_ranges(datetime.date(2018, 11, 15), datetime.date(2019, 1, 1)),
+                         [(datetime.date(2018, 11, 1), datetime.date(2018, 12, 1)),
+                          (datetime.date(2018, 12, 1), datetime.date(2019, 1, 1)),
+                          (datetime.date(2019, 1, 1), datetime.date(2019, 2, 1))])
+        if connection.vendor != "postgresql":
+            with self.assertRaises(CommandError):
+                call_command("partition_visits", stdout=six.StringIO())
+
+    @skipUnless(connection.vendor == "postgresql" and connection.pg_version >= partitions.MIN_SERVER_VERSION,
+                "partitioning requires PostgreSQL 11")
+    def test_partitioned_visit_writes(self):
+        apply_visit_events(self.events)
+        call_command("partition_visits", convert=True, months_ahead=1, stdout=six.StringIO())
+        visits_table = UrlVisits._meta.db_table
+        self.assertTrue(partitions.is_partitioned(visits_table))
+        self.assertEqual(partitions.partitions(visits_table)[0][0], partitions.legacy_name(visits_table))
+        # Rows of months without a partition land in the default one, until their partition is created
+        day = datetime.date.today() + datetime.timedelta(days=400)
+        timestamp = int(time.mktime(day.timetuple())) + 3600
+        apply_visit_events([[self.url.id, "1.1.1.1", "Chrome", timestamp]] * 2)
+        visit = UrlVisits.fetch(url_id=self.url.id, date=day)
+        UrlVisitors.mark_visitor({"REMOTE_ADDR": "1.1.1.2"}, visit.id)
+
+        def partition_of(model):
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT DISTINCT tableoid::regclass::text FROM {} WHERE date = %s".format(
+                    connection.ops.quote_name(model._meta.db_table)), [day])
+                return [row[0] for row in cursor.fetchall()]
+        for model in (UrlVisits, UrlVisitors):
+            self.assertEqual(partition_of(model), [partitions.default_name(model._meta.db_table)])
+            partitions.create_partitions(model._meta.db_table, day)
+            self.assertEqual(partition_of(model), [partitions.partition_name(model._meta.db_table, day)])
+        # Secondary indexes of the original tables cover new partitions too
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT indexdef FROM pg_indexes WHERE tablename = %s",
+                           [partitions.partition_name(UrlVisitors._meta.db_table, day)])
+            definitions = [row[0] for row in cursor.fetchall()]
+        self.assertTrue(any("gist" in definition and "remote_address" in definition for definition in definitions))
+        self.assertTrue(any("(agent_id)" in definition for definition in definitions))
+        self.assertEqual(UrlVisits.fetch(id=visit.id).visits, 2)
+        self.assertEqual(UrlVisits.fetch(id=visit.id).unique_visitors, 2)
+        self.assertEqual(UrlVisitors.objects.filter(url_visit_id=visit.id).count(), 2)
+
+    def test_apply_events_of_deleted_url(self):
+        self.assertEqual(apply_visit_events([[self.url.id + 100, "1.1.1.1", "Chrome", 1522872000]]), 0)
+
+    def test_buffer_dispatches_when_full(self):
+        buffer = VisitBuffer(size=2, interval=3600, timer=False)
+        self.assertEqual(buffer.add(self.url.id, "1.1.1.1", "Chrome"), 0)
+        self.assertEqual(buffer.add(self.url.id, "1.1.1.1", "Chrome"), 2)
+        self.assertEqual(len(buffer), 0)
+        self.assertEqual(Task.objects.filter(task_name="shortenurls.tasks.flush_visit_events").count(), 1)
+
+    def test_visit_worker_queue(self):
+        worker = VisitWorker(1, background=False)
+        meta = {"REMOTE_ADDR": "1.1.1.1", "HTTP_USER_AGENT": "Chrome"}
+        self.assertTrue(worker.submit(self.url.id, meta))
+        self.assertFalse(worker.submit(self.url.id, meta))
+        worker.drain()
+        visit = UrlVisits.fetch(url_id=self.url.id)
+        self.assertEqual(visit.visits, 1)
+        visitor = UrlVisitors.fetch(remote_address="1.1.1.1")
+        self.assertEqual(visitor.agent.user_agent, "Chrome")
+        # Visit time is taken once, when the visit is queued
+        self.assertEqual(visitor.last_visit, visit.last_visit_at)
+        self.assertEqual(Url.fetch(id=self.url.id).last_visit_at, visit.last_visit_at)
+        self.assertEqual(Url.fetch(id=self.url.id).total_visits, 1)
+
+    def test_buffer_flush(self):
+        buffer = VisitBuffer(size=100, interval=3600, timer=False)
+        buffer.add(self.url.id, "1.1.1.1", "Chrome")
+        self.assertEqual(buffer.flush(), 1)
+        self.assertEqual(buffer.flush(), 0)
+
+    def test_buffer_flush_expired(self):
+        buffer = VisitBuffer(size=100, interval=5, timer=False)
+        buffer.add(self.url.id, "1.1.1.1", "Chrome", timestamp=1000)
+        self.assertEqual(buffer.flush_expired(now=1004), 0)
+        self.assertEqual(buffer.flush_expired(now=1005), 1)
+        self.assertEqual(len(buffer), 0)
+        self.assertEqual(buffer.flush_expired(now=2000), 0)
+
+
+class LocalCacheTest(TestCase):
+    def test_hit_and_miss(self):
+        local_cache = LocalCache(2, 60)
+        self.assertIsNone(local_cache.get("a"))
+        local_cache.set("a", (1, "http://a"))
+        self.assertEqual(local_cache.get("a"), (1, "http://a"))
+        self.assertEqual(local_cache.stats()['hits'], 1)
+        self.assertEqual(local_cache.stats()['misses'], 1)
+
+    def test_least_recently_used_evicted(self):
+        local_cache = LocalCache(2, 60)
+        local_cache.set("a", 1)
+        local_cache.set("b", 2)
+        local_cache.get("a")
+        local_cache.set("c", 3)
+        self.assertIsNone(local_cache.get("b"))
+        self.assertEqual(local_cache.get("a"), 1)
+        self.assertEqual(local_cache.stats()['evictions'], 1)
+
+    def test_expired_entry(self):
+        local_cache = LocalCache(2, -1)
+        local_cache.set("a", 1)
+        self.assertIsNone(local_cache.get("a"))
+
+    def test_disabled_cache(self):
+        local_cache = LocalCache(0, 60)
+        local_cache.set("a", 1)
+        self.assertIsNone(local_cache.get("a"))
+
+
+class BloomFilterTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.url = Url.create(original_url="https://www.football-italia.net/", shorten_url="daaf1", last_visit_from="127.0.0.1")
+
+    def test_membership(self):
+        bloom = BloomFilter(100, 0.01)
+        for i in range(100):
+            bloom.add("code{}".format(i))
+        for i in range(100):
+            self.assertIn("code{}".format(i), bloom)
+        false_positives = len([i for i in range(1000) if "other{}".format(i) in bloom])
+        self.assertLess(false_positives, 50)
+
+    @override_settings(SHORT_URL_BLOOM_FILTER=True)
+    def test_short_url_filter(self):
+        short_url_filter = ShortUrlFilter(100, 0.01)
+        self.assertTrue(short_url_filter.might_exist(self.url.shorten_url))
+        with self.assertNumQueries(0):
+            self.assertFalse(short_url_filter.might_exist("dummy"))
+
+    @override_settings(SHORT_URL_BLOOM_FILTER=True)
+    def test_short_url_filter_sees_urls_created_elsewhere(self):
+        short_url_filter = ShortUrlFilter(100, 0.01)
+        short_url_filter.build()
+        # Url.create bumps the shared generation, filter of this "process" must pick the url up
+        Url.create(original_url="http://testing2", shorten_url="tstng")
+        self.assertTrue(short_url_filter.might_exist("tstng"))
+
+    @override_settings(SHORT_URL_BLOOM_FILTER=False)
+    def test_disabled_short_url_filter(self):
+        self.assertTrue(ShortUrlFilter(100, 0.01).might_exist("dummy"))
+
+
+class ShortUrlDispatcherTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        short_url_cache.clear()
+        self.url = Url.create(original_url="https://www.football-italia.net/", shorten_url="daaf1", last_visit_from="127.0.0.1")
+        self.fallback_calls = []
+        self.dispatcher = ShortUrlDispatcher(self.fallback)
+
+    def fallback(self, environ, start_response):
+        self.fallback_calls.append(environ['PATH_INFO'])
+        start_response('200 OK', [])
+        return [b'django']
+
+    def call(self, path, method='GET'):
+        environ = {'PATH_INFO': path, 'REQUEST_METHOD': method, 'REMOTE_ADDR': '1.1.1.1', 'HTTP_USER_AGENT': 'Chrome'}
+        response = {}
+
+        def start_response(status, headers):
+            response['status'] = status
+            response['headers'] = dict(headers)
+        response['body'] = b''.join(self.dispatcher(environ, start_response))
+        return response
+
+    def test_redirect(self):
+        response = self.call("/url/daaf1")
+        self.assertEqual(response['status'], '301 Moved Permanently')
+        self.assertEqual(response['headers']['Location'], self.url.original_url)
+        self.assertEqual(self.fallback_calls, [])
+        self.assertEqual(UrlVisits.fetch(url_id=self.url.id).visits, 1)
+        self.assertEqual(Url.fetch(id=self.url.id).last_visit_from, "1.1.1.1")
+
+    def test_other_requests_fall_through(self):
+        self.call("/url/all")
+        self.call("/url/daaf1", method='POST')
+        self.call("/url/dummy")
+        self.assertEqual(self.fallback_calls, ["/url/all", "/url/daaf1", "/url/dummy"])
+
+
+class ReachabilityTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.url = Url.create(original_url="http://unreachable.invalid/", shorten_url="daaf1", last_visit_from="127.0.0.1")
+
+    def test_unreachable_host_cached(self):
+        with self.assertRaises(RequestException):
+            check_reachability("http://unreachable.invalid/")
+        exception = None
+        try:
+            check_reachability("http://unreachable.invalid/other")
+        except RequestException as error:
+            exception = str(error)
+        self.assertIsNotNone(exception)
+        self.assertIn("is not reachable", exception)
+
+    def test_verify_unreachable_url(self):
+        self.assertFalse(Url.verify(self.url.id))
+        self.assertFalse(Url.fetch(id=self.url.id).verified)
+        self.assertIsNone(Url.verify(self.url.id + 100))
+
+    @override_settings(URL_VERIFICATION="deferred")
+    def test_deferred_verification(self):
+        resp = self.client.post(reverse("generate_url"), data=json.dumps({"url": "http://unreachable.invalid/path"}), content_type="application/json")
+        self.assertEqual(resp.status_code, 201)
+        url = Url.fetch(original_url="http://unreachable.invalid/path")
+        self.assertIsNone(url.verified)
+        self.assertEqual(Task.objects.filter(task_name="shortenurls.tasks.verify_url").count(), 1)
+
+    @override_settings(URL_VERIFICATION="deferred")
+    def test_deferred_verification_checks_syntax(self):
+        for url in ("??", "http://exa mple"):
+            resp = self.client.post(reverse("generate_url"), data=json.dumps({"url": url}), content_type="application/json")
+            self.assertEqual(resp.status_code, 400)
+        self.assertFalse(Task.objects.filter(task_name="shortenurls.tasks.verify_url").exists())
+
+
+class ShortUrlGeneratorTest(TestCase):
+    def test_encode_is_bijective(self):
+        codes = set(encode(number, 2) for number in range(62 ** 2))
+        self.assertEqual(len(codes), 62 ** 2)
+        self.assertTrue(all(len(code) == 2 for code in codes))
+
+    def test_legacy_and_reserved_short_urls_skipped(self):
+        self.assertFalse(is_usable("daaf1"))
+        self.assertFalse(is_usable("create"))
+        self.assertFalse(is_usable("visitors"))
+        self.assertFalse(is_usable("report"))
+        self.assertTrue(is_usable("dAaf1"))
+
+    def test_generator_reserves_blocks(self):
+        generator = ShortUrlGenerator(5, 10)
+        other_process = ShortUrlGenerator(5, 10)
+        codes = generator.take(15) + other_process.take(15)
+        self.assertEqual(len(set(codes)), 30)
+        self.assertEqual(ShortUrlSequence.objects.get(length=5).next_value, 40)
+
+    def test_create_retries_imported_short_url(self):
+        generator = ShortUrlGenerator(5, 10)
+        self.assertEqual(generator.next(), encode(1, 5))
+        # Imported after the block was reserved
+        Url.create(original_url="http://imported.invalid/", shorten_url=encode(2, 5))
+        url = generator.create(lambda short_urls: Url.create(original_url="http://new.invalid/",
+                                                             shorten_url=short_urls[0]), 1)
+        self.assertEqual(url.shorten_url, encode(3, 5))
+
+    def test_discard_imported_short_urls(self):
+        generator = ShortUrlGenerator(5, 10)
+        generator.next()
+        generator.discard([encode(2, 5)])
+        self.assertEqual(generator.next(), encode(3, 5))
+
+    def test_longest_short_urls_fit_sequence(self):
+        self.assertLessEqual(62 ** SHORT_URL_MAX_LENGTH, MAX_SEQUENCE_VALUE)
+        self.assertGreater(62 ** (SHORT_URL_MAX_LENGTH + 1), MAX_SEQUENCE_VALUE)
+
+    def test_generator_grows_length(self):
+        ShortUrlSequence.objects.create(length=5, next_value=62 ** 5 - 1)
+        codes = ShortUrlGenerator(5, 10).take(2)
+        self.assertEqual(len(codes[-1]), 6)
+
+    def test_long_short_url_route(self):
+        url = Url.create(original_url="https://www.football-italia.net/", shorten_url="a1B2c3D4", last_visit_from="127.0.0.1")
+        resp = self.client.get(reverse("retrieve_url", kwargs={"url": url.shorten_url}))
+        self.assertEqual(resp.status_code, 301)
+        self.assertEqual(reverse("generate_url"), "/url/create")
+
+
+@override_settings(URL_VERIFICATION="deferred")
+class BulkShortenTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.url = Url.create(original_url="http://existing.invalid/", shorten_url="daaf1", last_visit_from="127.0.0.1")
+
+    def post(self, data):
+        return self.client.post(reverse("bulk_generate_urls"), data=json.dumps(data), content_type="application/json")
+
+    def test_bulk_shorten(self):
+        resp = self.post(["new.invalid/1", "http://existing.invalid/", 5, "http://new.invalid/1", "http://new.invalid/2"])
+        self.assertEqual(resp.status_code, 200)
+        results = json.loads(resp.content.decode("utf-8"))
+        self.assertEqual(len(results), 5)
+        self.assertEqual(results[0]['url'], "new.invalid/1")
+        self.assertTrue(results[0]['created'])
+        self.assertEqual(results[0]['shortenUrl'], results[3]['shortenUrl'])
+        self.assertFalse(results[1]['created'])
+        self.assertTrue(results[1]['shortenUrl'].endswith("/url/daaf1"))
+        self.assertIn("error", results[2])
+        self.assertEqual(Url.fetch(single=False).count(), 3)
+        self.assertEqual(Task.objects.filter(task_name="shortenurls.tasks.verify_url").count(), 2)
+        self.assertEqual(cache.get("original-url:http://new.invalid/2").original_url, "http://new.invalid/2")
+
+    def test_invalid_payload(self):
+        self.assertEqual(self.post({"url": "http://new.invalid/"}).status_code, 400)
+
+    def test_bulk_shorten_invalid_urls(self):
+        resp = self.post(["not a url at all", "??", "http://exa mple", "http://new.invalid/4"])
+        self.assertEqual(resp.status_code, 200)
+        results = json.loads(resp.content.decode("utf-8"))
+        self.assertEqual([result['error'] for result in results[:3]], ["Enter a valid URL."] * 3)
+        self.assertTrue(results[3]['created'])
+        self.assertEqual(Url.fetch(single=False).count(), 2)
+
+    @override_settings(URL_VERIFICATION="sync")
+    def test_bulk_shorten_always_deferred(self):
+        results = json.loads(self.post(["http://new.invalid/3"]).content.decode("utf-8"))
+        self.assertTrue(results[0]['created'])
+        self.assertIsNone(Url.fetch(original_url="http://new.invalid/3").verified)
+        self.assertEqual(Task.objects.filter(task_name="shortenurls.tasks.verify_url").count(), 1)
+
+    @override_settings(BULK_SHORTEN_LIMIT=1)
+    def test_too_many_urls(self):
+        self.assertEqual(self.post(["http://new.invalid/1", "http://new.invalid/2"]).status_code, 400)
+
+
+class ImportUrlsCommandTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.url = Url.create(original_url="http://existing.invalid/", shorten_url="daaf1", last_visit_from="127.0.0.1")
+
+    def import_file(self, content, suffix):
+        handle, path = tempfile.mkstemp(suffix=suffix)
+        with os.fdopen(handle, "wb") as import_file:
+            import_file.write(content.encode("utf-8"))
+        try:
+            call_command("import_urls", path, chunk_size=2, stdout=six.StringIO(), stderr=six.StringIO())
+        finally:
+            os.remove(path)
+
+    def test_import_csv(self):
+        self.import_file("original_url,short_url,created\n"
+                         "http://legacy.invalid/1,Legacy1,2017-01-02\n"
+                         "legacy.invalid/2,,2017-01-03 10:00:00\n"
+                         "http://existing.invalid/,,\n"
+                         "http://legacy.invalid/3,daaf1,\n"
+                         "not a url,,\n"
+                         "http://legacy.invalid/1,Legacy1,2017-01-02\n", ".csv")
+        self.assertEqual(Url.fetch(single=False).count(), 3)
+        url = Url.fetch(shorten_url="Legacy1")
+        self.assertEqual(url.original_url, "http://legacy.invalid/1")
+        self.assertEqual(url.created.date(), datetime.date(2017, 1, 2))
+        self.assertEqual(Url.fetch_by_original_url("http://legacy.invalid/2").created.year, 2017)
+        self.assertEqual(cache.get("short_url:Legacy1").original_url, "http://legacy.invalid/1")
+        # Cached urls don't carry visitor sketches
+        self.assertIn("visitors_sketch", Url.fetch_by_original_url("http://legacy.invalid/2").get_deferred_fields())
+
+    def test_import_ndjson(self):
+        self.import_file('{"original_url": "http://legacy.invalid/1", "short_url": "Legacy1"}\n'
+                         '{"original_url": "http://legacy.invalid/2"}\n', ".ndjson")
+        self.assertEqual(Url.fetch(single=False).count(), 3)
+        self.assertEqual(Url.check_short_url("Legacy1").original_url, "http://legacy.invalid/1")
+
+
+class StreamingExportTest(TestCase):
+    def setUp(self):
+        user_agent_cache.clear()
+        self.url = Url.create(original_url="https://www.football-italia.net/", shorten_url="daaf1", last_visit_from="127.0.0.1")
+        self.url2 = Url.create(original_url="http://testing2", shorten_url="tstng2", last_visit_from="127.0.0.1")
+        self.visit = UrlVisits.add_visits(self.url.id, datetime.date.today(), 2, datetime.datetime.now(), "1.1.1.1")
+        UrlVisitors.add_visits(self.visit.id, self.visit.date, "1.1.1.1", "Chrome, Linux", 2, datetime.datetime.now())
+        Url.update_last_visit(self.url.id, "1.1.1.1", datetime.datetime.now(), 1, visits=2)
+
+    def get(self, name, **params):
+        kwargs = {"pk": self.url.id} if name != "urls_list" else {}
+        resp = self.client.get(reverse(name, kwargs=kwargs), params, HTTP_HOST="testserver")
+        self.assertTrue(resp.streaming)
+        return resp, b"".join(resp.streaming_content).decode("utf-8")
+
+    def test_json_array(self):
+        resp, content = self.get("urls_list", format="json", order_by="id")
+        self.assertEqual(resp['Content-Type'], "application/json")
+        urls = json.loads(content)
+        self.assertEqual([url['id'] for url in urls], [self.url.id, self.url2.id])
+        self.assertEqual(urls[0]['visits'], 2)
+
+    def test_ndjson(self):
+        resp, content = self.get("url_visits", format="ndjson")
+        lines = content.splitlines()
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(json.loads(lines[0]), UrlVisits.fetch(id=self.visit.id).json())
+
+    def test_csv(self):
+        resp, content = self.get("url_visitors", format="csv")
+        self.assertIn("attachment", resp['Content-Disposition'])
+        lines = content.splitlines()
+        self.assertEqual(lines[0], "id,ip,userAgent,browser,os,device,visits,firstVisit,lastVisit")
+        visitor = UrlVisitors.fetch(remote_address="1.1.1.1").json()
+        self.assertTrue(lines[1].endswith(',1.1.1.1,"Chrome, Linux",Chrome,Linux,desktop,2,{},{}'.format(
+            visitor['firstVisit'], visitor['lastVisit'])))
+
+    def test_invalid_parameters(self):
+        self.assertEqual(self.client.get(reverse("urls_list"), {"format": "xml"}).status_code, 400)
+        self.assertEqual(self.client.get(reverse("urls_list"), {"format": "csv", "order_by": "original_url"},
+                                         HTTP_HOST="testserver").status_code, 400)
+
+
+class VisitHistoryTest(TestCase):
+    def setUp(self):
+        self.url = Url.create(original_url="https://www.football-italia.net/", shorten_url="daaf1", last_visit_from="127.0.0.1")
+        now = datetime.datetime.now()
+        for day, visits in ((datetime.date(2018, 1, 30), 1), (datetime.date(2018, 2, 1), 2), (datetime.date(2018, 2, 5), 4)):
+            UrlVisits.add_visits(self.url.id, day, visits, now, "1.1.1.1")
+
+    def test_history_buckets(self):
+        days = UrlVisits.history(self.url.id, "day", datetime.date(2018, 1, 30), datetime.date(2018, 2, 2))
+        self.assertEqual(list(days.values()), [1, 0, 2, 0])
+        weeks = UrlVisits.history(self.url.id, "week", datetime.date(2018, 1, 30), datetime.date(2018, 2, 11))
+        self.assertEqual(list(weeks.items()), [(datetime.date(2018, 1, 29), 3), (datetime.date(2018, 2, 5), 4)])
+        with self.assertNumQueries(1):
+            months = UrlVisits.history(self.url.id, "month", datetime.date(2017, 12, 15), datetime.date(2018, 3, 1))
+        self.assertEqual(list(months.values()), [0, 1, 6, 0])
+
+    def test_history_endpoint(self):
+        resp = self.client.get(reverse("url_history", kwargs={"pk": self.url.id}),
+                               {"bucket": "month", "from_date": "01/01/2018", "to_date": "28/02/2018"})
+        self.assertEqual(resp.status_code, 200)
+        history = json.loads(resp.content.decode("utf-8"))
+        self.assertEqual(history['visits'], [{"start": "01/01/2018", "visits": 1}, {"start": "01/02/2018", "visits": 6}])
+        self.assertEqual(self.client.get(reverse("url_history", kwargs={"pk": self.url.id}),
+                                         {"bucket": "hour"}).status_code, 400)
+        self.assertEqual(self.client.get(reverse("url_history", kwargs={"pk": self.url.id + 1})).status_code, 404)
+
+
+class HyperLogLogTest(TestCase):
+    def setUp(self):
+        self.url = Url.create(original_url="https://www.football-italia.net/", shorten_url="daaf1", last_visit_from="127.0.0.1")
+        self.events = [[self.url.id, "10.0.0.{}".format(i % 50), "Chrome", 1522872000 + i] for i in range(200)]
+        self.events += [[self.url.id, "10.0.1.{}".format(i), "Chrome", 1522872000 + 86400] for i in range(30)]
+
+    def test_estimate_and_merge(self):
+        first, second = HyperLogLog(), HyperLogLog()
+        for i in range(5000):
+            first.add("10.0.{}.{}".format(i // 256, i % 256))
+            second.add("10.1.{}.{}".format(i // 256, i % 256))
+        self.assertAlmostEqual(first.count(), 5000, delta=250)
+        first.merge(second)
+        self.assertAlmostEqual(first.count(), 10000, delta=500)
+        self.assertEqual(HyperLogLog(first.to_bytes()).count(), first.count())
+        self.assertEqual(HyperLogLog().count(), 0)
+
+    def test_update_sketch_writes_only_changes(self):
+        self.assertIsNotNone(update_sketch(Url, self.url.id, "visitors_sketch", ["1.1.1.1"]))
+        with CaptureQueriesContext(connection) as queries:
+            self.assertIsNone(update_sketch(Url, self.url.id, "visitors_sketch", ["1.1.1.1"]))
+        self.assertFalse([query for query in queries.captured_queries if query['sql'].startswith("UPDATE")])
+        self.assertEqual(HyperLogLog(Url.fetch(id=self.url.id).visitors_sketch).count(), 1)
+
+    def test_merge_sketch_keeps_stored_registers(self):
+        update_sketch(Url, self.url.id, "visitors_sketch", ["1.1.1.1"])
+        sketch = HyperLogLog()
+        sketch.add("1.1.1.2")
+        self.assertEqual(merge_sketch(Url, self.url.id, "visitors_sketch", sketch, count_field="unique_visitors").count(), 2)
+        self.assertEqual(Url.fetch(id=self.url.id).unique_visitors, 2)
+        self.assertIsNone(merge_sketch(Url, self.url.id + 100, "visitors_sketch", sketch))
+
+    def test_sketches_along_visitor_rows(self):
+        apply_visit_events(self.events)
+        day = datetime.date.fromtimestamp(self.events[0][3])
+        # Sketches are estimates, counts kept along visitor rows are exact
+        self.assertAlmostEqual(UrlVisits.unique_visitors_between(self.url.id, day, day), 50, delta=2)
+        self.assertAlmostEqual(UrlVisits.unique_visitors_between(self.url.id, day, day + datetime.timedelta(days=1)),
+                               80, delta=2)
+        self.assertEqual(Url.fetch(id=self.url.id).unique_visitors, 80)
+
+    @override_settings(KEEP_VISITOR_ROWS=False)
+    def test_without_visitor_rows(self):
+        apply_visit_events(self.events)
+        UrlVisitors.mark_visitor({"REMOTE_ADDR": "10.0.2.1"}, UrlVisits.fetch(single=False).first().id, self.url.id)
+        self.assertEqual(UrlVisitors.fetch(single=False).count(), 0)
+        url = Url.fetch(id=self.url.id)
+        self.assertEqual(url.total_visits, 230)
+        self.assertAlmostEqual(url.unique_visitors, 81, delta=2)
+        day_counts = sorted(UrlVisits.fetch(single=False).values_list("unique_visitors", flat=True))
+        self.assertAlmostEqual(day_counts[0], 30, delta=2)
+        self.assertAlmostEqual(day_counts[1], 51, delta=2)
+        Url.objects.update(unique_visitors=0)
+        call_command("rebuild_visit_totals", stdout=six.StringIO())
+        self.assertEqual(Url.fetch(id=self.url.id).unique_visitors, url.unique_visitors)
+
+
+class HotUrlsTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        hot_urls.clear()
+        self.url = Url.create(original_url="https://www.football-italia.net/", shorten_url="daaf1", last_visit_from="127.0.0.1")
+        self.url2 = Url.create(original_url="http://testing2", shorten_url="tstng2", last_visit_from="127.0.0.1")
+
+    def test_space_saving(self):
+        summary = SpaceSaving(2)
+        for key in ["a", "a", "a", "b", "c", "a"]:
+            summary.offer(key)
+        self.assertEqual(summary.top(1), [("a", [4, 0])])
+        self.assertEqual(summary.count("c"), 2)
+        other = SpaceSaving(2, {"b": [5, 0]})
+        summary.merge(other)
+        self.assertEqual([key for key, counter in summary.top(2)], ["b", "a"])
+
+    def test_space_saving_evicts_least_counted(self):
+        summary = SpaceSaving(2)
+        for key in ["a", "b", "c", "b", "b", "b"]:
+            summary.offer(key)
+        # b was counted after its heap entry was pushed, c is the least counted one
+        summary.offer("d")
+        self.assertEqual(summary.counters, {"b": [4, 0], "d": [3, 2]})
+
+    def test_top_endpoint(self):
+        for _ in range(3):
+            self.client.get(reverse("retrieve_url", kwargs={"url": self.url2.shorten_url}))
+        self.client.get(reverse("retrieve_url", kwargs={"url": self.url.shorten_url}))
+        resp = self.client.get(reverse("top_urls"), {"window": "hour", "results": 5})
+        top = json.loads(resp.content.decode("utf-8"))
+        self.assertEqual([(url['id'], url['visits']) for url in top], [(self.url2.id, 3), (self.url.id, 1)])
+        # Counts are merged through the cache
+        hot_urls.clear()
+        top = json.loads(self.client.get(reverse("top_urls")).content.decode("utf-8"))
+        self.assertEqual(top[0]['id'], self.url2.id)
+        self.assertEqual(self.client.get(reverse("top_urls"), {"window": "week"}).status_code, 400)
+        self.assertEqual(self.client.get(reverse("top_urls"), {"results": 0}).status_code, 400)
+        self.assertEqual(self.client.get(reverse("top_urls"), {"results": -3}).status_code, 400)
+
+
+class ConditionalGetTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.url = Url.create(original_url="https://www.football-italia.net/", shorten_url="daaf1", last_visit_from="127.0.0.1")
+
+    def get(self, name, etag=None, **kwargs):
+        headers = {"HTTP_HOST": "testserver"}
+        if etag is not None:
+            headers['HTTP_IF_NONE_MATCH'] = etag
+        return self.client.get(reverse(name, kwargs=kwargs), **headers)
+
+    def test_visits_not_modified_until_visited(self):
+        resp = self.get("url_visits", pk=self.url.id)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("Last-Modified", resp)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.get("url_visits", resp['ETag'], pk=self.url.id).status_code, 304)
+        self.client.get(reverse("retrieve_url", kwargs={"url": self.url.shorten_url}))
+        self.assertEqual(self.get("url_visits", resp['ETag'], pk=self.url.id).status_code, 200)
+        self.assertEqual(self.get("url_visitors", pk=self.url.id + 1).status_code, 200)
+
+    def test_compaction_changes_visits_etag(self):
+        resp = self.get("url_visits", pk=self.url.id)
+        bump_url_versions(self.url.id)
+        self.assertEqual(self.get("url_visits", resp['ETag'], pk=self.url.id).status_code, 200)
+
+    def test_visits_leave_versions_alone(self):
+        data_version, url_version = get_data_version(), get_url_version(self.url.id)
+        self.client.get(reverse("retrieve_url", kwargs={"url": self.url.shorten_url}))
+        self.assertEqual(get_data_version(), data_version)
+        self.assertEqual(get_url_version(self.url.id), url_version)
+
+    def test_urls_list_not_modified_until_url_created(self):
+        resp = self.get("urls_list")
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get("urls_list", resp['ETag']).status_code, 304)
+        Url.create(original_url="http://testing2", shorten_url="tstng2", last_visit_from="127.0.0.1")
+        self.assertEqual(self.get("urls_list", resp['ETag']).status_code, 200)
+
+    def test_gzip(self):
+        for i in range(10):
+            Url.create(original_url="http://testing{}".format(i), shorten_url="tstng{}".format(i))
+        resp = self.client.get(reverse("urls_list"), HTTP_HOST="testserver", HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(resp['Content-Encoding'], "gzip")
+        self.assertTrue(resp['ETag'].startswith('W/"'))
+        self.assertEqual(self.client.get(reverse("urls_list"), HTTP_HOST="testserver",
+                                         HTTP_IF_NONE_MATCH=resp['ETag']).status_code, 304)
+
+
+class ResponseCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.url = Url.create(original_url="https://www.football-italia.net/", shorten_url="daaf1", last_visit_from="127.0.0.1")
+
+    def get(self, name, params=None, **kwargs):
+        return self.client.get(reverse(name, kwargs=kwargs), params or {}, HTTP_HOST="testserver")
+
+    def test_urls_list_cached_until_url_created(self):
+        resp = self.get("urls_list", {"sort": "-created", "limit": 10})
+        with self.assertNumQueries(0):
+            cached = self.get("urls_list", {"limit": 10, "sort": "-created"})
+        self.assertEqual(cached.content, resp.content)
+        self.assertEqual(cached['Content-Type'], resp['Content-Type'])
+        Url.create(original_url="http://testing2", shorten_url="tstng2", last_visit_from="127.0.0.1")
+        self.assertEqual(len(json.loads(self.get("urls_list", {"sort": "-created", "limit": 10}).content)), 2)
+
+    def test_visits_cached_until_visited(self):
+        other = Url.create(original_url="http://testing2", shorten_url="tstng2", last_visit_from="127.0.0.1")
+        self.get("url_visits", pk=self.url.id)
+        self.get("url_visits", pk=other.id)
+        self.client.get(reverse("retrieve_url", kwargs={"url": self.url.shorten_url}))
+        visits = json.loads(self.get("url_visits", pk=self.url.id).content)
+        self.assertEqual(sum(visit['visits'] for visit in visits), 1)
+        # Visiting one url leaves cached responses of others alone
+        with self.assertNumQueries(1):
+            self.get("url_visits", pk=other.id)
+
+    @override_settings(RESPONSE_CACHE_WAIT=0)
+    def test_computed_when_identical_request_is_not_done(self):
+        request = RequestFactory().get(reverse("urls_list"), HTTP_HOST="testserver")
+        key = response_cache_key(request, str("urls_list"), {}, get_data_version())
+        cache.set(key + ":lock", True)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.get("urls_list").status_code, 200)
+        # Response computed without holding the lock is not cached
+        self.assertIsNone(cache.get(key))
+        with self.assertNumQueries(1):
+            self.get("urls_list")
+
+    @override_settings(RESPONSE_CACHE_TTL=0)
+    def test_disabled(self):
+        self.get("urls_list")
+        with self.assertNumQueries(1):
+            self.get("urls_list")
+
+
+class UserAgentTest(TestCase):
+    def setUp(self):
+        user_agent_cache.clear()
+        self.url = Url.create(original_url="https://www.football-italia.net/", shorten_url="daaf1", last_visit_from="127.0.0.1")
+
+    def test_parse(self):
+        self.assertEqual(parse_user_agent("Mozilla/5.0 (iPhone; CPU iPhone OS 11_0 like Mac OS X) AppleWebKit/604.1.38 "
+                                          "(KHTML, like Gecko) Version/11.0 Mobile/15A372 Safari/604.1"),
+                         ("Safari", "iOS", "mobile"))
+        self.assertEqual(parse_user_agent("Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like "
+                                          "Gecko) Chrome/70.0.3538.102 Safari/537.36 Edge/18.18362"),
+                         ("Edge", "Windows", "desktop"))
+        self.assertEqual(parse_user_agent("Mozilla/5.0 (Linux; Android 8.0.0; SM-T820) AppleWebKit/537.36 (KHTML, like "
+                                          "Gecko) Chrome/69.0.3497.100 Safari/537.36"),
+                         ("Chrome", "Android", "tablet"))
+        self.assertEqual(parse_user_agent("Googlebot/2.1 (+http://www.google.com/bot.html)")[2], "bot")
+        self.assertEqual(parse_user_agent("N/A"), ("Other", "Other", "other"))
+
+    def test_intern(self):
+        agent_id = UserAgent.intern("Chrome, Linux")
+        with self.assertNumQueries(0):
+            self.assertEqual(UserAgent.intern("Chrome, Linux"), agent_id)
+        user_agent_cache.clear()
+        self.assertEqual(UserAgent.intern("Chrome, Linux"), agent_id)
+        self.assertNotEqual(UserAgent.intern("Firefox"), agent_id)
+        agent = UserAgent.objects.get(id=agent_id)
+        self.assertEqual((agent.browser, agent.os, agent.device), ("Chrome", "Linux", "desktop"))
+
+    def test_visitors_share_user_agent(self):
+        apply_visit_events([[self.url.id, "1.1.1.{}".format(i), "Chrome, Linux", 1522872000] for i in range(3)])
+        self.assertEqual(UserAgent.objects.count(), 1)
+        visitors = Url.get_all_visitors(self.url.id)
+        self.assertEqual(set((visitor['userAgent'], visitor['device']) for visitor in visitors),
+                         {("Chrome, Linux", "desktop")})
+
+    def test_deleting_user_agent_keeps_visitors(self):
+        apply_visit_events([[self.url.id, "1.1.1.1", "Chrome, Linux", 1522872000]])
+        UserAgent.objects.all().delete()
+        self.assertIsNone(UrlVisitors.fetch(remote_address="1.1.1.1").agent_id)
+
+
+class IPAddressTest(TestCase):
+    def setUp(self):
+        user_agent_cache.clear()
+        self.url = Url.create(original_url="https://www.football-italia.net/", shorten_url="daaf1", last_visit_from="me")
+        self.url2 = Url.create(original_url="http://testing2", shorten_url="tstng2", last_visit_from="127.0.0.1")
+        now = 1522872000
+        apply_visit_events([[self.url.id, "10.0.0.1", "Chrome", now], [self.url.id, "10.0.1.1", "Chrome", now],
+                            [self.url.id, "2001:DB8::1", "Chrome", now], [self.url2.id, "10.0.0.2", "Chrome", now]])
+
+    def test_normalize(self):
+        self.assertIsNone(Url.create(save=False, original_url="http://testing3", shorten_url="tstng3",
+                                     last_visit_from="me").last_visit_from)
+        self.assertEqual(normalize_ip(" 10.0.0.1"), "10.0.0.1")
+        self.assertEqual(normalize_ip("2001:DB8:0:0::1"), "2001:db8::1")
+        self.assertIsNone(normalize_ip("10.0.0"))
+        self.assertEqual(UrlVisitors.objects.filter(remote_address="2001:db8::1").count(), 1)
+
+    def test_network(self):
+        network = Network("10.0.0.7/24")
+        self.assertEqual(network.cidr, "10.0.0.0/24")
+        self.assertIn("10.0.0.255", network)
+        self.assertNotIn("10.0.1.1", network)
+        self.assertNotIn("::1", network)
+        self.assertIn("2001:db8:1::5", Network("2001:db8::/32"))
+        with self.assertRaises(URLException):
+            Network("10.0.0.0/33")
+
+    def test_visitors_of_network(self):
+        resp = self.client.get(reverse("url_visitors", kwargs={"pk": self.url.id}), {"network": "10.0.0.0/16"},
+                               HTTP_HOST="testserver")
+        self.assertEqual(sorted(visitor['ip'] for visitor in json.loads(resp.content)), ["10.0.0.1", "10.0.1.1"])
+        resp = self.client.get(reverse("network_visitors"), {"network": "10.0.0.0/24"})
+        self.assertEqual(sorted((visitor['urlId'], visitor['ip']) for visitor in json.loads(resp.content)),
+                         [(self.url.id, "10.0.0.1"), (self.url2.id, "10.0.0.2")])
+        self.assertEqual(self.client.get(reverse("network_visitors"), {"network": "10.0.0"}).status_code, 400)
+        for limit in (0, -1):
+            self.assertEqual(self.client.get(reverse("network_visitors"), {"network": "10.0.0.0/24", "limit": limit})
+                             .status_code, 400)
+
+    def test_network_visitors_limit(self):
+        network = Network("10.0.0.0/8")
+        visitors = [visitor['ip'] for visitor in UrlVisitors.iter_network(network, 10)]
+        self.assertEqual(len(visitors), 3)
+        self.assertEqual([visitor['ip'] for visitor in UrlVisitors.iter_network(network, 1)], visitors[:1])
+        if connection.vendor != "postgresql":
+            # Only the most recent visitor is searched
+            latest = UrlVisitors.objects.order_by("-id").first().remote_address
+            with override_settings(NETWORK_SCAN_MAX_ROWS=1):
+                self.assertEqual([visitor['ip'] for visitor in UrlVisitors.iter_network(Network(latest), 10)],
+                                 [latest])
+                oldest = UrlVisitors.objects.order_by("id").first().remote_address
+                self.assertEqual(list(UrlVisitors.iter_network(Network(oldest), 10)), [])
+
+
+class VisitsReportTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.url = Url.create(original_url="https://www.football-italia.net/", shorten_url="daaf1", last_visit_from="127.0.0.1")
+        self.url2 = Url.create(original_url="http://testing2", shorten_url="tstng2", last_visit_from="127.0.0.1")
+        now = datetime.datetime.now()
+        for url, day, visits in ((self.url, datetime.date(2018, 4, 2), 2), (self.url, datetime.date(2018, 4, 8), 6),
+                                 (self.url, datetime.date(2018, 4, 9), 4), (self.url, datetime.date(2018, 4, 10), 6),
+                                 (self.url2, datetime.date(2018, 4, 9), 1)):
+            UrlVisits.add_visits(url.id, day, visits, now, "1.1.1.1")
+
+    @skipUnless(reports_available(), "numpy is not installed")
+    def test_report(self):
+        report = visits_report(datetime.date(2018, 4, 9), datetime.date(2018, 4, 15), top=1)
+        self.assertEqual((report['visits'], report['previousVisits'], report['growth']), (11, 8, 0.375))
+        self.assertEqual([day['visits'] for day in report['daily']], [5, 6, 0, 0, 0, 0, 0])
+        self.assertEqual(report['daily'][-1]['cumulative'], 11)
+        self.assertEqual(report['visitedUrls'], 2)
+        self.assertEqual(report['percentiles']['50'], 5.5)
+        self.assertEqual(report['distribution']['top10Percent'], round(10 / 11.0, 4))
+        self.assertEqual(report['top'], [{"id": self.url.id, "visits": 10, "previousVisits": 8, "growth": 0.25,
+                                          "daily": [4, 6, 0, 0, 0, 0, 0]}])
+        resp = self.client.get(reverse("visits_report"), {"from_date": "09/04/2018", "to_date": "15/04/2018"})
+        self.assertEqual(json.loads(resp.content)['visits'], 11)
+        self.assertEqual(self.client.get(reverse("visits_report"), {"from_date": "15/04/2018",
+                                                                    "to_date": "09/04/2018"}).status_code, 400)
+        self.assertEqual(self.client.get(reverse("visits_report"), {"from_date": "01/01/2015",
+                                                                    "to_date": "15/04/2018"}).status_code, 400)
+        self.assertEqual(self.client.get(reverse("visits_report"), {"top": "-1"}).status_code, 400)
+
+    def test_report_range(self):
+        with self.assertRaises(URLException):
+            visits_report(datetime.date(2015, 1, 1), datetime.date(2018, 4, 15))
+        with self.assertRaises(URLException):
+            visits_report(datetime.date(1, 1, 1), datetime.date(1, 1, 2))
+        with self.assertRaises(URLException):
+            visits_report(datetime.date(2018, 4, 9), datetime.date(2018, 4, 15), top=-1)
+        with self.assertRaises(CommandError):
+            call_command("visits_report", from_date="01/01/0001", to_date="01/01/0001", stdout=six.StringIO())
+        with self.assertRaises(CommandError):
+            call_command("visits_report", top=-1, stdout=six.StringIO())
+
+    @skipIf(reports_available(), "numpy is installed")
+    def test_report_requires_numpy(self):
+        self.assertEqual(self.client.get(reverse("visits_report")).status_code, 501)
+        with self.assertRaises(CommandError):
+            call_command("visits_report", stdout=six.StringIO())
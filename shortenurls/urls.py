@@ -1,12 +1,18 @@
 from django.conf.urls import url
 
 import views
+from shortenurls.const import SHORT_URL_PATTERN
 
 urlpatterns = [
-    url(r'create', views.generate_short_url, name='generate_url'),
-    url(r'(?P<pk>\d+)/visits', views.get_url_visits, name='url_visits'),
-    url(r'(?P<pk>\d+)/visitors', views.get_url_visitors, name='url_visitors'),
-    url(r'(?P<url>\w{5})$', views.get_url, name="retrieve_url"),
-    url(r'all', views.urls_list, name="urls_list"),
+    url(r'^create$', views.generate_short_url, name='generate_url'),
+    url(r'^bulk$', views.bulk_generate_short_urls, name='bulk_generate_urls'),
+    url(r'^(?P<pk>\d+)/visits$', views.get_url_visits, name='url_visits'),
+    url(r'^(?P<pk>\d+)/visitors$', views.get_url_visitors, name='url_visitors'),
+    url(r'^(?P<pk>\d+)/history$', views.get_url_history, name='url_history'),
+    url(r'^all$', views.urls_list, name="urls_list"),
+    url(r'^top$', views.top_urls, name="top_urls"),
+    url(r'^visitors$', views.network_visitors, name="network_visitors"),
+    url(r'^report$', views.get_visits_report, name="visits_report"),
+    url(r'^(?P<url>%s)$' % SHORT_URL_PATTERN, views.get_url, name="retrieve_url"),
 
 ]
\ No newline at end of file
@@ -0,0 +1,53 @@
+import re
+
+# Checked in order, first match wins. Most browsers mention the engines of the browsers they derive from, so
+# derived ones go first.
+BROWSERS = (
+    ("Edge", re.compile(r"\bEdge?/|\bEdgA/|\bEdgiOS/")),
+    ("Opera", re.compile(r"\bOPR/|\bOpera\b")),
+    ("Samsung Internet", re.compile(r"\bSamsungBrowser/")),
+    ("Chrome", re.compile(r"\bChrome\b|\bCriOS/|\bChromium/")),
+    ("Firefox", re.compile(r"\bFirefox\b|\bFxiOS/")),
+    ("Safari", re.compile(r"\bSafari/")),
+    ("Internet Explorer", re.compile(r"\bMSIE\b|\bTrident/")),
+)
+OPERATING_SYSTEMS = (
+    ("Windows", re.compile(r"\bWindows\b")),
+    ("Android", re.compile(r"\bAndroid\b")),
+    ("iOS", re.compile(r"\biPhone\b|\biPad\b|\biPod\b")),
+    ("Chrome OS", re.compile(r"\bCrOS\b")),
+    ("Mac OS", re.compile(r"\bMac OS X\b|\bMacintosh\b")),
+    ("Linux", re.compile(r"\bLinux\b")),
+)
+DESKTOP_OPERATING_SYSTEMS = ("Windows", "Chrome OS", "Mac OS", "Linux")
+re_bot = re.compile(r"bot\b|crawl|spider|slurp|\bcurl/|\bwget/|python-requests|\bHeadless", re.IGNORECASE)
+re_tablet = re.compile(r"\biPad\b|\bTablet\b")
+re_mobile = re.compile(r"\bMobi|\biPhone\b|\biPod\b|\bAndroid\b")
+
+OTHER = "Other"
+
+
+def _first_match(rules, user_agent):
+    for name, pattern in rules:
+        if pattern.search(user_agent):
+            return name
+    return OTHER
+
+
+def parse_user_agent(user_agent):
+    """ Returns (browser, operating system, device class) of a user agent string. Device class is one of bot,
+    tablet, mobile, desktop or other.
+    """
+    browser = _first_match(BROWSERS, user_agent)
+    operating_system = _first_match(OPERATING_SYSTEMS, user_agent)
+    if re_bot.search(user_agent):
+        device = "bot"
+    elif re_tablet.search(user_agent) or (operating_system == "Android" and "Mobile" not in user_agent):
+        device = "tablet"
+    elif re_mobile.search(user_agent):
+        device = "mobile"
+    elif operating_system in DESKTOP_OPERATING_SYSTEMS:
+        device = "desktop"
+    else:
+        device = "other"
+    return browser, operating_system, device
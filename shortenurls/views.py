@@ -1,29 +1,53 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import datetime
+import hashlib
 import json
 import logging
-import uuid
+import time
+from collections import OrderedDict
 
+from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.http import HttpResponse, HttpResponsePermanentRedirect
+from django.utils import six
+from django.views.decorators.http import condition
 from requests import RequestException
 
-from shortenurls.const import SHORT_URL_LENGTH, ORIGINAL_URL_MEMCACHE_KEY
+from shortenurls.codes import short_url_generator
+from shortenurls.const import ORIGINAL_URL_MEMCACHE_KEY, SHORT_URL_MEMCACHE_KEY, BULK_SHORTEN_LIMIT, DATE_FORMAT, \
+    HOT_URLS_WINDOWS, HOT_URLS_MAX_RESULTS, URL_MAX_PAGE_SIZE, REPORT_TOP_URLS, REPORT_MAX_TOP_URLS, \
+    URL_VERIFICATION, URLS_LIST_MAX_AGE
 from shortenurls.exceptions import URLException
-from shortenurls.helpers import add_to_memcache, get_memcached_value
+from shortenurls.compression import compress_page
+from shortenurls.helpers import add_to_memcache, get_memcached_value, set_many_memcache, get_data_version, \
+    get_url_version
+from shortenurls.hot import hot_urls
 from shortenurls.models import Url, UrlVisits, UrlVisitors
+from shortenurls.networks import Network
+from shortenurls.reports import default_range, reports_available, visits_report
+from shortenurls.response_cache import cache_response
+from shortenurls.streaming import CONTENT_TYPES, stream_response
+from shortenurls.tasks import verify_url
+from shortenurls.visits import record_visit
+
+# Columns of CSV exports, in order
+URL_FIELDS = ["id", "shortUrl", "redirectUrl", "created", "lastIP", "verified", "visits", "uniqueVisitors"]
+VISIT_FIELDS = ["id", "created", "visits", "uniqueVisitors", "lastVisitAt", "lastIP"]
+VISITOR_FIELDS = ["id", "ip", "userAgent", "browser", "os", "device", "visits", "firstVisit", "lastVisit"]
+NETWORK_VISITOR_FIELDS = ["urlId"] + VISITOR_FIELDS
 
 
 def generate_short_url(request):
     json_data = json.loads(request.body)
     url_to_short = json_data.get("url")
     cached = False
-    # If url doesn't contain http or https, add to the url
-    if "http" not in url_to_short:
-        url_to_short = "http://"+url_to_short
+    url_to_short = Url.normalize_url(url_to_short)
+    # In deferred mode reachability is checked by a background task once the short url is issued
+    deferred = getattr(settings, "URL_VERIFICATION", URL_VERIFICATION) == "deferred"
     try:
-        Url.check_url_validation(url_to_short)
+        Url.check_url_validation(url_to_short, reachability=not deferred)
     except (ValidationError, RequestException):
         return HttpResponse("Provided URL is not valid.", status=400)
     status_code = 200
@@ -33,7 +57,7 @@ def generate_short_url(request):
         url_obj = get_memcached_value(memcache_format)
         if url_obj is None:
             # Original url is not in memcache: check database
-            url_obj = Url.fetch(original_url=url_to_short)
+            url_obj = Url.fetch_by_original_url(url_to_short)
         else:
             cached = True
     except Url.DoesNotExist:
@@ -41,42 +65,166 @@ def generate_short_url(request):
         url_obj = None
     # Generate shorten url
     if url_obj is None:
-        while True:
-            # Generating short_url based on SHORT_URL_LENGTH constant
-            short_url = str(uuid.uuid4())[:SHORT_URL_LENGTH]
-            # Keep in mind that short_url must be unique!
-            if not Url.short_url_exist(short_url):
-                # Shorted URL is unique
-                break
-
-        url_obj = Url.create(original_url=url_to_short, shorten_url=short_url)
+        # Generator never hands out the same short url twice, collisions with imported ones are retried by create
+        url_obj = short_url_generator.create(
+            lambda short_urls: Url.create(original_url=url_to_short, shorten_url=short_urls[0],
+                                          verified=None if deferred else True), 1)
+        if deferred:
+            verify_url(url_obj.id)
         status_code = 201
     if not cached:
         if add_to_memcache(memcache_format, url_obj):
             logging.info("Cache stored.")
-    resp = ("https://" if request.is_secure() else "http://") + (request.META['HTTP_HOST'] if 'HTTP_HOST' in request.META else "")+"/url/"+url_obj.shorten_url
-    return HttpResponse(json.dumps({"shortenUrl": resp}), status=status_code)
+    return HttpResponse(json.dumps({"shortenUrl": build_short_url(request, url_obj.shorten_url)}), status=status_code)
+
+
+def bulk_generate_short_urls(request):
+    """ Shortens a JSON array of URLs. Existing URLs are looked up with a single query, missing ones are created with
+    a single bulk insert. Response lists results in input order, invalid URLs get an error instead of a short url.
+    Reachability of created URLs is always verified by background tasks, whatever URL_VERIFICATION says, since
+    checking hundreds of URLs one by one would hold the request for minutes.
+    """
+    try:
+        urls = json.loads(request.body)
+    except ValueError:
+        return HttpResponse("Provided data is not valid.", status=400)
+    if not isinstance(urls, list):
+        return HttpResponse("Expected a JSON array of URLs.", status=400)
+    limit = getattr(settings, "BULK_SHORTEN_LIMIT", BULK_SHORTEN_LIMIT)
+    if len(urls) > limit:
+        return HttpResponse("At most {} URLs can be shortened at once.".format(limit), status=400)
+    normalized = [Url.normalize_url(url) if isinstance(url, six.string_types) and url else None for url in urls]
+    valid, errors = [], {}
+    for url_to_short in OrderedDict.fromkeys(url for url in normalized if url is not None):
+        try:
+            Url.check_url_validation(url_to_short, reachability=False)
+            valid.append(url_to_short)
+        except ValidationError as error:
+            errors[url_to_short] = " ".join(error.messages)
+    url_objs = Url.fetch_by_original_urls(valid)
+    missing = [url for url in valid if url not in url_objs]
+    # Short urls are generated before the insert transaction, see ShortUrlGenerator
+    created = short_url_generator.create(lambda short_urls: Url.create_many(missing, short_urls, verified=None),
+                                         len(missing))
+    for url_obj in created:
+        url_objs[url_obj.original_url] = url_obj
+        verify_url(url_obj.id)
+    cached_values = dict((ORIGINAL_URL_MEMCACHE_KEY.format(url), url_obj) for url, url_obj in url_objs.items())
+    cached_values.update((SHORT_URL_MEMCACHE_KEY.format(url_obj.shorten_url), url_obj) for url_obj in created)
+    set_many_memcache(cached_values)
+    created_urls = set(url_obj.original_url for url_obj in created)
+    resp = []
+    for url, url_to_short in zip(urls, normalized):
+        if url_to_short in url_objs:
+            resp.append({"url": url, "shortenUrl": build_short_url(request, url_objs[url_to_short].shorten_url),
+                         "created": url_to_short in created_urls})
+        else:
+            resp.append({"url": url, "error": errors.get(url_to_short, "Provided URL is not valid.")})
+    return HttpResponse(json.dumps(resp), status=200, content_type="application/json")
+
+
+def build_short_url(request, short_url):
+    return ("https://" if request.is_secure() else "http://") + request.META.get('HTTP_HOST', "") + "/url/" + short_url
 
 
 def get_url(request, url):
     try:
         url_obj = Url.check_short_url(url)
-        visit = UrlVisits.mark_visit(url_obj.id, request.META['REMOTE_ADDR'])
-        visitor = UrlVisitors.mark_visitor(request.META, visit.id)
+        record_visit(url_obj.id, request.META)
         return HttpResponsePermanentRedirect(url_obj.original_url)
     except URLException as fail:
         return HttpResponse(fail)
 
 
+def streamed(request, rows, fields, filename):
+    """ Streams rows returned by `rows` callable in the format requested by format parameter, None when the
+    parameter is missing and the regular response should be built.
+    """
+    output_format = request.GET.get("format")
+    if output_format is None:
+        return None
+    if output_format not in CONTENT_TYPES:
+        return HttpResponse("Unsupported format, use one of: {}".format(", ".join(sorted(CONTENT_TYPES))), status=400)
+    try:
+        return stream_response(rows(), output_format, fields, filename)
+    except URLException as error:
+        return HttpResponse(error, status=400)
+    except Exception as error:
+        return HttpResponse(error, status=500)
+
+
+def url_state(request, pk):
+    """ Returns (total visits, unique visitors, last visit, created) of the url, read once per request"""
+    if not hasattr(request, "_url_state"):
+        request._url_state = Url.objects.filter(id=pk).values_list("total_visits", "unique_visitors", "last_visit_at",
+                                                                   "created").first()
+    return request._url_state
+
+
+def url_etag(request, pk):
+    """ ETag of url's visits and visitors, any recorded visit changes the url's counters and compacting visit
+    records changes the url version.
+    """
+    state = url_state(request, pk)
+    if state is None:
+        return None
+    version = "{}:{}:{}:{}:{}".format(state[0], state[1], state[2], get_url_version(pk), request.build_absolute_uri())
+    return hashlib.md5(version.encode("utf-8")).hexdigest()
+
+
+def url_version(request, pk):
+    """ Version of url's visits and visitors responses. Recorded visits change the url's counters, so there is no
+    version to bump on the redirect path. Url version covers visit records rewritten by maintenance.
+    """
+    return "{}:{}".format(get_url_version(pk), url_state(request, pk))
+
+
+def url_last_modified(request, pk):
+    state = url_state(request, pk)
+    if state is None:
+        return None
+    return state[2] or state[3]
+
+
+def urls_list_etag(request):
+    """ ETag of the url listing. Data version changes with urls, visit counts are revalidated every
+    URLS_LIST_MAX_AGE seconds.
+    """
+    max_age = getattr(settings, "URLS_LIST_MAX_AGE", URLS_LIST_MAX_AGE)
+    version = "{}:{}:{}".format(get_data_version(), int(time.time() // max_age), request.build_absolute_uri())
+    return hashlib.md5(version.encode("utf-8")).hexdigest()
+
+
+@compress_page
+@condition(etag_func=urls_list_etag)
+@cache_response(lambda request: get_data_version())
 def urls_list(request):
+    response = streamed(request, lambda: Url.iter_all(request.META['HTTP_HOST'], request.is_secure(), **request.GET),
+                        URL_FIELDS, "urls")
+    if response is not None:
+        return response
     try:
-        resp = Url.fetch_all(request.META['HTTP_HOST'], request.is_secure(), **request.GET)
+        resp, next_cursor = Url.fetch_page(request.META['HTTP_HOST'], request.is_secure(), **request.GET)
+    except URLException as error:
+        return HttpResponse(error, status=400)
     except Exception as error:
         return HttpResponse(error, status=500)
-    return HttpResponse(json.dumps(resp), status=200, content_type="application/json")
+    response = HttpResponse(json.dumps(resp), status=200, content_type="application/json")
+    if next_cursor is not None:
+        params = request.GET.copy()
+        params['cursor'] = next_cursor
+        response['X-Next-Cursor'] = next_cursor
+        response['Link'] = '<{}>; rel="next"'.format(request.build_absolute_uri("?" + params.urlencode()))
+    return response
 
 
+@compress_page
+@condition(etag_func=url_etag, last_modified_func=url_last_modified)
+@cache_response(url_version)
 def get_url_visits(request, pk):
+    response = streamed(request, lambda: Url.iter_visits(pk), VISIT_FIELDS, "url-{}-visits".format(pk))
+    if response is not None:
+        return response
     try:
         resp = Url.get_all_visits(pk)
     except Exception as error:
@@ -84,9 +232,105 @@ def get_url_visits(request, pk):
     return HttpResponse(json.dumps(resp), status=200, content_type="application/json")
 
 
+@compress_page
+@condition(etag_func=url_etag, last_modified_func=url_last_modified)
+@cache_response(url_version)
 def get_url_visitors(request, pk):
     try:
-        resp = Url.get_all_visitors(pk)
+        network = Network(request.GET["network"]) if "network" in request.GET else None
+    except URLException as error:
+        return HttpResponse(error, status=400)
+    response = streamed(request, lambda: Url.iter_visitors(pk, network), VISITOR_FIELDS, "url-{}-visitors".format(pk))
+    if response is not None:
+        return response
+    try:
+        resp = Url.get_all_visitors(pk, network)
     except Exception as error:
         return HttpResponse(error, status=500)
-    return HttpResponse(json.dumps(resp), status=200, content_type="application/json")
\ No newline at end of file
+    return HttpResponse(json.dumps(resp), status=200, content_type="application/json")
+
+
+@compress_page
+@cache_response(lambda request: get_data_version())
+def get_visits_report(request):
+    if not reports_available():
+        return HttpResponse("Reports require numpy", status=501)
+    from_date, to_date = default_range()
+    try:
+        if "from_date" in request.GET:
+            from_date = datetime.datetime.strptime(request.GET["from_date"], DATE_FORMAT).date()
+        if "to_date" in request.GET:
+            to_date = datetime.datetime.strptime(request.GET["to_date"], DATE_FORMAT).date()
+        top = min(int(request.GET.get("top", REPORT_TOP_URLS)), REPORT_MAX_TOP_URLS)
+        report = visits_report(from_date, to_date, top)
+    except (ValueError, OverflowError, URLException) as error:
+        return HttpResponse(error, status=400)
+    return HttpResponse(json.dumps(report), status=200, content_type="application/json")
+
+
+def network_visitors(request):
+    """ Most recent visitors of any url from the network given in CIDR notation"""
+    try:
+        network = Network(request.GET.get("network", ""))
+        limit = min(int(request.GET.get("limit", URL_MAX_PAGE_SIZE)), URL_MAX_PAGE_SIZE)
+    except (ValueError, URLException) as error:
+        return HttpResponse(error, status=400)
+    if limit < 1:
+        return HttpResponse("limit must be positive", status=400)
+    response = streamed(request, lambda: UrlVisitors.iter_network(network, limit), NETWORK_VISITOR_FIELDS,
+                        "network-visitors")
+    if response is not None:
+        return response
+    return HttpResponse(json.dumps(list(UrlVisitors.iter_network(network, limit))), status=200,
+                        content_type="application/json")
+
+
+def get_url_history(request, pk):
+    try:
+        url_obj = Url.objects.defer("visitors_sketch").get(id=pk)
+    except Url.DoesNotExist as error:
+        return HttpResponse(error, status=404)
+    bucket = request.GET.get("bucket", "day")
+    try:
+        to_date = datetime.datetime.strptime(request.GET["to_date"], DATE_FORMAT).date() \
+            if "to_date" in request.GET else datetime.date.today()
+        from_date = datetime.datetime.strptime(request.GET["from_date"], DATE_FORMAT).date() \
+            if "from_date" in request.GET else url_obj.created.date()
+        history = UrlVisits.history(url_obj.id, bucket, from_date, to_date)
+    except (ValueError, URLException) as error:
+        return HttpResponse(error, status=400)
+    resp = {
+        "bucket": bucket,
+        "fromDate": datetime.date.strftime(from_date, DATE_FORMAT),
+        "toDate": datetime.date.strftime(to_date, DATE_FORMAT),
+        "uniqueVisitors": UrlVisits.unique_visitors_between(url_obj.id, from_date, to_date),
+        "visits": [{"start": datetime.date.strftime(start, DATE_FORMAT), "visits": visits}
+                   for start, visits in history.items()],
+    }
+    return HttpResponse(json.dumps(resp), status=200, content_type="application/json")
+
+
+def top_urls(request):
+    window = request.GET.get("window", "day")
+    if window not in HOT_URLS_WINDOWS:
+        return HttpResponse("Unsupported window, use one of: {}".format(", ".join(sorted(HOT_URLS_WINDOWS))),
+                            status=400)
+    try:
+        results = min(int(request.GET.get("results", 10)), HOT_URLS_MAX_RESULTS)
+    except ValueError as error:
+        return HttpResponse(error, status=400)
+    if results < 1:
+        return HttpResponse("results must be positive", status=400)
+    # Counts of this process are merged first, counts of other processes are at most a flush interval old
+    hot_urls.flush()
+    top = hot_urls.top(window, results)
+    urls = dict((url['shorten_url'], url) for url in Url.objects.filter(shorten_url__in=[key for key, counter in top])
+                .values("id", "shorten_url", "original_url", "created", "last_visit_from", "verified"))
+    resp = []
+    for short_url, (count, error) in top:
+        if short_url in urls:
+            url_resp = Url.values_json(urls[short_url], request.META.get('HTTP_HOST', ""), request.is_secure())
+            url_resp['visits'] = count
+            url_resp['visitsError'] = error
+            resp.append(url_resp)
+    return HttpResponse(json.dumps(resp), status=200, content_type="application/json")
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import atexit
+import datetime
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils.six.moves import queue
+
+from shortenurls.const import VISIT_ASYNC, VISIT_BUFFER_SIZE, VISIT_BUFFER_INTERVAL, VISIT_QUEUE_SIZE, \
+    VISIT_WRITE_BEHIND
+from shortenurls.models import Url, UrlVisits, UrlVisitors
+from shortenurls.networks import normalize_ip
+
+
+class VisitBuffer(object):
+    """ Per-process buffer of visit events. Events are handed to the background flusher in batches, either when
+    the buffer is full or when the oldest buffered event is older than the flush interval. A timer thread, started
+    on first use after the server forked its workers, flushes buffers that stopped receiving visits.
+    """
+
+    def __init__(self, size=VISIT_BUFFER_SIZE, interval=VISIT_BUFFER_INTERVAL, timer=True):
+        self.size = size
+        self.interval = interval
+        self.timer = timer
+        self._events = []
+        self._started = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def add(self, url_id, remote_addr, user_agent, timestamp=None):
+        """ Records a single visit event. Returns the number of events dispatched to the flusher (0 if none)."""
+        if self.timer and self._thread is None:
+            self._start_timer()
+        event = [url_id, remote_addr, user_agent, timestamp if timestamp is not None else time.time()]
+        with self._lock:
+            if not self._events:
+                self._started = event[3]
+            self._events.append(event)
+            if len(self._events) < self.size and event[3] - self._started < self.interval:
+                return 0
+            events, self._events = self._events, []
+        return self._dispatch(events)
+
+    def flush(self):
+        """ Dispatches every buffered event regardless of size and age."""
+        with self._lock:
+            events, self._events = self._events, []
+        return self._dispatch(events)
+
+    def flush_expired(self, now=None):
+        """ Dispatches buffered events once the oldest one is older than the flush interval."""
+        now = time.time() if now is None else now
+        with self._lock:
+            if not self._events or now - self._started < self.interval:
+                return 0
+            events, self._events = self._events, []
+        return self._dispatch(events)
+
+    def _start_timer(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="visit-buffer-timer")
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        # Checking twice per interval keeps buffered events at most one and a half intervals old
+        while True:
+            time.sleep(self.interval / 2.0)
+            try:
+                self.flush_expired()
+            except Exception as error:
+                logging.error("Flushing buffered visits failed: %s", error)
+            finally:
+                close_old_connections()
+
+    def __len__(self):
+        return len(self._events)
+
+    @staticmethod
+    def _dispatch(events):
+        if not events:
+            return 0
+        # Imported here since tasks module depends on this one
+        from shortenurls.tasks import flush_visit_events
+        try:
+            flush_visit_events(events)
+        except Exception as error:
+            logging.error("Scheduling of %d buffered visits failed: %s", len(events), error)
+            return 0
+        return len(events)
+
+
+visit_buffer = VisitBuffer(getattr(settings, "VISIT_BUFFER_SIZE", VISIT_BUFFER_SIZE),
+                           getattr(settings, "VISIT_BUFFER_INTERVAL", VISIT_BUFFER_INTERVAL))
+atexit.register(visit_buffer.flush)
+
+
+class VisitWorker(object):
+    """ Fire-and-forget visit recording. Visits are queued and written by a background thread of the worker process,
+    so the redirect is sent before any visit bookkeeping happens. Thread is started on first use, after the server
+    forked its workers. Without background, queued visits are only written by drain.
+    """
+
+    def __init__(self, size=VISIT_QUEUE_SIZE, background=True):
+        self.background = background
+        self._queue = queue.Queue(size)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, url_id, meta):
+        """ Queues a visit. Returns False when the queue is full and visit has to be recorded by the caller. Visit
+        time is taken here, so it isn't shifted by the time the visit spends in the queue.
+        """
+        if self.background and self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="visit-worker")
+                    self._thread.daemon = True
+                    self._thread.start()
+        try:
+            self._queue.put_nowait((url_id, meta, datetime.datetime.now()))
+        except queue.Full:
+            return False
+        return True
+
+    def _run(self):
+        while True:
+            self._write(*self._queue.get())
+            if self._queue.empty():
+                close_old_connections()
+
+    @staticmethod
+    def _write(url_id, meta, visited_at):
+        try:
+            write_visit(url_id, meta, visited_at)
+        except Exception as error:
+            logging.error("Recording visit of url %s failed: %s", url_id, error)
+
+    def drain(self):
+        """ Writes every queued visit on the calling thread"""
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            self._write(*item)
+
+
+visit_worker = VisitWorker(getattr(settings, "VISIT_QUEUE_SIZE", VISIT_QUEUE_SIZE))
+atexit.register(visit_worker.drain)
+
+
+def write_visit(url_id, meta, visited_at=None):
+    """ Writes a visit of a short url to UrlVisits, UrlVisitors and Url in a single transaction"""
+    visited_at = visited_at or datetime.datetime.now()
+    with transaction.atomic():
+        visit = UrlVisits.mark_visit(url_id, meta['REMOTE_ADDR'], visited_at)
+        UrlVisitors.mark_visitor(meta, visit.id, url_id, visited_at, visits=1, day=visit.date)
+    return visit
+
+
+def record_visit(url_id, meta):
+    """ Records a visit of a short url. With VISIT_WRITE_BEHIND setting visit is buffered and applied later by the
+    background flusher, with VISIT_ASYNC it is written by a background thread right after the response is sent,
+    otherwise it is written right away.
+    """
+    if getattr(settings, "VISIT_WRITE_BEHIND", VISIT_WRITE_BEHIND):
+        visit_buffer.add(url_id, meta['REMOTE_ADDR'], meta.get('HTTP_USER_AGENT', "N/A"))
+        return None
+    if getattr(settings, "VISIT_ASYNC", VISIT_ASYNC):
+        visitor_meta = {"REMOTE_ADDR": meta['REMOTE_ADDR'], "HTTP_USER_AGENT": meta.get('HTTP_USER_AGENT', "N/A")}
+        if visit_worker.submit(url_id, visitor_meta):
+            return None
+    return write_visit(url_id, meta)
+
+
+def coalesce_visit_events(events):
+    """ Folds raw visit events into per day, per visitor and per url aggregates so every affected row is written
+    only once.
+    """
+    visits = {}
+    visitors = {}
+    urls = {}
+    for url_id, remote_addr, user_agent, timestamp in events:
+        remote_addr = normalize_ip(remote_addr)
+        visited_at = datetime.datetime.fromtimestamp(timestamp)
+        day = visited_at.date()
+        visit = visits.setdefault((url_id, day), {"visits": 0, "last_visit_at": None, "last_visit_from": None})
+        visit['visits'] += 1
+        if visit['last_visit_at'] is None or visited_at >= visit['last_visit_at']:
+            visit['last_visit_at'] = visited_at
+            visit['last_visit_from'] = remote_addr
+        visitor = visitors.setdefault((url_id, day, remote_addr), {"visits": 0, "user_agent": user_agent,
+                                                                    "last_visit": visited_at})
+        visitor['visits'] += 1
+        visitor['last_visit'] = max(visitor['last_visit'], visited_at)
+        if url_id not in urls or visited_at >= urls[url_id][0]:
+            urls[url_id] = (visited_at, remote_addr)
+    return visits, visitors, urls
+
+
+def apply_visit_events(events):
+    """ Applies buffered visit events to UrlVisits, UrlVisitors and Url with one write per affected row."""
+    visits, visitors, urls = coalesce_visit_events(events)
+    existing = set(Url.objects.filter(id__in=list(urls)).values_list("id", flat=True))
+    visit_ids = {}
+    new_visitors = dict.fromkeys(urls, 0)
+    url_visits = dict.fromkeys(urls, 0)
+    with transaction.atomic():
+        for (url_id, day), visit in visits.items():
+            if url_id not in existing:
+                continue
+            visit_obj = UrlVisits.add_visits(url_id, day, visit['visits'], visit['last_visit_at'], visit['last_visit_from'])
+            visit_ids[(url_id, day)] = visit_obj.id
+            url_visits[url_id] += visit['visits']
+        day_visitors = {}
+        for (url_id, day, remote_addr), visitor in visitors.items():
+            if (url_id, day) not in visit_ids:
+                continue
+            day_visitors.setdefault((url_id, day), []).append(remote_addr)
+            if not UrlVisitors.rows_kept():
+                continue
+            visitor_obj, created = UrlVisitors.add_visits(visit_ids[(url_id, day)], day, remote_addr,
+                                                          visitor['user_agent'], visitor['visits'],
+                                                          visitor['last_visit'])
+            if created and UrlVisitors.counts_new_visitors() and \
+                    UrlVisitors.is_new_to_url(url_id, remote_addr, visit_ids[(url_id, day)]):
+                new_visitors[url_id] += 1
+        for (url_id, day), remote_addrs in day_visitors.items():
+            UrlVisits.add_visitors(url_id, visit_ids[(url_id, day)], day, remote_addrs)
+        for url_id, (visited_at, remote_addr) in urls.items():
+            if url_id in existing:
+                Url.update_last_visit(url_id, remote_addr, visited_at, new_visitors[url_id], url_visits[url_id])
+    return len(visit_ids)